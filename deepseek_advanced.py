@@ -1,11 +1,16 @@
 # Advanced DeepSeek-R1 Implementation
 # This script demonstrates advanced usage of DeepSeek-R1 with memory optimization
+# torch and transformers are imported on first use, so --help and argument errors are instant.
 
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 import argparse
 import gc
+import logging
+
+import deepseek_checkpoint
+
+logger = logging.getLogger(__name__)
 
 class DeepSeekModel:
     def __init__(self, 
@@ -13,7 +18,16 @@ class DeepSeekModel:
                  use_4bit: bool = False,
                  use_8bit: bool = False,
                  device: Optional[str] = None,
-                 cpu_only: bool = False):
+                 cpu_only: bool = False,
+                 cpu_int8: bool = False,
+                 quant_cache_dir: Optional[str] = None,
+                 draft_model_name: Optional[str] = None,
+                 lookahead: int = 4,
+                 dtype: Optional[str] = None,
+                 max_context_tokens: Optional[int] = None,
+                 context_summaries: bool = True,
+                 kv_pool_mb: Optional[float] = None,
+                 kv_block_size: int = 16):
         """
         Initialize the DeepSeek model with various optimization options.
         
@@ -23,6 +37,16 @@ class DeepSeekModel:
             use_8bit: Whether to use 8-bit quantization (requires bitsandbytes)
             device: Specific device to use (e.g., 'cuda:0', 'cpu')
             cpu_only: Force CPU usage regardless of GPU availability
+            cpu_int8: Run on CPU with int8 dynamic quantisation of the Linear layers
+            quant_cache_dir: Where the quantised model is cached (default ~/.cache/deepseek/int8)
+            draft_model_name: Small model with the same tokenizer used for speculative decoding
+            lookahead: Tokens the draft model proposes per verification step
+            dtype: Weight dtype name (e.g. 'bfloat16'); default float16 on CUDA, float32 on CPU
+            max_context_tokens: Prompt-token budget; older turns are summarised and left out
+            context_summaries: Summarise the turns left out (otherwise they are just dropped)
+            kv_pool_mb: Keep KV state in a paged block pool of this many MB; conversations
+                keep their blocks for the next turn and share common prompt prefixes
+            kv_block_size: Tokens per paged KV cache block
         """
         self.model_name = model_name
         self.tokenizer = None
@@ -30,20 +54,46 @@ class DeepSeekModel:
         self.use_4bit = use_4bit
         self.use_8bit = use_8bit
         self.cpu_only = cpu_only
+        self.cpu_int8 = cpu_int8
+        self.quant_cache_dir = quant_cache_dir
+        self.draft_model_name = draft_model_name
+        self.draft_model = None
+        self.lookahead = lookahead
+        self.dtype = dtype
+        self.max_context_tokens = max_context_tokens
+        self.context_summaries = context_summaries
+        # deepseek_context.ContextManager, created with the tokenizer when max_context_tokens is set
+        self.context = None
+        self.kv_pool_mb = kv_pool_mb
+        self.kv_block_size = kv_block_size
+        # deepseek_paged.KVBlockPool, and per conversation the (token ids, block table) of its last
+        # turn, least recently used first; the pool evicts them when it runs out of blocks
+        self.kv_pool = None
+        self._kv_tables: "OrderedDict[Optional[str], tuple]" = OrderedDict()
+        # Acceptance statistics of the last speculative generate_response() call
+        self.last_speculative_stats = None
+        # Reasoning/answer token counts of the last generate_response() call with a thinking budget
+        self.last_reasoning_stats = None
+        # Prompt tokens before/after compaction of the last generate_response() call with a context budget
+        self.last_context_stats = None
         
         # Determine device
-        if cpu_only:
+        if cpu_only or cpu_int8:
             self.device = "cpu"
         elif device:
             self.device = device
         else:
+            import torch
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
             
-        print(f"Using device: {self.device}")
+        logger.info(f"Using device: {self.device}")
         
     def load_model(self):
         """Load the model and tokenizer with the specified optimizations"""
-        print(f"Loading {self.model_name}...")
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        
+        logger.info(f"Loading {self.model_name}...")
         
         # Load tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(
@@ -58,15 +108,17 @@ class DeepSeekModel:
         
         # Add quantization if requested
         if self.use_4bit:
-            print("Using 4-bit quantization")
+            logger.info("Using 4-bit quantization")
             model_kwargs.update({
                 "load_in_4bit": True,
                 "bnb_4bit_compute_dtype": torch.float16,
                 "bnb_4bit_quant_type": "nf4",
             })
         elif self.use_8bit:
-            print("Using 8-bit quantization")
+            logger.info("Using 8-bit quantization")
             model_kwargs.update({"load_in_8bit": True})
+        elif self.dtype:
+            model_kwargs.update({"torch_dtype": getattr(torch, self.dtype)})
         elif self.device == "cuda":
             # Use half precision for CUDA without quantization
             model_kwargs.update({"torch_dtype": torch.float16})
@@ -77,13 +129,48 @@ class DeepSeekModel:
         else:
             model_kwargs["device_map"] = "auto"
         
-        # Load the model
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_name,
-            **model_kwargs
-        )
+        # Load the model; a prepared checkpoint is memory-mapped directly unless quantising
+        if self.cpu_int8:
+            from deepseek_quant import DEFAULT_CACHE_DIR, load_int8_model
+            logger.info("Using CPU int8 dynamic quantization")
+            self.model = load_int8_model(self.model_name, self.quant_cache_dir or DEFAULT_CACHE_DIR)
+        elif deepseek_checkpoint.is_prepared(self.model_name) and not (self.use_4bit or self.use_8bit):
+            logger.info("Loading prepared checkpoint")
+            self.model = deepseek_checkpoint.load_model(self.model_name, device=self.device)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_name,
+                **model_kwargs
+            )
+        
+        if self.draft_model_name:
+            self.load_draft_model()
+        
+        if self.max_context_tokens is not None:
+            from deepseek_context import ContextManager, model_summarizer
+            summarize = model_summarizer(self.tokenizer, self.summary_ids) if self.context_summaries else None
+            self.context = ContextManager(self.tokenizer, self.max_context_tokens, summarize=summarize)
+        
+        if self.kv_pool_mb:
+            from deepseek_paged import KVBlockPool
+            self.kv_pool = KVBlockPool.for_model(self.model, int(self.kv_pool_mb * 1024 * 1024), self.kv_block_size)
+            self.kv_pool.reclaim = self._release_kv_table
+        
+        logger.info("Model loaded successfully")
+        return self
+    
+    def load_draft_model(self):
+        """Load the draft model used for speculative decoding onto the main model's device"""
+        from transformers import AutoTokenizer
+        from deepseek_speculative import check_compatible
         
-        print("Model loaded successfully")
+        logger.info(f"Loading draft model {self.draft_model_name}...")
+        draft_tokenizer = AutoTokenizer.from_pretrained(self.draft_model_name, trust_remote_code=True)
+        check_compatible(self.tokenizer, draft_tokenizer)
+        
+        self.draft_model = deepseek_checkpoint.load_model(self.draft_model_name, device=self.device,
+                                                          torch_dtype=self.model.dtype)
+        self.draft_model.to(self.model.device).eval()
         return self
     
     def generate_response(self, 
@@ -92,7 +179,9 @@ class DeepSeekModel:
                          temperature: float = 0.7,
                          top_p: float = 0.9,
                          top_k: int = 50,
-                         do_sample: bool = True) -> str:
+                         do_sample: bool = True,
+                         thinking_budget: Optional[int] = None,
+                         conversation: Optional[str] = None) -> str:
         """
         Generate a response based on the provided messages.
         
@@ -103,80 +192,250 @@ class DeepSeekModel:
             top_p: Nucleus sampling parameter
             top_k: Top-k sampling parameter
             do_sample: Whether to use sampling instead of greedy decoding
+            thinking_budget: Close the <think> section after this many tokens and leave it
+                out of the response (reasoning/answer counts in last_reasoning_stats)
+            conversation: Id of the chat messages belong to, so its summaries carry over
+                between turns when max_context_tokens is set
             
         Returns:
             Generated response as a string
+        
+        With a draft model loaded, greedy decoding is speculative (same output, acceptance
+        statistics in last_speculative_stats) and sampling uses transformers' assisted generation.
+        With a paged KV pool (and no draft model), KV state already held for the conversation's
+        last turn or a shared prompt prefix is reused instead of prefilled.
         """
         if self.model is None or self.tokenizer is None:
             raise ValueError("Model and tokenizer must be loaded before generating responses")
         
-        # Apply chat template
-        inputs = self.tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        ).to(self.model.device)
+        import torch
+        
+        # Long conversations keep their recent turns plus a summary of the rest
+        if self.context is not None:
+            compaction = self.context.fit(messages, conversation=conversation)
+            messages = compaction.messages
+            self.last_context_stats = {"prompt_tokens_before": compaction.tokens_before,
+                                       "prompt_tokens_after": compaction.tokens_after,
+                                       "dropped_messages": compaction.dropped,
+                                       "summarized_messages": compaction.summarized}
+        
+        # Apply chat template (assembled from cached token fragments, same ids as apply_chat_template)
+        prompt_ids = self.encode(messages)
+        input_ids = torch.tensor([prompt_ids], device=self.model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        
+        reasoning = None
+        if thinking_budget is not None:
+            from deepseek_reasoning import ReasoningTracker, budget_processor, split_answer
+            reasoning = ReasoningTracker.create(self.tokenizer, prompt_ids, thinking_budget)
         
         # Generate response
+        if self.draft_model is not None and not do_sample and reasoning is None:
+            from deepseek_speculative import speculative_generate
+            outputs, self.last_speculative_stats = speculative_generate(
+                self.model,
+                self.draft_model,
+                inputs["input_ids"],
+                max_new_tokens=max_new_tokens,
+                lookahead=self.lookahead,
+                eos_token_id=self.tokenizer.eos_token_id
+            )
+        else:
+            assisted = {"assistant_model": self.draft_model} if self.draft_model is not None else {}
+            if reasoning is not None:
+                assisted["logits_processor"] = budget_processor(reasoning)
+            table = None
+            # Turns longer than the whole pool (plus a copied block) use the default cache
+            blocks = -(-(len(prompt_ids) + max_new_tokens) // self.kv_block_size) + 1
+            if self.kv_pool is not None and self.draft_model is None and blocks <= self.kv_pool.usable_blocks:
+                from deepseek_paged import PagedCache
+                table = self._kv_table(prompt_ids, conversation)
+                assisted["past_key_values"] = PagedCache(self.kv_pool, [table])
+            try:
+                with torch.no_grad():
+                    outputs = self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                        top_k=top_k,
+                        do_sample=do_sample,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        **assisted
+                    )
+            except Exception:
+                if table is not None:
+                    self.kv_pool.free(table)
+                raise
+            if table is not None:
+                self._keep_kv_table(conversation, outputs[0].tolist(), table)
+        
+        # Decode response
+        output_ids = outputs[0][inputs["input_ids"].shape[-1]:].tolist()
+        if reasoning is not None:
+            output_ids, split = split_answer(self.tokenizer, prompt_ids, output_ids)
+            self.last_reasoning_stats = dict(split.stats(), thinking_budget_exhausted=reasoning.budget_exhausted)
+        response = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        
+        return response
+    
+    def _kv_table(self, prompt_ids: List[int], conversation: Optional[str]):
+        """A block table holding the KV state of the longest prefix of prompt_ids already in the pool"""
+        from deepseek_kv import common_prefix_length
+        
+        kept = self._kv_tables.get(conversation)
+        if kept is not None:
+            kept_ids, kept_table = kept
+            reused = min(common_prefix_length(kept_ids, prompt_ids), len(prompt_ids) - 1)
+            if reused > 0:
+                return self.kv_pool.fork(kept_table, reused)
+        return self.kv_pool.match(prompt_ids)
+    
+    def _keep_kv_table(self, conversation: Optional[str], token_ids: List[int], table):
+        """Keep a finished turn's blocks as its conversation's cache, replacing the previous turn's"""
+        token_ids = token_ids[:table.length]
+        self.kv_pool.commit(table, token_ids)
+        previous = self._kv_tables.pop(conversation, None)
+        if previous is not None:
+            self.kv_pool.free(previous[1])
+        self._kv_tables[conversation] = (token_ids, table)
+    
+    def _release_kv_table(self) -> bool:
+        """Free the least recently used conversation's blocks (called by the pool when it is full)"""
+        if not self._kv_tables:
+            return False
+        _, (_, table) = self._kv_tables.popitem(last=False)
+        self.kv_pool.free(table)
+        return True
+    
+    def summary_ids(self, prompt_ids: List[int], max_new_tokens: int) -> List[int]:
+        """Greedy continuation of prompt_ids, used to write conversation summaries"""
+        import torch
+        
+        input_ids = torch.tensor([prompt_ids], device=self.model.device)
+        with torch.no_grad():
+            outputs = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                          max_new_tokens=max_new_tokens, do_sample=False,
+                                          pad_token_id=self.tokenizer.eos_token_id)
+        return outputs[0][len(prompt_ids):].tolist()
+    
+    def encode(self, messages: List[Dict[str, str]]) -> List[int]:
+        """Prompt token ids for messages with the chat template applied"""
+        from deepseek_prompts import encode_chat
+        return encode_chat(self.tokenizer, messages)
+    
+    def generate_batch(self,
+                       prompts: List[List[int]],
+                       max_new_tokens: int = 100,
+                       temperature: float = 0.7,
+                       top_p: float = 0.9,
+                       top_k: int = 50,
+                       do_sample: bool = True) -> List[List[int]]:
+        """
+        Generate for several tokenized prompts in one left-padded batch.
+        
+        Prompts of similar length waste the least compute on padding. Returns the new token
+        ids of each prompt, cut after the first end-of-sequence token.
+        """
+        if self.model is None or self.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded before generating responses")
+        
+        import torch
+        
+        eos_token_id = self.tokenizer.eos_token_id
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else eos_token_id
+        width = max(len(ids) for ids in prompts)
+        input_ids = torch.tensor([[pad_token_id] * (width - len(ids)) + list(ids) for ids in prompts])
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in prompts])
+        
         with torch.no_grad():
             outputs = self.model.generate(
-                **inputs,
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
                 max_new_tokens=max_new_tokens,
                 temperature=temperature,
                 top_p=top_p,
                 top_k=top_k,
                 do_sample=do_sample,
-                pad_token_id=self.tokenizer.eos_token_id
+                pad_token_id=pad_token_id
             )
         
-        # Decode response
-        response = self.tokenizer.decode(
-            outputs[0][inputs["input_ids"].shape[-1]:],
-            skip_special_tokens=True
-        )
-        
-        return response
+        results = []
+        for row in outputs[:, width:].tolist():
+            if eos_token_id in row:
+                row = row[:row.index(eos_token_id) + 1]
+            results.append(row)
+        return results
     
     def unload_model(self):
         """Unload the model and free up GPU memory"""
         if self.model is not None:
             del self.model
             self.model = None
+        if self.draft_model is not None:
+            del self.draft_model
+            self.draft_model = None
         if self.tokenizer is not None:
             del self.tokenizer
             self.tokenizer = None
+        self.context = None
+        self.kv_pool = None
+        self._kv_tables.clear()
         
         # Force garbage collection
         gc.collect()
+        import torch
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
         
-        print("Model unloaded and memory freed")
+        logger.info("Model unloaded and memory freed")
 
 
 def main():
+    # Library modules log their progress (model loading, registry) instead of printing
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="DeepSeek-R1 Advanced Demo")
     parser.add_argument("--message", type=str, default="Who are you?", 
                         help="Message to send to the model")
+    parser.add_argument("--model", type=str, default="deepseek-ai/DeepSeek-R1",
+                        help="HuggingFace model identifier or local (prepared) model directory")
     parser.add_argument("--4bit", dest="use_4bit", action="store_true", 
                         help="Use 4-bit quantization")
     parser.add_argument("--8bit", dest="use_8bit", action="store_true", 
                         help="Use 8-bit quantization")
     parser.add_argument("--cpu", action="store_true", 
                         help="Force CPU usage")
+    parser.add_argument("--cpu-int8", action="store_true",
+                        help="Use CPU int8 dynamic quantization (cached on disk after the first run)")
+    parser.add_argument("--quant-cache", type=str, default=None,
+                        help="Directory for the cached int8 model")
     parser.add_argument("--max-tokens", type=int, default=100, 
                         help="Maximum new tokens to generate")
+    parser.add_argument("--draft-model", type=str, default=None,
+                        help="Small model with the same tokenizer for speculative decoding")
+    parser.add_argument("--lookahead", type=int, default=4,
+                        help="Tokens the draft model proposes per step")
+    parser.add_argument("--greedy", action="store_true",
+                        help="Greedy decoding instead of sampling")
+    parser.add_argument("--thinking-budget", type=int, default=None,
+                        help="Cap the <think> section at this many tokens and print only the answer")
+    parser.add_argument("--kv-pool-mb", type=float, default=None,
+                        help="Keep the KV cache in a paged block pool of this many MB")
     args = parser.parse_args()
     
     # Initialize and load model
     model = DeepSeekModel(
+        model_name=args.model,
         use_4bit=args.use_4bit,
         use_8bit=args.use_8bit,
-        cpu_only=args.cpu
+        cpu_only=args.cpu,
+        cpu_int8=args.cpu_int8,
+        quant_cache_dir=args.quant_cache,
+        draft_model_name=args.draft_model,
+        lookahead=args.lookahead,
+        kv_pool_mb=args.kv_pool_mb
     ).load_model()
     
     # Create messages
@@ -188,10 +447,22 @@ def main():
     print(f"\nUser: {args.message}")
     response = model.generate_response(
         messages=messages,
-        max_new_tokens=args.max_tokens
+        max_new_tokens=args.max_tokens,
+        do_sample=not args.greedy,
+        thinking_budget=args.thinking_budget
     )
     print(f"DeepSeek-R1: {response}")
     
+    if args.thinking_budget is not None and model.last_reasoning_stats is not None:
+        stats = model.last_reasoning_stats
+        print(f"Reasoning: {stats['reasoning_tokens']} tokens, answer: {stats['answer_tokens']} tokens"
+              + (" (thinking budget reached)" if stats["thinking_budget_exhausted"] else ""))
+    
+    stats = model.last_speculative_stats
+    if stats is not None:
+        print(f"Speculative decoding: {stats['accepted_tokens']}/{stats['draft_tokens']} draft tokens accepted "
+              f"({stats['acceptance_rate']:.0%}), {stats['tokens_per_pass']:.2f} tokens per main-model pass")
+    
     # Unload model to free memory
     model.unload_model()
 
@@ -0,0 +1,360 @@
+# DeepSeek-R1 Async Web Application
+# Serves the chat app as an ASGI application (run with uvicorn) so HTTP handling never blocks on
+# inference: handlers only queue work with the batching scheduler and await its callbacks. When
+# the scheduler queue is full requests are shed immediately with 429 and a Retry-After header.
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+
+from jinja2 import Environment
+
+import deepseek_web_app as web
+from deepseek_cancel import CancellationToken
+from deepseek_errors import DeadlineExceeded, QueueFullError, SessionBusyError
+from deepseek_metrics import CONTENT_TYPE
+from deepseek_streaming import IncrementalDetokenizer, format_sse, timing_stats
+
+HOME_TEMPLATE = Environment(autoescape=True).from_string(web.HTML_TEMPLATE)
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+async def read_body(receive):
+    """Collect the full request body"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return body
+
+
+async def send_response(send, status, body, content_type=b"application/json", headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, payload, headers=()):
+    await send_response(send, status, json.dumps(payload, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+
+def retry_after_header(retry_after):
+    return [(b"retry-after", str(retry_after).encode())]
+
+
+async def request_data(scope, receive):
+    """JSON body of a POST, or the query string of a GET"""
+    if scope["method"] == "GET":
+        return {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+    try:
+        return json.loads(await read_body(receive) or b"{}")
+    except ValueError:
+        return {}
+
+
+def watch_disconnect(receive, cancel_token):
+    """Cancel cancel_token when the client disconnects; cancel the returned task once the response is sent"""
+    async def watch():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                cancel_token.cancel()
+                return
+
+    return asyncio.ensure_future(watch())
+
+
+async def submit(user_message, session_id, stream, cancel_token=None, language="english", tenant=None,
+                 priority=None):
+    """
+    Queue a chat turn from the event loop.
+
+    Returns (generation, input_ids, session, events): the scheduler thread hands each token id,
+    then None when the request finishes, to the events queue via call_soon_threadsafe.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_token(token_id):
+        loop.call_soon_threadsafe(events.put_nowait, token_id)
+
+    def on_done(_):
+        loop.call_soon_threadsafe(events.put_nowait, None)
+
+    # Templating and the session lookup run off the loop too
+    generation, input_ids, session = await loop.run_in_executor(
+        None, lambda: web.submit_chat(user_message, session_id, on_token=on_token if stream else None,
+                                      on_done=on_done, cancel_token=cancel_token, language=language,
+                                      tenant=tenant, priority=priority))
+    return generation, input_ids, session, events
+
+
+async def home(scope, receive, send):
+    status_message = "Model is ready!" if web.model_loaded else "Loading model... This may take a few minutes."
+    body = HOME_TEMPLATE.render(status_message=status_message, model_ready=web.model_loaded)
+    await send_response(send, 200, body.encode("utf-8"), content_type=b"text/html; charset=utf-8")
+
+
+async def status(scope, receive, send):
+    await send_json(send, 200, web.status_payload())
+
+
+async def prometheus_metrics(scope, receive, send):
+    await send_response(send, 200, web.metrics.render().encode("utf-8"), content_type=CONTENT_TYPE.encode())
+
+
+async def chat(scope, receive, send):
+    """Handle chat requests"""
+    if not web.model_loaded:
+        web.ensure_model_loading()
+        await send_json(send, 200, {"response": "Model is still loading. Please wait."})
+        return
+
+    data = await request_data(scope, receive)
+    user_message = data.get('message', '')
+    session_id = data.get('session_id')
+    language = data.get('language', 'english')
+
+    if not user_message:
+        await send_json(send, 200, {"response": "Please provide a message."})
+        return
+    try:
+        tenant, priority = web.request_tenant(data)
+    except ValueError as e:
+        await send_json(send, 400, {"response": str(e)})
+        return
+
+    answered = web.lookup_response(user_message, language, session_id)
+    if answered is not None:
+        await send_json(send, 200, {"response": answered.answer, "lookup": answered.intent})
+        return
+
+    cached = web.cached_response(user_message, language, session_id)
+    if cached is not None:
+        web.metrics.count("cached")
+        await send_json(send, 200, {"response": cached, "cached": True})
+        return
+
+    cancel_token = CancellationToken()
+    watcher = watch_disconnect(receive, cancel_token)
+    generation = session = None
+    try:
+        generation, input_ids, session, events = await submit(user_message, session_id, stream=False,
+                                                              cancel_token=cancel_token, language=language,
+                                                              tenant=tenant, priority=priority)
+        await asyncio.wait_for(events.get(), timeout=web.REQUEST_TIMEOUT + web.DEADLINE_GRACE)
+        generation.result(timeout=0)
+
+        detokenize_started = time.perf_counter()
+        response = web.response_text(generation, input_ids)
+        generation.timings["detokenize"] = time.perf_counter() - detokenize_started
+        web.record_metrics(generation, input_ids, language)
+        web.finish_chat(generation, session, user_message, response, language)
+
+        payload = {"response": response}
+        if session is not None:
+            payload["session_id"] = session_id
+            usage = web.context_usage(session)
+            if usage:
+                payload["usage"] = {"prompt_tokens": len(input_ids), **usage}
+        if generation.truncated:
+            payload.update(truncated=True, finish_reason=generation.finish_reason)
+        await send_json(send, 200, payload)
+    except QueueFullError as e:
+        web.metrics.count("rejected")
+        payload, retry_after = web.queue_full_response(e)
+        await send_json(send, 429, payload, headers=retry_after_header(retry_after))
+    except SessionBusyError:
+        web.metrics.count("rejected")
+        await send_json(send, 409, {"response": web.SESSION_BUSY_MESSAGE})
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        cancel_token.cancel()
+        web.metrics.count("expired")
+        await send_json(send, 504, {"response": "The request timed out. Please try again."})
+    except Exception as e:
+        cancel_token.cancel()
+        web.metrics.count("error")
+        print(f"Error generating response: {e}")
+        await send_json(send, 200, {"response": f"Error generating response: {str(e)}"})
+    finally:
+        watcher.cancel()
+        # A turn that failed still frees its session (finish_chat already did otherwise)
+        web.end_turn(generation, session)
+
+
+async def chat_stream(scope, receive, send):
+    """Stream a chat response as server-sent events: token events, then a done event with usage"""
+    if not web.model_loaded:
+        web.ensure_model_loading()
+        await send_response(send, 200, format_sse("error", {"error": "Model is still loading. Please wait."}).encode(),
+                            content_type=b"text/event-stream")
+        return
+
+    data = await request_data(scope, receive)
+    user_message = data.get('message', '')
+    session_id = data.get('session_id')
+    language = data.get('language', 'english')
+
+    if not user_message:
+        await send_response(send, 200, format_sse("error", {"error": "Please provide a message."}).encode(),
+                            content_type=b"text/event-stream")
+        return
+    try:
+        tenant, priority = web.request_tenant(data)
+    except ValueError as e:
+        await send_response(send, 400, format_sse("error", {"error": str(e)}).encode(),
+                            content_type=b"text/event-stream")
+        return
+
+    answered = web.lookup_response(user_message, language, session_id)
+    if answered is not None:
+        body = (format_sse("token", {"text": answered.answer})
+                + format_sse("done", {"finish_reason": "lookup", "lookup": answered.intent}))
+        await send_response(send, 200, body.encode("utf-8"), content_type=b"text/event-stream")
+        return
+
+    cached = web.cached_response(user_message, language, session_id)
+    if cached is not None:
+        web.metrics.count("cached")
+        body = format_sse("token", {"text": cached}) + format_sse("done", {"finish_reason": "cached", "cached": True})
+        await send_response(send, 200, body.encode("utf-8"), content_type=b"text/event-stream")
+        return
+
+    cancel_token = CancellationToken()
+    try:
+        generation, input_ids, session, events = await submit(user_message, session_id, stream=True,
+                                                              cancel_token=cancel_token, language=language,
+                                                              tenant=tenant, priority=priority)
+    except QueueFullError as e:
+        web.metrics.count("rejected")
+        payload, retry_after = web.queue_full_response(e)
+        body = format_sse("error", {"error": payload["response"], "retry_after": retry_after})
+        await send_response(send, 429, body.encode("utf-8"), content_type=b"text/event-stream",
+                            headers=retry_after_header(retry_after))
+        return
+    except SessionBusyError:
+        web.metrics.count("rejected")
+        await send_response(send, 409, format_sse("error", {"error": web.SESSION_BUSY_MESSAGE}).encode("utf-8"),
+                            content_type=b"text/event-stream")
+        return
+
+    await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+
+    async def emit(event, payload):
+        await send({"type": "http.response.body", "body": format_sse(event, payload).encode("utf-8"),
+                    "more_body": True})
+
+    detokenizer = IncrementalDetokenizer(web.tier_tokenizer(generation))
+    reasoning = web.answer_filter(generation, input_ids)
+    detokenize_seconds = 0.0
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + web.REQUEST_TIMEOUT + web.DEADLINE_GRACE
+    # A client that goes away mid-stream cancels the generation, freeing its batch slot
+    watcher = watch_disconnect(receive, cancel_token)
+    try:
+        while True:
+            token_id = await asyncio.wait_for(events.get(), timeout=max(0.0, deadline - loop.time()))
+            if token_id is None:
+                break
+            if reasoning is not None and not reasoning.observe(token_id):
+                continue
+            detokenize_started = time.perf_counter()
+            text = detokenizer.add(token_id)
+            detokenize_seconds += time.perf_counter() - detokenize_started
+            if text:
+                await emit("token", {"text": text})
+        if generation.error is not None:
+            raise generation.error
+        text = detokenizer.flush()
+        if text:
+            await emit("token", {"text": text})
+        generation.timings["detokenize"] = detokenize_seconds
+        usage = web.record_metrics(generation, input_ids, language)
+
+        web.finish_chat(generation, session, user_message, web.response_text(generation, input_ids), language)
+        stats = timing_stats(generation.submitted_at, generation.first_token_at, generation.finished_at,
+                             len(input_ids), len(generation.output_ids))
+        stats["usage"].update(usage, **web.context_usage(session))
+        await emit("done", {"finish_reason": generation.finish_reason, "truncated": generation.truncated, **stats})
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        web.metrics.count("expired")
+        await emit("error", {"error": "The request timed out. Please try again."})
+    except Exception as e:
+        web.metrics.count("error")
+        print(f"Error streaming response: {e}")
+        await emit("error", {"error": f"Error generating response: {str(e)}"})
+    finally:
+        watcher.cancel()
+        if not generation.done:
+            cancel_token.cancel()
+        web.end_turn(generation, session)
+    await send({"type": "http.response.body", "body": b""})
+
+
+ROUTES = {
+    ("GET", "/"): home,
+    ("GET", "/api/status"): status,
+    ("GET", "/metrics"): prometheus_metrics,
+    ("POST", "/api/chat"): chat,
+    ("GET", "/api/chat/stream"): chat_stream,
+    ("POST", "/api/chat/stream"): chat_stream,
+}
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if web.scheduler is not None:
+                    web.scheduler.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        known = any(path == scope["path"] for _, path in ROUTES)
+        await send_json(send, 405 if known else 404, {"error": "Method not allowed" if known else "Not found"})
+        return
+    await handler(scope, receive, send)
+
+
+def main():
+    parser = web.build_arg_parser("DeepSeek-R1 Web App (async server)")
+    parser.add_argument("--log-level", type=str, default="info", help="uvicorn log level")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    web.configure(args)
+
+    import uvicorn
+
+    # Start model loading in background if requested
+    if args.load_model_on_startup:
+        threading.Thread(target=web.load_model_in_background, daemon=True).start()
+
+    # One process, one event loop: concurrency comes from the scheduler, not from extra workers
+    uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,788 @@
+# DeepSeek Continuous Batching Scheduler
+# A scheduler thread owns the model and decodes all active requests together, one token per
+# step. Finished sequences leave the batch and queued ones join at token boundaries, so
+# throughput scales with concurrency instead of requests serialising on the model.
+# Waiting requests are admitted by priority class and weighted-fair across tenants, and an
+# interactive request may preempt a running batch request when every slot is taken.
+# With a KVBlockPool (deepseek_paged), the batch's KV state lives in the pool's blocks instead of
+# one padded tensor, and requests are admitted while the pool has room for them.
+
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import queue
+import threading
+import time
+import weakref
+
+import torch
+
+from deepseek_kv import (
+    KVLayers,
+    cache_to_layers,
+    concat_rows,
+    layers_nbytes,
+    layers_seq_length,
+    layers_to_cache,
+    select_rows,
+    slice_positions,
+)
+from deepseek_cancel import CANCELLED, CancellationToken, stop_reason
+from deepseek_errors import DeadlineExceeded, KVPoolExhausted, QueueFullError
+from deepseek_fairness import DEFAULT_TENANT, FairQueue, TenantPolicy, priority_rank
+from deepseek_paged import PagedCache
+from deepseek_reasoning import ReasoningTracker
+
+
+class GenerationRequest:
+    """A queued generation request; wait on it with result() or register callbacks"""
+
+    def __init__(self,
+                 input_ids: List[int],
+                 max_new_tokens: int = 100,
+                 temperature: float = 0.7,
+                 top_p: float = 0.9,
+                 top_k: int = 0,
+                 do_sample: bool = True,
+                 stream: bool = False,
+                 past_layers: Optional[KVLayers] = None,
+                 past_table=None,
+                 keep_cache: bool = False,
+                 deadline: Optional[float] = None,
+                 cancel_token: Optional[CancellationToken] = None,
+                 reasoning: Optional[ReasoningTracker] = None,
+                 tenant: Optional[str] = None,
+                 priority: Optional[str] = None,
+                 token_probs: Optional[List[float]] = None,
+                 on_token: Optional[Callable[[int], None]] = None,
+                 on_done: Optional[Callable[["GenerationRequest"], None]] = None):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.do_sample = do_sample
+        # Follows the <think> section and forces it closed once the thinking budget is spent
+        self.reasoning = reasoning
+        # Who the request is for and its priority class (see deepseek_fairness)
+        self.tenant = tenant
+        self.priority = priority
+        self.rank = priority_rank(priority)
+        self.preemptions = 0
+        # When a list is given, the probability of each sampled token is appended to it (the
+        # model's confidence, used by deepseek_routing), and the name of the model tier that
+        # served the request (None: the serving model)
+        self.token_probs = token_probs
+        self.model_tier: Optional[str] = None
+
+        # KV state already computed for a prefix of input_ids, and whether to hand back the
+        # final KV state (cache_layers covering cache_ids) when the request finishes. With a
+        # paged KV cache, both are block tables of the scheduler's pool (past_table, cache_table)
+        # and kv_table holds the running sequence's blocks.
+        self.past_layers = past_layers
+        self.past_table = past_table
+        self.keep_cache = keep_cache
+        self.cache_layers: Optional[KVLayers] = None
+        self.cache_table = None
+        self.cache_ids: List[int] = []
+        self.kv_table = None
+        self._cache_finalizer = None
+        # Prompt tokens whose KV state was reused instead of prefilled
+        self.cached_tokens = 0
+        # Set when the request receives the output of an identical one already in flight
+        # (deepseek_coalesce) instead of being generated itself
+        self.coalesced = False
+
+        # Absolute time.time() after which the request is no longer worth serving, a token the
+        # caller cancels when it gives up, and callbacks run on the scheduler thread (they must
+        # be quick and must not block). A request stopped by either keeps its partial output.
+        self.deadline = deadline
+        self.cancel_token = cancel_token
+        self.on_token = on_token
+        self.on_done = on_done
+
+        self.output_ids: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.submitted_at = time.time()
+        self.queued_at = self.submitted_at
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Decode tokens not generated because the request was cancelled or ran out of time
+        self.tokens_saved = 0
+        # Seconds spent per stage ("queue", "prefill", "decode"); callers add their own stages
+        self.timings: Dict[str, float] = {}
+        self._done = threading.Event()
+        self._tokens: Optional[queue.Queue] = queue.Queue() if stream else None
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def truncated(self) -> bool:
+        """True if the request was stopped early and output_ids is partial"""
+        return self.tokens_saved > 0 and self.error is None
+
+    def result(self, timeout: Optional[float] = None) -> List[int]:
+        """Block until the request finishes and return the generated token ids"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def iter_tokens(self, timeout: Optional[float] = None) -> Iterator[int]:
+        """Yield generated token ids as they are produced (request must be submitted with stream=True)"""
+        if self._tokens is None:
+            raise ValueError("Request was not submitted with stream=True")
+        while True:
+            try:
+                token_id = self._tokens.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("No token produced in time")
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    def take_cache_table(self):
+        """Take over cache_table; a table nobody takes is freed when the request is garbage collected"""
+        table, self.cache_table = self.cache_table, None
+        if self._cache_finalizer is not None:
+            self._cache_finalizer.detach()
+            self._cache_finalizer = None
+        return table
+
+    def _append(self, token_id: int):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.output_ids.append(token_id)
+        if self.reasoning is not None:
+            self.reasoning.observe(token_id)
+        if self._tokens is not None:
+            self._tokens.put(token_id)
+        if self.on_token is not None:
+            self.on_token(token_id)
+
+    def _finish(self, reason: str, error: Optional[BaseException] = None):
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        if self.first_token_at is not None:
+            self.timings["decode"] = self.finished_at - self.first_token_at
+        self._done.set()
+        if self._tokens is not None:
+            self._tokens.put(None)
+        if self.on_done is not None:
+            self.on_done(self)
+
+
+def sample_next_token(logits: torch.Tensor, request: GenerationRequest) -> int:
+    """Pick the next token for one sequence from its last-position logits"""
+    token_id = pick_token(logits, request)
+    if request.token_probs is not None:
+        request.token_probs.append(float(torch.softmax(logits.float(), dim=-1)[token_id]))
+    return token_id
+
+
+def pick_token(logits: torch.Tensor, request: GenerationRequest) -> int:
+    """Greedy, forced or sampled (temperature/top-k/top-p) choice of the next token"""
+    if request.reasoning is not None:
+        forced = request.reasoning.forced_token()
+        if forced is not None:
+            return forced
+    if not request.do_sample or request.temperature <= 0:
+        return int(torch.argmax(logits))
+
+    logits = logits.float() / request.temperature
+    if request.top_k and request.top_k > 0:
+        kth = torch.topk(logits, min(request.top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if 0 < request.top_p < 1:
+        sorted_logits, sorted_index = torch.sort(logits, descending=True)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # Drop tokens once the cumulative probability before them already exceeds top_p
+        remove = cumulative - torch.softmax(sorted_logits, dim=-1) > request.top_p
+        logits = logits.scatter(0, sorted_index, sorted_logits.masked_fill(remove, float("-inf")))
+    probs = torch.softmax(logits, dim=-1)
+    return int(torch.multinomial(probs, 1))
+
+
+class ContinuousBatchingScheduler:
+    """Owns the model and runs iteration-level (continuous) batching on a background thread"""
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_queue_depth: Optional[int] = None,
+                 tenants: Optional[Dict[str, TenantPolicy]] = None, preemption: bool = True, kv_pool=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_queue_depth = max_queue_depth
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        eos = model.generation_config.eos_token_id if model.generation_config.eos_token_id is not None \
+            else tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        self.preemption = preemption
+        self._queue = FairQueue(tenants)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="batching-scheduler", daemon=True)
+
+        # Batch state: active requests, their batched KV layers and the attention mask, or with
+        # a paged KV cache (deepseek_paged.KVBlockPool) one block table per active request
+        self.kv_pool = kv_pool
+        self._active: List[GenerationRequest] = []
+        self._layers = None
+        # The DynamicCache the decode steps extend in place; rebuilt from _layers only when rows
+        # join or leave the batch, so a step does not copy the whole batch's KV state again
+        self._cache = None
+        self._mask: Optional[torch.Tensor] = None
+        self._tables: List[Any] = []
+        self._next_tokens: Optional[torch.Tensor] = None
+
+        # Occupancy and throughput counters
+        self.steps = 0
+        self.occupied_slots = 0
+        self.generated_tokens = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.tokens_saved = 0
+        self.preempted = 0
+        self.peak_active = 0
+        self.peak_kv_bytes = 0
+
+        # Moving average of how long a request occupies a batch slot, for wait estimates
+        self.mean_service_time: Optional[float] = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def submit(self,
+               input_ids: List[int],
+               max_new_tokens: int = 100,
+               temperature: float = 0.7,
+               top_p: float = 0.9,
+               top_k: int = 0,
+               do_sample: bool = True,
+               stream: bool = False,
+               past_layers: Optional[KVLayers] = None,
+               past_table=None,
+               keep_cache: bool = False,
+               deadline: Optional[float] = None,
+               cancel_token: Optional[CancellationToken] = None,
+               thinking_budget: Optional[int] = None,
+               tenant: Optional[str] = None,
+               priority: Optional[str] = None,
+               token_probs: Optional[List[float]] = None,
+               on_token: Optional[Callable[[int], None]] = None,
+               on_done: Optional[Callable[[GenerationRequest], None]] = None) -> GenerationRequest:
+        """
+        Queue a prompt for generation; the returned request completes asynchronously.
+
+        past_layers may hold the KV state (batch of one) for a prefix of input_ids, in which
+        case only the remaining tokens are prefilled. With keep_cache the final KV state of the
+        sequence is left on the request as cache_layers/cache_ids.
+
+        With a paged KV cache, pass past_table (a BlockTable of kv_pool) instead of past_layers;
+        keep_cache leaves the sequence's table on the request as cache_table, for the caller
+        to take_cache_table() and eventually free. Prompts also share the pool's cached blocks of any prefix seen before.
+
+        Raises QueueFullError when max_queue_depth requests are already waiting; requests
+        still queued when their deadline passes are dropped with DeadlineExceeded. Running
+        requests whose deadline passes or whose cancel_token is cancelled stop after the
+        current step with finish_reason "deadline"/"cancelled" and their partial output.
+        With a thinking_budget, the <think> section is closed after that many tokens.
+
+        tenant and priority ("interactive" or "batch") place the request in the fair queue;
+        QueueFullError is also raised when the tenant's own queue cap is reached. The
+        probability of every sampled token is appended to token_probs, if given.
+        """
+        if self.max_queue_depth is not None and self._queue.qsize() >= self.max_queue_depth:
+            self.rejected += 1
+            raise QueueFullError(self.estimated_wait())
+        request = GenerationRequest(input_ids, max_new_tokens=max_new_tokens, temperature=temperature,
+                                    top_p=top_p, top_k=top_k, do_sample=do_sample, stream=stream,
+                                    past_layers=past_layers, past_table=past_table, keep_cache=keep_cache,
+                                    deadline=deadline,
+                                    cancel_token=cancel_token, tenant=tenant, priority=priority,
+                                    token_probs=token_probs, on_token=on_token, on_done=on_done)
+        if thinking_budget is not None:
+            request.reasoning = ReasoningTracker.create(self.tokenizer, input_ids, thinking_budget)
+        # A request's fair-queueing cost is the number of decode steps it may hold a slot for
+        if not self._queue.put(request, tenant, priority, cost=max_new_tokens):
+            self.rejected += 1
+            raise QueueFullError(self.estimated_wait())
+        return request
+
+    def estimated_wait(self) -> float:
+        """Rough seconds a newly queued request waits for a batch slot"""
+        service_time = self.mean_service_time or 1.0
+        waves = (self._queue.qsize() + len(self._active)) / self.max_batch_size
+        return waves * service_time
+
+    def generate(self, input_ids: List[int], timeout: Optional[float] = None, **kwargs) -> List[int]:
+        """Submit a prompt and block until its tokens are ready"""
+        return self.submit(input_ids, **kwargs).result(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch occupancy and throughput counters, with per-tenant queue state"""
+        active = len(self._active)
+        tenants = self._queue.stats()
+        for request in list(self._active):
+            tenant = tenants.setdefault(request.tenant or DEFAULT_TENANT, {})
+            tenant["active"] = tenant.get("active", 0) + 1
+        return {
+            "max_batch_size": self.max_batch_size,
+            "active": active,
+            "queued": self._queue.qsize(),
+            "occupancy": active / self.max_batch_size,
+            "mean_occupancy": (self.occupied_slots / (self.steps * self.max_batch_size)) if self.steps else 0.0,
+            "steps": self.steps,
+            "generated_tokens": self.generated_tokens,
+            "completed": self.completed,
+            "max_queue_depth": self.max_queue_depth,
+            "estimated_wait": round(self.estimated_wait(), 3),
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "cancelled": self.cancelled,
+            "tokens_saved": self.tokens_saved,
+            "preempted": self.preempted,
+            "peak_active": self.peak_active,
+            "kv_bytes": self._kv_bytes(),
+            "peak_kv_bytes": self.peak_kv_bytes,
+            "kv_pool": self.kv_pool.stats() if self.kv_pool is not None else None,
+            "tenants": tenants,
+        }
+
+    def _kv_bytes(self) -> int:
+        """Memory held by the running batch's KV state (used pool blocks with a paged cache)"""
+        if self.kv_pool is not None:
+            stats = self.kv_pool.stats()
+            return stats["used_blocks"] * stats["bytes_per_block"]
+        layers = self._layers
+        return layers_nbytes(layers) if layers else 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._admit()
+                if not self._active:
+                    continue
+                self._decode_step()
+            except Exception as e:
+                # A failed decode step poisons the whole batch; fail it and carry on (prefill
+                # failures only fail the requests being prefilled)
+                for request in self._active:
+                    request._finish("error", e)
+                self._reset_batch()
+
+        for request in self._active:
+            request._finish("cancelled", RuntimeError("Scheduler stopped"))
+        self._reset_batch()
+
+    def _reset_batch(self):
+        for table in self._tables:
+            if table is not None:
+                self.kv_pool.free(table)
+        self._tables = []
+        self._active = []
+        self._layers = None
+        self._cache = None
+        self._mask = None
+        self._next_tokens = None
+
+    def _admit(self):
+        """Move queued requests into free batch slots at a token boundary"""
+        if self.preemption and len(self._active) >= self.max_batch_size:
+            self._preempt()
+        joining = []
+        while len(self._active) + len(joining) < self.max_batch_size:
+            # Only block when there is nothing to decode
+            block = not self._active and not joining
+            request = self._queue.get(timeout=0.1 if block else 0)
+            if request is None:
+                break
+            if request.cancel_token is not None and request.cancel_token.cancelled:
+                self.cancelled += 1
+                self._save_tokens(request)
+                request._finish(CANCELLED)
+                continue
+            if request.deadline is not None and time.time() > request.deadline:
+                self.expired += 1
+                self._save_tokens(request)
+                request._finish("expired", DeadlineExceeded("Request expired while queued"))
+                continue
+            if self.kv_pool is not None and not self._reserve(request, len(self._active) + len(joining)):
+                if self._active or joining:
+                    # Waits at the head of its queue until running sequences give blocks back
+                    self._queue.requeue(request, request.tenant, request.priority, preempted=False)
+                else:
+                    request._finish("error", KVPoolExhausted("Prompt does not fit in the KV cache pool"))
+                break
+            if request.started_at is None:
+                self._queue.charge(request.tenant, len(request.input_ids))
+            joining.append(request)
+        if joining:
+            self._prefill(joining)
+
+    def _reserve(self, request: GenerationRequest, running: int) -> bool:
+        """Give a request a block table covering its context in the KV pool, if there is room"""
+        # A preempted request is re-prefilled with the tokens it had generated so far
+        context = request.input_ids + request.output_ids
+        table = request.past_table if request.past_table is not None else self.kv_pool.match(context)
+        request.past_table = None
+        request.past_layers = None
+        cached = table.length
+        try:
+            self.kv_pool.reserve(table, len(context) - cached)
+            # Leave a block per running sequence to grow into, so admitting does not force preemptions
+            if self.kv_pool.ensure_free(running):
+                request.kv_table = table
+                request.cached_tokens = cached
+                # Index the prompt's full blocks now: requests prefilled in the same pass share
+                # them too, as every layer writes all rows before reading any
+                self.kv_pool.commit(table, context)
+                return True
+        except KVPoolExhausted:
+            pass
+        self.kv_pool.free(table)
+        return False
+
+    def _preempt(self):
+        """Give the slot of a running lower-priority request to a more urgent waiting one"""
+        rank = self._queue.waiting_rank()
+        if rank is None:
+            return
+        candidates = [row for row, r in enumerate(self._active) if r.rank > rank]
+        if not candidates:
+            return
+        # The request with the least output loses the least work: it is re-prefilled later
+        self._requeue(min(candidates, key=lambda row: len(self._active[row].output_ids)))
+
+    def _requeue(self, row: int):
+        """Take a running request out of the batch and put it back at the head of its queue"""
+        request = self._active[row]
+        self._retire([row])
+        request.preemptions += 1
+        request.queued_at = time.time()
+        self.preempted += 1
+        self._queue.requeue(request, request.tenant, request.priority)
+
+    @torch.no_grad()
+    def _prefill(self, joining: List[GenerationRequest]):
+        """Prefill newly admitted requests and merge them into the running batch"""
+        fresh = [r for r in joining if r.past_layers is None]
+        resumed = [r for r in joining if r.past_layers is not None]
+        now = time.time()
+        for request in joining:
+            if request.started_at is None:
+                request.started_at = now
+            request.timings["queue"] = request.timings.get("queue", 0.0) + now - request.queued_at
+        if self.kv_pool is not None:
+            self._prefill_paged(joining)
+            return
+
+        # Fresh prompts share one left-padded forward pass; resumed ones each extend their own cache
+        groups = self._prefill_group(fresh) if fresh else []
+        for request in resumed:
+            groups += self._prefill_group([request])
+        if not groups:
+            return
+
+        parts = [(self._layers, self._mask, self._next_tokens)] if self._active else []
+        parts += [(layers, mask, next_tokens) for _, layers, mask, next_tokens in groups]
+        length = max(mask.shape[-1] for _, mask, _ in parts)
+        self._layers = concat_rows([layers for layers, _, _ in parts]) if len(parts) > 1 else parts[0][0]
+        self._mask = torch.cat([self._left_pad_mask(mask, length) for _, mask, _ in parts])
+        self._next_tokens = torch.cat([next_tokens for _, _, next_tokens in parts])
+        self._cache = None
+
+        first_new_row = len(self._active)
+        for requests, _, _, _ in groups:
+            self._active.extend(requests)
+        self._emit(first_new_row)
+
+    def _prefill_group(self, requests: List[GenerationRequest]):
+        """Prefill requests in one pass; returns [(requests, layers, mask, next_tokens)] for those that succeeded"""
+        started = time.perf_counter()
+        try:
+            if requests[0].past_layers is None:
+                layers, mask, next_tokens = self._prefill_fresh(requests)
+            else:
+                layers, mask, next_tokens = self._prefill_resumed(requests[0])
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0]._finish("error", e)
+                return []
+            # One bad prompt fails the whole pass: prefill each alone so only that one fails
+            return [group for request in requests for group in self._prefill_group([request])]
+        for request in requests:
+            request.timings["prefill"] = request.timings.get("prefill", 0.0) + time.perf_counter() - started
+        return [(requests, layers, mask, next_tokens)]
+
+    def _prefill_fresh(self, requests: List[GenerationRequest]):
+        device = self.model.device
+        # A preempted request is re-prefilled with the tokens it had generated so far
+        contexts = [r.input_ids + r.output_ids for r in requests]
+        length = max(len(context) for context in contexts)
+        input_ids = torch.full((len(requests), length), self.pad_token_id, dtype=torch.long, device=device)
+        mask = torch.zeros((len(requests), length), dtype=torch.long, device=device)
+        for row, context in enumerate(contexts):
+            input_ids[row, length - len(context):] = torch.tensor(context, device=device)
+            mask[row, length - len(context):] = 1
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+
+        outputs = self.model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids, use_cache=True)
+        next_tokens = [sample_next_token(outputs.logits[row, -1], r) for row, r in enumerate(requests)]
+        return cache_to_layers(outputs.past_key_values), mask, torch.tensor(next_tokens, device=device)
+
+    def _prefill_resumed(self, request: GenerationRequest):
+        device = self.model.device
+        past_length = layers_seq_length(request.past_layers)
+        input_ids = torch.tensor([request.input_ids[past_length:]], dtype=torch.long, device=device)
+        mask = torch.ones((1, len(request.input_ids)), dtype=torch.long, device=device)
+        position_ids = torch.arange(past_length, len(request.input_ids), device=device).unsqueeze(0)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=layers_to_cache(request.past_layers),
+            use_cache=True,
+        )
+        request.past_layers = None
+        request.cached_tokens = past_length
+        next_token = sample_next_token(outputs.logits[0, -1], request)
+        return cache_to_layers(outputs.past_key_values), mask, torch.tensor([next_token], device=device)
+
+    def _prefill_paged(self, joining: List[GenerationRequest]):
+        """Prefill the uncached positions of every joining request in one pass over the KV pool"""
+        device = self.model.device
+        started = time.perf_counter()
+        contexts = [r.input_ids + r.output_ids for r in joining]
+        counts = [len(context) - r.cached_tokens for context, r in zip(contexts, joining)]
+        width = max(counts)
+        input_ids = torch.full((len(joining), width), self.pad_token_id, dtype=torch.long, device=device)
+        for row, (context, count) in enumerate(zip(contexts, counts)):
+            input_ids[row, width - count:] = torch.tensor(context[len(context) - count:], device=device)
+        tables = [r.kv_table for r in joining]
+        cache = PagedCache(self.kv_pool, tables)
+        mask = cache.plan(counts)
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)[:, -width:]
+
+        try:
+            outputs = self.model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                                 past_key_values=cache, use_cache=True)
+        except Exception as e:
+            for table in tables:
+                self.kv_pool.free(table)
+            for request in joining:
+                request.kv_table = None
+            if len(joining) == 1:
+                joining[0]._finish("error", e)
+                return
+            # One bad prompt fails the whole pass: prefill each alone so only that one fails
+            for request in joining:
+                if self._reserve(request, len(self._active)):
+                    self._prefill_paged([request])
+                elif self._active:
+                    self._queue.requeue(request, request.tenant, request.priority, preempted=False)
+                else:
+                    request._finish("error", KVPoolExhausted("Prompt does not fit in the KV cache pool"))
+            return
+        next_tokens = [sample_next_token(outputs.logits[row, -1], r) for row, r in enumerate(joining)]
+        for request in joining:
+            request.timings["prefill"] = request.timings.get("prefill", 0.0) + time.perf_counter() - started
+
+        first_new_row = len(self._active)
+        self._active.extend(joining)
+        self._tables.extend(tables)
+        next_tokens = torch.tensor(next_tokens, device=device)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens]) if first_new_row else next_tokens
+        self._observe_memory()
+        self._emit(first_new_row)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """Feed every active sequence its last token and sample the next one"""
+        if self.kv_pool is not None:
+            self._decode_step_paged()
+            return
+        self.steps += 1
+        self.occupied_slots += len(self._active)
+
+        self._mask = torch.cat([self._mask, self._mask.new_ones((self._mask.shape[0], 1))], dim=-1)
+        position_ids = self._mask.sum(-1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=self._mask,
+            position_ids=position_ids,
+            past_key_values=self._batch_cache(),
+            use_cache=True,
+        )
+        # The cache was extended in place; these are references to its tensors, not copies
+        self._layers = cache_to_layers(self._cache)
+        self._next_tokens = torch.tensor(
+            [sample_next_token(outputs.logits[row, -1], r) for row, r in enumerate(self._active)],
+            device=self._mask.device,
+        )
+        self._observe_memory()
+        self._emit(0)
+
+    def _batch_cache(self):
+        if self._cache is None:
+            self._cache = layers_to_cache(self._layers)
+        return self._cache
+
+    def _decode_step_paged(self):
+        # Every sequence needs a slot for the token it feeds; when the pool runs out, the least
+        # urgent sequence with the least output is preempted and re-prefilled later
+        row = 0
+        while row < len(self._active):
+            try:
+                self.kv_pool.reserve(self._tables[row], 1)
+                row += 1
+            except KVPoolExhausted as e:
+                if len(self._active) == 1:
+                    self._active[0]._finish("error", e)
+                    self._retire([0])
+                    return
+                victim = max(range(len(self._active)),
+                             key=lambda r: (self._active[r].rank, -len(self._active[r].output_ids)))
+                self._requeue(victim)
+                if victim < row:
+                    row -= 1
+        self.steps += 1
+        self.occupied_slots += len(self._active)
+
+        cache = PagedCache(self.kv_pool, self._tables)
+        mask = cache.plan([1] * len(self._tables))
+        position_ids = torch.tensor([[table.length - 1] for table in self._tables], device=mask.device)
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        self._next_tokens = torch.tensor(
+            [sample_next_token(outputs.logits[row, -1], r) for row, r in enumerate(self._active)],
+            device=mask.device,
+        )
+        self._observe_memory()
+        self._emit(0)
+
+    def _observe_memory(self):
+        self.peak_active = max(self.peak_active, len(self._active))
+        self.peak_kv_bytes = max(self.peak_kv_bytes, self._kv_bytes())
+
+    def _emit(self, first_row: int):
+        """Record sampled tokens for rows >= first_row and retire finished sequences"""
+        finished = []
+        generated: Dict[Optional[str], int] = {}
+        for row in range(first_row, len(self._active)):
+            request = self._active[row]
+            token_id = int(self._next_tokens[row])
+            if token_id in self.eos_token_ids:
+                self._capture_cache(row, request)
+                request._finish("stop")
+                finished.append(row)
+                continue
+            request._append(token_id)
+            self.generated_tokens += 1
+            generated[request.tenant] = generated.get(request.tenant, 0) + 1
+            if len(request.output_ids) >= request.max_new_tokens:
+                self._capture_cache(row, request)
+                request._finish("length")
+                finished.append(row)
+                continue
+
+            # Checked between steps: the slot is freed now and refilled from the queue next step
+            reason = stop_reason(request.cancel_token, request.deadline)
+            if reason is not None:
+                self.cancelled += 1
+                self._save_tokens(request)
+                request._finish(reason)
+                finished.append(row)
+
+        # Generated tokens count against each tenant's token-rate limit
+        for tenant, tokens in generated.items():
+            self._queue.charge(tenant, tokens)
+        if finished:
+            for row in finished:
+                if not self._active[row].truncated:
+                    self.completed += 1
+                    self._observe_service_time(self._active[row])
+            self._retire(finished)
+
+    def _save_tokens(self, request: GenerationRequest):
+        request.tokens_saved = request.max_new_tokens - len(request.output_ids)
+        self.tokens_saved += request.tokens_saved
+
+    def _observe_service_time(self, request: GenerationRequest):
+        if request.started_at is None:
+            return
+        service_time = time.time() - request.started_at
+        if self.mean_service_time is None:
+            self.mean_service_time = service_time
+        else:
+            self.mean_service_time = 0.9 * self.mean_service_time + 0.1 * service_time
+
+    def _capture_cache(self, row: int, request: GenerationRequest):
+        """Copy a finishing sequence's KV state (without padding) onto the request"""
+        if not request.keep_cache:
+            return
+        if self.kv_pool is not None:
+            # The request takes over the table until the caller takes it (take_cache_table)
+            table = self._tables[row]
+            request.cache_ids = (request.input_ids + request.output_ids)[:table.length]
+            self.kv_pool.commit(table, request.cache_ids)
+            request.cache_table = table
+            request._cache_finalizer = weakref.finalize(request, self.kv_pool.free, table)
+            self._tables[row] = None
+            return
+        real_length = int(self._mask[row].sum())
+        layers = select_rows(self._layers, [row])
+        request.cache_layers = slice_positions(layers, layers_seq_length(layers) - real_length)
+        request.cache_ids = (request.input_ids + request.output_ids)[:real_length]
+
+    def _retire(self, finished: List[int]):
+        """Drop finished rows from the batch and trim padding no remaining row needs"""
+        keep = [row for row in range(len(self._active)) if row not in set(finished)]
+        if self.kv_pool is not None:
+            # Blocks no other sequence or cache shares are free for the next admission at once
+            for row in finished:
+                if self._tables[row] is not None:
+                    self.kv_pool.free(self._tables[row])
+            self._tables = [self._tables[row] for row in keep]
+        if not keep:
+            self._reset_batch()
+            return
+        self._active = [self._active[row] for row in keep]
+        self._next_tokens = self._next_tokens[keep]
+        if self.kv_pool is not None:
+            return
+        self._layers = select_rows(self._layers, keep)
+        self._cache = None
+        self._mask = self._mask[keep]
+
+        # Columns that are padding for every remaining row can be dropped
+        real = self._mask.any(dim=0).nonzero()
+        start = int(real[0]) if len(real) else 0
+        if start > 0:
+            self._layers = slice_positions(self._layers, start)
+            self._mask = self._mask[:, start:]
+
+    @staticmethod
+    def _left_pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+        pad = length - mask.shape[-1]
+        if pad <= 0:
+            return mask
+        return torch.cat([mask.new_zeros((mask.shape[0], pad)), mask], dim=-1)
@@ -0,0 +1,852 @@
+# DeepSeek Serving Benchmarks
+# Micro-benchmarks for the serving optimisations. Every benchmark runs offline against a tiny
+# randomly initialised model (created on the fly) unless --model points at a real checkpoint.
+
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from deepseek_cache import VectorIndex, hashed_ngram_vector
+from deepseek_context import ContextManager, ModelLock, model_summarizer
+from deepseek_kv import PrefixCache
+from deepseek_metrics import percentile
+from deepseek_prompts import ChatPromptBuilder, encode_chat
+import deepseek_server
+
+# Vendor questions in every supported language
+SAMPLE_PROMPTS = {
+    "english": [
+        "What is today's onion price?",
+        "How do I register as a supplier?",
+        "Which suppliers near Dadar deliver tomatoes today?",
+    ],
+    "hindi": [
+        "आज प्याज का भाव क्या है?",
+        "मैं सप्लायर के रूप में कैसे रजिस्टर करूँ?",
+        "मेरा ऑर्डर कहाँ है?",
+    ],
+    "marathi": [
+        "आज कांद्याचा भाव काय आहे?",
+        "मी पुरवठादार म्हणून नोंदणी कशी करू?",
+        "माझी ऑर्डर कुठे आहे?",
+    ],
+    "gujarati": [
+        "આજે ડુંગળીનો ભાવ શું છે?",
+        "હું સપ્લાયર તરીકે કેવી રીતે નોંધણી કરું?",
+        "મારો ઓર્ડર ક્યાં છે?",
+    ],
+}
+
+
+def benchmark_model_path(args):
+    """--model, or a tiny random model built in the run's scratch directory"""
+    if args.model is not None:
+        return args.model
+    from deepseek_tiny_model import create_tiny_model
+    return create_tiny_model(tempfile.mkdtemp(prefix="deepseek-tiny-", dir=args.scratch),
+                             hidden_size=args.hidden_size, num_layers=args.layers)
+
+
+def load_benchmark_model(args):
+    """Load --model, or build a tiny random model in the run's scratch directory"""
+    model_path = benchmark_model_path(args)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True)
+    model.eval()
+    return tokenizer, model
+
+
+def median_ms(fn, repeats):
+    """Median wall time of fn() in milliseconds after one warm-up call"""
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def bench_prefix_cache(args):
+    """Prefill latency and compute with and without the per-language system-prompt KV prefix"""
+    tokenizer, model = load_benchmark_model(args)
+    deepseek_server.tokenizer, deepseek_server.model = tokenizer, model
+    n_params = sum(p.numel() for p in model.parameters())
+
+    cache = PrefixCache(model)
+    results = []
+    for language, prompts in SAMPLE_PROMPTS.items():
+        cache.add(language, deepseek_server.system_prefix_ids(language))
+        for prompt in prompts:
+            input_ids = tokenizer.apply_chat_template(
+                [
+                    {"role": "system", "content": deepseek_server.get_system_prompt(language)},
+                    {"role": "user", "content": prompt},
+                ],
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True
+            )["input_ids"]
+            full = torch.tensor([input_ids])
+
+            def prefill_full():
+                with torch.no_grad():
+                    model(input_ids=full, use_cache=True)
+
+            def prefill_cached():
+                past_key_values, prefix_length = cache.lookup(language, input_ids)
+                with torch.no_grad():
+                    model(input_ids=full[:, prefix_length:], past_key_values=past_key_values, use_cache=True)
+
+            _, prefix_length = cache.lookup(language, input_ids)
+            full_ms = median_ms(prefill_full, args.repeats)
+            cached_ms = median_ms(prefill_cached, args.repeats)
+            results.append({
+                "language": language,
+                "prompt_tokens": len(input_ids),
+                "cached_tokens": prefix_length,
+                "prefill_tokens": len(input_ids) - prefix_length,
+                "full_prefill_ms": round(full_ms, 3),
+                "cached_prefill_ms": round(cached_ms, 3),
+                "speedup": round(full_ms / cached_ms, 2) if cached_ms else None,
+                # Dense forward cost is ~2 FLOPs per parameter per token (attention excluded)
+                "gflops_saved": round(2 * n_params * prefix_length / 1e9, 4),
+            })
+
+    print(f"{'language':<10} {'prompt':>6} {'cached':>6} {'full ms':>9} {'cached ms':>9} {'speedup':>8} {'GFLOPs saved':>12}")
+    for language in SAMPLE_PROMPTS:
+        rows = [r for r in results if r["language"] == language]
+        print(f"{language:<10} "
+              f"{statistics.mean(r['prompt_tokens'] for r in rows):>6.0f} "
+              f"{statistics.mean(r['cached_tokens'] for r in rows):>6.0f} "
+              f"{statistics.mean(r['full_prefill_ms'] for r in rows):>9.3f} "
+              f"{statistics.mean(r['cached_prefill_ms'] for r in rows):>9.3f} "
+              f"{statistics.mean(r['speedup'] for r in rows):>7.2f}x "
+              f"{statistics.mean(r['gflops_saved'] for r in rows):>12.4f}")
+    return {"benchmark": "prefix-cache", "parameters": n_params, "results": results}
+
+
+def bench_semantic_cache(args):
+    """Insert and lookup latency of the semantic cache's vector index at --entries rows"""
+    rng = random.Random(0)
+    products = ["onion", "tomato", "potato", "garlic", "ginger", "chilli", "coriander", "paneer", "oil", "rice"]
+    areas = ["dadar", "thane", "andheri", "borivali", "kurla", "vashi", "pune", "surat", "nashik", "ahmedabad"]
+    templates = ["price of {p} in {a} for {n} kg", "{p} rate {a} order {n}", "who sells {p} near {a} batch {n}"]
+
+    def message(n):
+        return rng.choice(templates).format(p=rng.choice(products), a=rng.choice(areas), n=n)
+
+    dim = args.dim
+    index = VectorIndex(dim, capacity=args.entries)
+    vectors = np.stack([hashed_ngram_vector(message(n), dim) for n in range(args.entries)])
+
+    started = time.perf_counter()
+    for n, vector in enumerate(vectors):
+        index.add(vector, n, group=n % 4)
+    insert_us = (time.perf_counter() - started) / args.entries * 1e6
+
+    # Half the queries repeat an indexed message, half are unseen
+    queries = []
+    for i in range(args.queries):
+        if i % 2 == 0:
+            n = rng.randrange(args.entries)
+            queries.append((vectors[n], n % 4))
+        else:
+            queries.append((hashed_ngram_vector(message(10 ** 9 + i), dim), i % 4))
+    # Each kind of measurement runs in its own loop so they do not evict each other's caches
+    search_ms, brute_ms, embed_ms, hits = [], [], [], 0
+    for vector, group in queries:
+        start = time.perf_counter()
+        row, _ = index.search(vector, group=group, threshold=args.threshold)
+        search_ms.append((time.perf_counter() - start) * 1000)
+        hits += row is not None
+
+    for vector, _ in queries:
+        start = time.perf_counter()
+        int(np.argmax(vectors @ vector))
+        brute_ms.append((time.perf_counter() - start) * 1000)
+
+    for i in range(len(queries)):
+        text = message(i)
+        start = time.perf_counter()
+        hashed_ngram_vector(text, dim)
+        embed_ms.append((time.perf_counter() - start) * 1000)
+
+    result = {
+        "benchmark": "semantic-cache",
+        "entries": len(index),
+        "dim": dim,
+        "threshold": args.threshold,
+        "insert_us": round(insert_us, 2),
+        "search_p50_ms": round(percentile(search_ms, 50), 4),
+        "search_p99_ms": round(percentile(search_ms, 99), 4),
+        "brute_force_p50_ms": round(percentile(brute_ms, 50), 4),
+        "embed_p50_ms": round(percentile(embed_ms, 50), 4),
+        "hit_rate": hits / len(queries),
+    }
+    for key, value in result.items():
+        print(f"{key:<20} {value}")
+    return result
+
+
+def bench_worker_pool(args):
+    """Decode throughput and memory of the CPU worker pool for 1..--max-workers processes"""
+    from deepseek_checkpoint import ensure_prepared
+    from deepseek_workers import WorkerPool
+
+    model_path = benchmark_model_path(args)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    prompts = [
+        tokenizer.apply_chat_template([{"role": "user", "content": prompt}], add_generation_prompt=True,
+                                      tokenize=True, return_dict=True)["input_ids"]
+        for prompts in SAMPLE_PROMPTS.values() for prompt in prompts
+    ]
+    # Prepared once in scratch and mapped by every pool size
+    checkpoint_path = ensure_prepared(model_path, "float32", args.scratch)
+
+    results = []
+    for num_workers in range(1, args.max_workers + 1):
+        pool = WorkerPool(model_path, num_workers, max_batch_size=args.batch_size,
+                          checkpoint_path=checkpoint_path).start()
+        try:
+            pool.generate(prompts[0], max_new_tokens=4, do_sample=False)
+            started = time.perf_counter()
+            requests = [pool.submit(prompts[i % len(prompts)], max_new_tokens=args.max_new_tokens, do_sample=False)
+                        for i in range(args.requests)]
+            tokens = sum(len(request.result()) for request in requests)
+            elapsed = time.perf_counter() - started
+            workers = pool.stats()["workers"]
+        finally:
+            pool.stop()
+        results.append({
+            "workers": num_workers,
+            "tokens": tokens,
+            "seconds": round(elapsed, 3),
+            "tokens_per_second": round(tokens / elapsed, 1),
+            "total_rss_mb": round(sum(w["rss"] for w in workers) / 2 ** 20, 1),
+            "total_pss_mb": round(sum(w["pss"] for w in workers) / 2 ** 20, 1),
+        })
+
+    weights_mb = sum(os.path.getsize(path) for path in glob.glob(os.path.join(checkpoint_path, "*.safetensors"))) \
+        / 2 ** 20
+    print(f"shared checkpoint: {weights_mb:.1f} MB")
+    print(f"{'workers':>7} {'tok/s':>9} {'RSS MB':>9} {'PSS MB':>9}")
+    for r in results:
+        print(f"{r['workers']:>7} {r['tokens_per_second']:>9.1f} {r['total_rss_mb']:>9.1f} {r['total_pss_mb']:>9.1f}")
+    return {"benchmark": "worker-pool", "cpus": len(os.sched_getaffinity(0)),
+            "weights_mb": round(weights_mb, 1), "results": results}
+
+
+# Run in a fresh interpreter: load a model, generate one token, report timings and peak RSS
+COLD_START_CHILD = """
+import json, resource, sys, time
+started = time.perf_counter()
+import torch
+from transformers import AutoTokenizer
+import deepseek_checkpoint
+imported = time.perf_counter()
+path, mode, dtype = sys.argv[1:4]
+tokenizer = AutoTokenizer.from_pretrained(path)
+if mode == "prepared":
+    model = deepseek_checkpoint.load_model(path)
+else:
+    model = deepseek_checkpoint.load_model(path, torch_dtype=getattr(torch, dtype))
+loaded = time.perf_counter()
+model.generate(torch.tensor([[1, 2, 3]]), max_new_tokens=1, do_sample=False)
+ready = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - started,
+    "load_s": loaded - imported,
+    "time_to_ready_s": ready - started,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+COLD_START_MODULES = ["deepseek_web_app", "deepseek_async_app", "deepseek_server", "deepseek_advanced",
+                      "deepseek_demo"]
+
+
+def run_python(code, *argv):
+    """Run code in a fresh interpreter from the repository directory and parse its last output line"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, "-c", code, *argv], cwd=here, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_cold_start(args):
+    """Import time of each entry point, and time-to-ready/peak RSS of hub-style vs prepared loading"""
+    from deepseek_checkpoint import prepare_checkpoint
+
+    imports = {}
+    for module in ["torch, transformers"] + COLD_START_MODULES:
+        code = f"import json, time; t = time.perf_counter(); import {module}; " \
+               f"print(json.dumps(time.perf_counter() - t))"
+        imports[module] = round(statistics.median(run_python(code) for _ in range(3)), 3)
+
+    model_path = benchmark_model_path(args)
+    prepared_dir = tempfile.mkdtemp(prefix="deepseek-prepared-", dir=args.scratch)
+    prepared_path = prepare_checkpoint(model_path, prepared_dir, args.dtype)
+    loads = {}
+    for mode, path in (("from_pretrained", model_path), ("prepared", prepared_path)):
+        runs = [run_python(COLD_START_CHILD, path, mode, args.dtype) for _ in range(args.repeats)]
+        loads[mode] = {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}
+
+    print(f"{'import':<22} {'seconds':>8}")
+    for module, seconds in imports.items():
+        print(f"{module:<22} {seconds:>8.3f}")
+    print(f"\n{'load path':<16} {'import s':>9} {'load s':>8} {'ready s':>8} {'peak RSS MB':>12}")
+    for mode, r in loads.items():
+        print(f"{mode:<16} {r['import_s']:>9.3f} {r['load_s']:>8.3f} {r['time_to_ready_s']:>8.3f} {r['peak_rss_mb']:>12.1f}")
+    return {"benchmark": "cold-start", "dtype": args.dtype, "import_seconds": imports, "load": loads}
+
+
+def bench_cpu_int8(args):
+    """Memory, decode speed and output drift of the int8 dynamic-quantised model against fp32"""
+    from deepseek_quant import load_int8_model, model_nbytes, quantized_cache_path
+
+    tokenizer, fp32_model = load_benchmark_model(args)
+    model_path = fp32_model.name_or_path
+    cache_dir = tempfile.mkdtemp(prefix="deepseek-int8-", dir=args.scratch)
+
+    started = time.perf_counter()
+    int8_model = load_int8_model(model_path, cache_dir)
+    quantize_s = time.perf_counter() - started
+    started = time.perf_counter()
+    int8_model = load_int8_model(model_path, cache_dir)
+    cached_load_s = time.perf_counter() - started
+
+    prompts = [
+        tokenizer.apply_chat_template([{"role": "user", "content": prompt}], add_generation_prompt=True,
+                                      tokenize=True, return_dict=True, return_tensors="pt")["input_ids"]
+        for prompts in SAMPLE_PROMPTS.values() for prompt in prompts
+    ]
+
+    def decode(model):
+        outputs, elapsed, tokens = [], 0.0, 0
+        with torch.no_grad():
+            for input_ids in prompts:
+                start = time.perf_counter()
+                output = model.generate(input_ids, max_new_tokens=args.max_new_tokens, do_sample=False,
+                                        pad_token_id=tokenizer.eos_token_id)
+                elapsed += time.perf_counter() - start
+                outputs.append(output[0, input_ids.shape[-1]:].tolist())
+                tokens += len(outputs[-1])
+        return outputs, tokens / elapsed
+
+    fp32_outputs, fp32_tps = decode(fp32_model)
+    int8_outputs, int8_tps = decode(int8_model)
+
+    # Teacher-forced drift: both models score the fp32 continuation token by token
+    top1_agree, kl, positions = 0, 0.0, 0
+    with torch.no_grad():
+        for input_ids, continuation in zip(prompts, fp32_outputs):
+            sequence = torch.cat([input_ids, torch.tensor([continuation], dtype=input_ids.dtype)], dim=-1)
+            ref = torch.log_softmax(fp32_model(sequence).logits[0].float(), dim=-1)
+            quant = torch.log_softmax(int8_model(sequence).logits[0].float(), dim=-1)
+            top1_agree += int((ref.argmax(-1) == quant.argmax(-1)).sum())
+            kl += float((ref.exp() * (ref - quant)).sum())
+            positions += ref.shape[0]
+
+    def matching_prefix(a, b):
+        return next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+
+    result = {
+        "benchmark": "cpu-int8",
+        "prompts": len(prompts),
+        "fp32_mb": round(model_nbytes(fp32_model) / 2 ** 20, 2),
+        "int8_mb": round(model_nbytes(int8_model) / 2 ** 20, 2),
+        "cache_file_mb": round(os.path.getsize(quantized_cache_path(model_path, cache_dir)) / 2 ** 20, 2),
+        "quantize_s": round(quantize_s, 3),
+        "cached_load_s": round(cached_load_s, 3),
+        "fp32_tokens_per_second": round(fp32_tps, 1),
+        "int8_tokens_per_second": round(int8_tps, 1),
+        "speedup": round(int8_tps / fp32_tps, 2),
+        "identical_outputs": sum(a == b for a, b in zip(fp32_outputs, int8_outputs)),
+        "mean_matching_prefix": round(statistics.mean(
+            matching_prefix(a, b) for a, b in zip(fp32_outputs, int8_outputs)), 2),
+        "top1_agreement": round(top1_agree / positions, 4),
+        "mean_kl": round(kl / positions, 5),
+    }
+    for key, value in result.items():
+        print(f"{key:<24} {value}")
+    return result
+
+
+def shallow_draft(model, num_layers, scratch):
+    """Save a draft that keeps only the first num_layers decoder layers of model (same tokenizer)"""
+    output_dir = tempfile.mkdtemp(prefix="deepseek-draft-", dir=scratch)
+    draft = AutoModelForCausalLM.from_pretrained(model.name_or_path, trust_remote_code=True)
+    draft.model.layers = draft.model.layers[:num_layers]
+    draft.config.num_hidden_layers = num_layers
+    draft.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model.name_or_path, trust_remote_code=True).save_pretrained(output_dir)
+    return output_dir
+
+
+def bench_speculative(args):
+    """Greedy decode speed with and without a draft model, plus the draft's acceptance rate"""
+    from deepseek_speculative import speculative_generate
+
+    tokenizer, model = load_benchmark_model(args)
+    draft_path = args.draft_model or shallow_draft(model, args.draft_layers, args.scratch)
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_path, trust_remote_code=True).eval()
+
+    prompts = [
+        tokenizer.apply_chat_template([{"role": "user", "content": prompt}], add_generation_prompt=True,
+                                      tokenize=True, return_dict=True, return_tensors="pt")["input_ids"]
+        for prompts in SAMPLE_PROMPTS.values() for prompt in prompts
+    ]
+
+    def baseline(input_ids):
+        with torch.no_grad():
+            return model.generate(input_ids, max_new_tokens=args.max_new_tokens, do_sample=False,
+                                  pad_token_id=tokenizer.eos_token_id)
+
+    def speculative(input_ids):
+        return speculative_generate(model, draft_model, input_ids, max_new_tokens=args.max_new_tokens,
+                                    lookahead=args.lookahead, eos_token_id=tokenizer.eos_token_id)
+
+    baseline(prompts[0])
+    speculative(prompts[0])
+    baseline_s, speculative_s, tokens, identical = 0.0, 0.0, 0, 0
+    proposed, accepted, passes = 0, 0, 0
+    for input_ids in prompts:
+        start = time.perf_counter()
+        expected = baseline(input_ids)
+        baseline_s += time.perf_counter() - start
+        start = time.perf_counter()
+        output, stats = speculative(input_ids)
+        speculative_s += time.perf_counter() - start
+
+        identical += int(torch.equal(output, expected))
+        tokens += stats["new_tokens"]
+        proposed += stats["draft_tokens"]
+        accepted += stats["accepted_tokens"]
+        passes += stats["target_passes"]
+
+    result = {
+        "benchmark": "speculative",
+        "prompts": len(prompts),
+        "draft_model": args.draft_model or f"first {args.draft_layers} layer(s) of the main model",
+        "lookahead": args.lookahead,
+        "identical_outputs": identical,
+        "acceptance_rate": round(accepted / proposed, 4) if proposed else 0.0,
+        "tokens_per_main_pass": round(tokens / passes, 2),
+        "baseline_tokens_per_second": round(tokens / baseline_s, 1),
+        "speculative_tokens_per_second": round(tokens / speculative_s, 1),
+        "speedup": round(baseline_s / speculative_s, 2),
+    }
+    for key, value in result.items():
+        print(f"{key:<30} {value}")
+    return result
+
+
+def bench_templates(args):
+    """Per-request prompt assembly time: apply_chat_template vs cached template fragments"""
+    tokenizer = AutoTokenizer.from_pretrained(benchmark_model_path(args), trust_remote_code=True)
+    builder = ChatPromptBuilder(tokenizer)
+    results, mismatches = [], 0
+    for language, prompts in SAMPLE_PROMPTS.items():
+        system = {"role": "system", "content": deepseek_server.get_system_prompt(language)}
+        for turns in (0, args.turns):
+            # A session turn carries the earlier exchanges of the conversation
+            history = []
+            for turn in range(turns):
+                history += [{"role": "user", "content": prompts[turn % len(prompts)]},
+                            {"role": "assistant", "content": prompts[(turn + 1) % len(prompts)]}]
+            for prompt in prompts:
+                messages = [system] + history + [{"role": "user", "content": prompt}]
+                mismatches += builder.encode(messages) != builder.render(messages)
+                template_ms = median_ms(lambda: builder.render(messages), args.repeats)
+                cached_ms = median_ms(lambda: builder.encode(messages), args.repeats)
+                results.append({
+                    "language": language,
+                    "history_turns": turns,
+                    "prompt_tokens": len(builder.encode(messages)),
+                    "template_us": round(template_ms * 1000, 1),
+                    "cached_us": round(cached_ms * 1000, 1),
+                })
+
+    print(f"{'language':<10} {'turns':>5} {'tokens':>6} {'template us':>11} {'cached us':>9} {'speedup':>8}")
+    for language in SAMPLE_PROMPTS:
+        for turns in (0, args.turns):
+            rows = [r for r in results if r["language"] == language and r["history_turns"] == turns]
+            template_us = statistics.mean(r["template_us"] for r in rows)
+            cached_us = statistics.mean(r["cached_us"] for r in rows)
+            print(f"{language:<10} {turns:>5} {statistics.mean(r['prompt_tokens'] for r in rows):>6.0f} "
+                  f"{template_us:>11.1f} {cached_us:>9.1f} {template_us / cached_us:>7.2f}x")
+
+    saved_us = statistics.mean(r["template_us"] - r["cached_us"] for r in results)
+    # CPU time the serving process gets back every second at the given request rate
+    saved_ms_per_second = saved_us * args.qps / 1000
+    print(f"identical to apply_chat_template: {mismatches == 0} ({len(results) - mismatches}/{len(results)})")
+    print(f"saved per request: {saved_us:.1f} us; at {args.qps} requests/s: {saved_ms_per_second:.1f} ms CPU "
+          f"per second ({saved_ms_per_second / 10:.2f}% of a core)")
+    return {"benchmark": "templates", "identical": mismatches == 0, "qps": args.qps,
+            "saved_us_per_request": round(saved_us, 1), "saved_cpu_ms_per_second": round(saved_ms_per_second, 2),
+            "builder": builder.stats(), "results": results}
+
+
+def bench_context(args):
+    """Per-turn prompt tokens and latency over a long conversation: full history vs a context budget"""
+    tokenizer, model = load_benchmark_model(args)
+    limit = model.config.max_position_embeddings - args.max_new_tokens
+    # One model serves turns and summaries; summaries only run between turns, as in the daemon
+    model_lock = ModelLock()
+
+    def generate_ids(prompt_ids, max_new_tokens):
+        input_ids = torch.tensor([prompt_ids])
+        with torch.no_grad():
+            outputs = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                     max_new_tokens=max_new_tokens, do_sample=False)
+        return outputs[0][len(prompt_ids):].tolist()
+
+    def timed_turn(messages):
+        prompt_ids = encode_chat(tokenizer, messages)
+        if len(prompt_ids) > limit:
+            return len(prompt_ids), None
+        start = time.perf_counter()
+        generate_ids(prompt_ids, args.max_new_tokens)
+        return len(prompt_ids), (time.perf_counter() - start) * 1000
+
+    def summary_ids(prompt_ids, max_new_tokens):
+        with model_lock.background():
+            return generate_ids(prompt_ids, max_new_tokens)
+
+    context = ContextManager(tokenizer, args.context_tokens, summarize=model_summarizer(tokenizer, summary_ids))
+    system = {"role": "system", "content": deepseek_server.get_system_prompt("english")}
+    prompts = SAMPLE_PROMPTS["english"]
+    history, results = [], []
+    timed_turn([system, {"role": "user", "content": prompts[0]}])
+    for turn in range(args.conversation_turns):
+        messages = [system] + history + [{"role": "user", "content": f"{prompts[turn % len(prompts)]} ({turn + 1})"}]
+        with model_lock.foreground():
+            full_tokens, full_ms = timed_turn(messages)
+            start = time.perf_counter()
+            compaction = context.fit(messages, conversation="benchmark")
+            fit_ms = (time.perf_counter() - start) * 1000
+            compacted_tokens, compacted_ms = timed_turn(compaction.messages)
+        results.append({
+            "turn": turn + 1,
+            "full_tokens": full_tokens,
+            "full_ms": round(full_ms, 2) if full_ms is not None else None,
+            "compacted_tokens": compacted_tokens,
+            "compacted_ms": round(compacted_ms + fit_ms, 2),
+            "fit_ms": round(fit_ms, 3),
+            "dropped_messages": compaction.dropped,
+            "summarized_messages": compaction.summarized,
+        })
+        history = messages[1:] + [{"role": "assistant",
+                                   "content": f"Onions are {20 + turn % 7} rupees a kilo at the Dadar market today."}]
+        # The user reads the answer before the next turn; summaries are written meanwhile
+        context.wait()
+    context.wait()
+
+    print(f"{'turn':>4} {'full tokens':>11} {'full ms':>8} {'budget tokens':>13} {'budget ms':>9} {'dropped':>7} {'summarised':>10}")
+    for r in results:
+        if r["turn"] == 1 or r["turn"] % 5 == 0:
+            full_ms = f"{r['full_ms']:.2f}" if r["full_ms"] is not None else "too long"
+            print(f"{r['turn']:>4} {r['full_tokens']:>11} {full_ms:>8} {r['compacted_tokens']:>13} "
+                  f"{r['compacted_ms']:>9.2f} {r['dropped_messages']:>7} {r['summarized_messages']:>10}")
+
+    # Latency growth: the last ten turns against the first ten (full history: the last ten that fit the model)
+    window = min(10, len(results) // 2)
+    growth = {}
+    for key in ("full_ms", "compacted_ms"):
+        measured = [r[key] for r in results if r[key] is not None]
+        growth[key] = round(statistics.mean(measured[-window:]) / statistics.mean(measured[:window]), 2)
+    too_long = next((r["turn"] for r in results if r["full_ms"] is None), None)
+    print(f"latency, last {window} turns / first {window}: full history {growth['full_ms']}x"
+          + (f" (longer than the model's context from turn {too_long})" if too_long else "")
+          + f", budget of {args.context_tokens} tokens {growth['compacted_ms']}x")
+    print(f"context manager: {context.stats()}")
+    return {"benchmark": "context", "context_tokens": args.context_tokens, "latency_growth": growth,
+            "context": context.stats(), "results": results}
+
+
+def bench_kv(args):
+    """Concurrent sequences that fit a KV memory budget: padded per-batch caches vs the paged block pool"""
+    from deepseek_batching import ContinuousBatchingScheduler
+    from deepseek_paged import KVBlockPool
+
+    tokenizer, model = load_benchmark_model(args)
+    budget = int(args.kv_budget_mb * 2**20)
+    # Vendors in one language share the system prompt; their questions differ in length
+    prompts = []
+    for i in range(args.requests):
+        language = list(SAMPLE_PROMPTS)[i % len(SAMPLE_PROMPTS)]
+        question = SAMPLE_PROMPTS[language][i % 3] + " " + "?" * (i % 7)
+        prompts.append(encode_chat(tokenizer, [
+            {"role": "system", "content": deepseek_server.get_system_prompt(language)},
+            {"role": "user", "content": question},
+        ]))
+
+    def run(max_batch_size, kv_pool=None):
+        scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=max_batch_size,
+                                                kv_pool=kv_pool).start()
+        start = time.perf_counter()
+        try:
+            requests = [scheduler.submit(ids, max_new_tokens=args.max_new_tokens, do_sample=False)
+                        for ids in prompts]
+            outputs = [request.result() for request in requests]
+        finally:
+            scheduler.stop()
+        elapsed = time.perf_counter() - start
+        return outputs, scheduler.stats(), sum(len(o) for o in outputs) / elapsed
+
+    # Default cache: the largest batch whose peak KV memory stays within the budget
+    default = None
+    max_batch_size = 1
+    while max_batch_size <= args.requests:
+        outputs, stats, tokens_per_s = run(max_batch_size)
+        if stats["peak_kv_bytes"] > budget:
+            break
+        default = {"max_batch_size": max_batch_size, "peak_active": stats["peak_active"],
+                   "peak_kv_bytes": stats["peak_kv_bytes"], "tokens_per_s": round(tokens_per_s, 1)}
+        reference = outputs
+        max_batch_size *= 2
+    if default is None:
+        print(f"A single sequence does not fit {args.kv_budget_mb} MB with the default cache")
+        return {"benchmark": "kv", "budget_bytes": budget, "default": None, "paged": None}
+
+    # Paged cache: the pool holds the whole budget and admission decides how many sequences run
+    pool = KVBlockPool.for_model(model, budget, block_size=args.kv_block_size)
+    outputs, stats, tokens_per_s = run(args.requests, kv_pool=pool)
+    paged = {"max_batch_size": args.requests, "peak_active": stats["peak_active"],
+             "peak_kv_bytes": stats["peak_kv_bytes"], "tokens_per_s": round(tokens_per_s, 1),
+             "preempted": stats["preempted"], "identical_output": outputs == reference,
+             "kv_pool": stats["kv_pool"]}
+
+    print(f"KV budget {args.kv_budget_mb} MB, {args.requests} requests of {args.max_new_tokens} tokens")
+    print(f"{'cache':<8} {'concurrent':>10} {'peak KV KB':>10} {'tokens/s':>9}")
+    for name, result in (("default", default), ("paged", paged)):
+        print(f"{name:<8} {result['peak_active']:>10} {result['peak_kv_bytes'] / 1024:>10.0f} "
+              f"{result['tokens_per_s']:>9.1f}")
+    pool_stats = stats["kv_pool"]
+    print(f"concurrency: {paged['peak_active'] / default['peak_active']:.2f}x, "
+          f"peak pool utilisation {pool_stats['peak_used_blocks'] / pool_stats['blocks']:.0%}, "
+          f"prefix hit tokens {pool_stats['prefix_hit_tokens']}, copy-on-write {pool_stats['cow_copies']}, "
+          f"preempted {paged['preempted']}, identical output {paged['identical_output']}")
+    return {"benchmark": "kv", "budget_bytes": budget, "default": default, "paged": paged}
+
+
+def bench_routing(args):
+    """Traffic share, latency and escalations of a small tier in front of the full model"""
+    from deepseek_batching import ContinuousBatchingScheduler
+    from deepseek_routing import TierPolicy, TierRouter
+    from deepseek_tiny_model import create_tiny_model
+
+    tokenizer, model = load_benchmark_model(args)
+    if args.small_model is None:
+        args.small_model = create_tiny_model(tempfile.mkdtemp(prefix="deepseek-tiny-", dir=args.scratch),
+                                             hidden_size=max(16, args.hidden_size // 4), num_layers=1, seed=1)
+    small_tokenizer = AutoTokenizer.from_pretrained(args.small_model, trust_remote_code=True)
+    small_model = AutoModelForCausalLM.from_pretrained(args.small_model, trust_remote_code=True).eval()
+    schedulers = [ContinuousBatchingScheduler(small_model, small_tokenizer, max_batch_size=args.batch_size * 2).start(),
+                  ContinuousBatchingScheduler(model, tokenizer, max_batch_size=args.batch_size).start()]
+    tokenizers = [small_tokenizer, tokenizer]
+
+    # Greetings and lookups, then questions that need reasoning, in every language
+    messages = [("hi", "english"), ("what are your hours", "english"), ("नमस्ते", "hindi")]
+    messages += [(prompt, language) for language, prompts in SAMPLE_PROMPTS.items() for prompt in prompts]
+    messages += [("Explain why onion prices rise in the monsoon and how I should plan my stock", "english"),
+                 ("I buy 40 kg at 25 rupees and sell at 32, what is my profit", "english"),
+                 ("प्याज के दाम मानसून में क्यों बढ़ते हैं?", "hindi")]
+    workload = [messages[i % len(messages)] for i in range(args.requests)]
+
+    def submit_to(index, message, language, on_token, on_done, cancel_token, token_probs):
+        input_ids = encode_chat(tokenizers[index], [
+            {"role": "system", "content": deepseek_server.get_system_prompt(language)},
+            {"role": "user", "content": message},
+        ])
+        return schedulers[index].submit(input_ids, max_new_tokens=args.max_new_tokens, do_sample=False,
+                                        cancel_token=cancel_token, token_probs=token_probs,
+                                        on_token=on_token, on_done=on_done)
+
+    results = {}
+    for name, min_confidence in (("full only", None), ("routed", 0.0), ("routed+escalation", args.min_confidence)):
+        tiers = [] if min_confidence is None else \
+            [TierPolicy("small", args.small_model, max_words=10, min_confidence=min_confidence)]
+        router = TierRouter(tiers, probe_tokens=args.probe_tokens)
+        offset = 1 - len(tiers)
+        latencies = []
+        for message, language in workload:
+            started = time.perf_counter()
+            generation = router.submit(message, language, lambda index, *callbacks:
+                                       submit_to(index + offset, message, language, *callbacks))
+            generation.result()
+            latencies.append((time.perf_counter() - started) * 1000)
+        stats = router.stats()
+        results[name] = {"p50_ms": round(percentile(latencies, 50), 2), "p95_ms": round(percentile(latencies, 95), 2),
+                         "mean_ms": round(statistics.mean(latencies), 2), "routing": stats}
+    for scheduler in schedulers:
+        scheduler.stop()
+
+    print(f"{len(workload)} requests, {args.max_new_tokens} tokens each; small tier: {args.small_model}")
+    print(f"{'run':<18} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8}   per tier (share, p50 ms, escalated)")
+    for name, result in results.items():
+        tiers = ", ".join(f"{t['name']} {t['share']:.0%} {t['p50_seconds'] * 1000:.1f} {t['escalated']}"
+                          for t in result["routing"]["tiers"] if t["routed"] or t["served"])
+        print(f"{name:<18} {result['mean_ms']:>8.2f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f}   {tiers}")
+    small = results["routed"]["routing"]["tiers"][0]
+    print(f"routing reasons: {results['routed']['routing']['reasons']}, "
+          f"small tier mean confidence {small['mean_confidence']}")
+    return {"benchmark": "routing", "small_model": args.small_model, "results": results}
+
+
+def bench_lookup(args):
+    """Hit rate and latency of the lookup fast path, and end-to-end time with and without it"""
+    from deepseek_lookup import LookupFastPath
+
+    # generate_response serves the model through the registry, so it loads the benchmark model
+    deepseek_server.MODEL_NAME = benchmark_model_path(args)
+    deepseek_server.response_cache = None
+    deepseek_server.load_model()
+    deepseek_server.GENERATION_PARAMS = {"max_new_tokens": args.max_new_tokens, "do_sample": False}
+
+    # The sample products and areas in every language, padded with numbered products
+    products = [
+        {"id": "onion", "name": {"english": "Onion", "hindi": "प्याज", "marathi": "कांदा", "gujarati": "ડુંગળી"},
+         "aliases": ["कांद्या"], "price": 32, "unit": "kg"},
+        {"id": "tomato", "name": {"english": "Tomato", "hindi": "टमाटर", "marathi": "टोमॅटो", "gujarati": "ટામેટા"},
+         "aliases": ["tomatoes"], "price": 24, "unit": "kg"},
+    ]
+    products += [{"id": f"item{n}", "name": f"item{n}", "price": 10 + n % 90, "unit": "kg"}
+                 for n in range(args.catalogue_size)]
+    areas = ["Dadar", "Thane", "Andheri", "Borivali", "Kurla", "Vashi", "Pune", "Surat", "Nashik", "Ahmedabad"]
+    catalogue = {
+        "products": products,
+        "suppliers": [{"name": f"Supplier {n}", "area": areas[n % len(areas)],
+                       "products": [products[n % len(products)]["id"], "tomato"]} for n in range(args.catalogue_size)],
+        "orders": [{"id": f"BB{1000 + n}", "status": "out_for_delivery"} for n in range(args.catalogue_size)],
+        "faq": [{"question": {"english": "How do I register as a supplier?", "hindi": "मैं सप्लायर के रूप में कैसे रजिस्टर करूँ?",
+                              "marathi": "मी पुरवठादार म्हणून नोंदणी कशी करू?",
+                              "gujarati": "હું સપ્લાયર તરીકે કેવી રીતે નોંધણી કરું?"},
+                 "answer": "Open Supplier Registration from the menu."}],
+    }
+    path = os.path.join(args.scratch, "catalogue.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(catalogue, f, ensure_ascii=False)
+    started = time.perf_counter()
+    lookup = LookupFastPath(path)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    # The sample questions, catalogue lookups and questions that need the model
+    rng = random.Random(0)
+    messages = [(prompt, language) for language, prompts in SAMPLE_PROMPTS.items() for prompt in prompts]
+    messages += [(f"item{rng.randrange(args.catalogue_size)} price", "english"),
+                 (f"where is my order BB{1000 + rng.randrange(args.catalogue_size)}", "hindi"),
+                 ("suppliers in Thane", "marathi"),
+                 ("Explain why onion prices rise in the monsoon", "english"),
+                 ("नमस्ते", "hindi")]
+    workload = [messages[i % len(messages)] for i in range(args.requests)]
+
+    results = {}
+    for name, fast_path in (("generate all", None), ("fast path", lookup)):
+        deepseek_server.lookup = fast_path
+        latencies = []
+        for message, language in workload:
+            started = time.perf_counter()
+            deepseek_server.generate_response(message, language)
+            latencies.append((time.perf_counter() - started) * 1000)
+        results[name] = {"p50_ms": round(percentile(latencies, 50), 3), "p95_ms": round(percentile(latencies, 95), 3),
+                         "mean_ms": round(statistics.mean(latencies), 3)}
+    deepseek_server.lookup = None
+    stats = lookup.stats()
+
+    print(f"{len(workload)} requests, {args.max_new_tokens} tokens when generated; catalogue of "
+          f"{len(products)} products built in {build_ms:.1f} ms")
+    print(f"{'run':<14} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, result in results.items():
+        print(f"{name:<14} {result['mean_ms']:>9.3f} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f}")
+    print(f"fast path: hit rate {stats['hit_rate']:.0%} {stats['intents']}, declined {stats['declined']}, "
+          f"lookup p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms")
+    return {"benchmark": "lookup", "catalogue_products": len(products), "build_ms": round(build_ms, 2),
+            "results": results, "lookup": stats}
+
+
+BENCHMARKS = {
+    "context": bench_context,
+    "cpu-int8": bench_cpu_int8,
+    "cold-start": bench_cold_start,
+    "kv": bench_kv,
+    "lookup": bench_lookup,
+    "prefix-cache": bench_prefix_cache,
+    "routing": bench_routing,
+    "semantic-cache": bench_semantic_cache,
+    "speculative": bench_speculative,
+    "templates": bench_templates,
+    "worker-pool": bench_worker_pool,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek-R1 serving benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="Benchmark to run")
+    parser.add_argument("--model", type=str, default=None,
+                        help="Model directory or identifier (default: a tiny random model)")
+    parser.add_argument("--hidden-size", type=int, default=256, help="Hidden size of the tiny model")
+    parser.add_argument("--layers", type=int, default=4, help="Layers of the tiny model")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed repetitions per measurement")
+    parser.add_argument("--entries", type=int, default=100000, help="Semantic cache entries to index")
+    parser.add_argument("--queries", type=int, default=1000, help="Semantic cache lookups to time")
+    parser.add_argument("--dim", type=int, default=128, help="Semantic cache vector size")
+    parser.add_argument("--threshold", type=float, default=0.85, help="Semantic cache similarity threshold")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1,
+                        help="Largest worker pool to measure")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per worker pool measurement")
+    parser.add_argument("--batch-size", type=int, default=4, help="Batch size of each worker")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="Tokens generated per request")
+    parser.add_argument("--dtype", choices=["float32", "float16", "bfloat16"], default="bfloat16",
+                        help="Serving dtype for the cold-start benchmark")
+    parser.add_argument("--draft-model", type=str, default=None,
+                        help="Draft model for the speculative benchmark (default: the main model's first layers)")
+    parser.add_argument("--draft-layers", type=int, default=1,
+                        help="Layers kept in the default draft model")
+    parser.add_argument("--lookahead", type=int, default=4, help="Draft tokens proposed per step")
+    parser.add_argument("--turns", type=int, default=4,
+                        help="Earlier exchanges in the session prompts of the template benchmark")
+    parser.add_argument("--qps", type=float, default=500.0,
+                        help="Request rate the template benchmark projects CPU savings for")
+    parser.add_argument("--conversation-turns", type=int, default=50,
+                        help="Turns of the simulated conversation in the context benchmark")
+    parser.add_argument("--context-tokens", type=int, default=512,
+                        help="Prompt-token budget of the context benchmark")
+    parser.add_argument("--kv-budget-mb", type=float, default=8.0,
+                        help="KV cache memory budget of the kv benchmark")
+    parser.add_argument("--kv-block-size", type=int, default=16, help="Tokens per block of the paged KV cache")
+    parser.add_argument("--small-model", type=str, default=None,
+                        help="Small tier of the routing benchmark (default: a tiny model a quarter the width)")
+    parser.add_argument("--min-confidence", type=float, default=0.0031,
+                        help="Confidence below which the routing benchmark escalates small-tier answers "
+                             "(random tiny models sit near 1/vocabulary)")
+    parser.add_argument("--probe-tokens", type=int, default=8, help="Small-tier tokens scored before escalating")
+    parser.add_argument("--catalogue-size", type=int, default=1000,
+                        help="Products, suppliers and orders in the lookup benchmark's catalogue")
+    parser.add_argument("--json", type=str, default=None, help="Write machine-readable results to this file")
+    args = parser.parse_args()
+
+    # Tiny models, prepared checkpoints and other files a run writes are removed when it ends
+    with tempfile.TemporaryDirectory(prefix="deepseek-benchmark-") as args.scratch:
+        result = BENCHMARKS[args.benchmark](args)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# DeepSeek Bulk Generation
+# Pre-generates answers for a JSONL file of prompts (FAQ and catalogue questions) with one
+# loaded DeepSeekModel. Prompts are sorted by token length and batched so each batch carries
+# little padding, and every answer is appended to the output JSONL as soon as its batch ends.
+# The output file doubles as the checkpoint: rerunning the same command skips prompts that
+# already have an answer, so an interrupted run picks up where it stopped.
+#
+# Input lines: {"id": "faq-17", "message": "...", "language": "hindi", "max_new_tokens": 200}
+# ("messages" may replace "message"; id defaults to the line number; generation fields optional)
+#
+# Usage:
+#   python deepseek_bulk.py prompts.jsonl --output answers.jsonl --batch-size 16
+#   python deepseek_bulk.py prompts.jsonl --output answers.jsonl   # resumes after a crash
+
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Set
+
+# Generation settings a prompt line may override; prompts are only batched with equal settings
+DEFAULT_PARAMS = {
+    "max_new_tokens": 200,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "top_k": 50,
+    "do_sample": True,
+}
+
+
+def read_prompts(path: str, defaults: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Parse the input JSONL into items with an id, language, chat messages and generation params"""
+    from deepseek_server import get_system_prompt
+
+    items, seen = [], set()
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON: {e}")
+            if not isinstance(record, dict) or not (record.get("message") or record.get("messages")):
+                raise ValueError(f"{path}:{line_number}: expected an object with 'message' or 'messages'")
+
+            item_id = str(record.get("id", line_number))
+            if item_id in seen:
+                raise ValueError(f"{path}:{line_number}: duplicate id {item_id!r}")
+            seen.add(item_id)
+
+            language = record.get("language", "english")
+            messages = record.get("messages") or [
+                {"role": "system", "content": get_system_prompt(language)},
+                {"role": "user", "content": record["message"]},
+            ]
+            params = {key: record.get(key, value) for key, value in defaults.items()}
+            items.append({"id": item_id, "language": language, "messages": messages, "params": params})
+    return items
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """Ids already answered in output_path; a line cut short by a crash is removed first"""
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+    done = set()
+    for line in data[:end].decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        # Failed prompts are retried on the next run
+        if "error" not in record:
+            done.add(str(record["id"]))
+    return done
+
+
+def make_batches(items: List[Dict[str, Any]], batch_size: int, max_batch_tokens: int) -> List[List[Dict[str, Any]]]:
+    """Group items with equal generation params, sort by prompt length and cut into batches"""
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for item in items:
+        groups.setdefault(json.dumps(item["params"], sort_keys=True), []).append(item)
+
+    batches = []
+    for group in groups.values():
+        group.sort(key=lambda item: len(item["input_ids"]))
+        batch: List[Dict[str, Any]] = []
+        for item in group:
+            # Sorted ascending, so the newest item sets the padded width of the batch
+            padded = (len(batch) + 1) * len(item["input_ids"])
+            if batch and (len(batch) >= batch_size or padded > max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def generate_batch(model, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Answer one batch; if the batch fails, retry its prompts one by one so one bad prompt is isolated"""
+    try:
+        outputs = model.generate_batch([item["input_ids"] for item in batch], **batch[0]["params"])
+    except Exception as e:
+        if len(batch) == 1:
+            return [{"id": batch[0]["id"], "language": batch[0]["language"], "error": str(e)}]
+        return [result for item in batch for result in generate_batch(model, [item])]
+
+    return [
+        {
+            "id": item["id"],
+            "language": item["language"],
+            "response": model.tokenizer.decode(output_ids, skip_special_tokens=True),
+            "prompt_tokens": len(item["input_ids"]),
+            "completion_tokens": len(output_ids),
+        }
+        for item, output_ids in zip(batch, outputs)
+    ]
+
+
+def run(model, items: List[Dict[str, Any]], output_path: str, batch_size: int = 8,
+        max_batch_tokens: int = 16384) -> Dict[str, Any]:
+    """Generate answers for items not yet in output_path, appending each batch's results as it ends"""
+    done = completed_ids(output_path)
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} prompts, {len(items) - len(pending)} already answered, {len(pending)} to generate")
+
+    for item in pending:
+        item["input_ids"] = model.encode(item["messages"])
+    batches = make_batches(pending, batch_size, max_batch_tokens)
+    prompt_tokens = sum(len(item["input_ids"]) for item in pending)
+    padded_tokens = sum(len(batch) * len(batch[-1]["input_ids"]) for batch in batches)
+
+    started = time.time()
+    answered, failed, completion_tokens = 0, 0, 0
+    with open(output_path, "a", encoding="utf-8") as f:
+        for number, batch in enumerate(batches, 1):
+            for result in generate_batch(model, batch):
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                if "error" in result:
+                    failed += 1
+                else:
+                    answered += 1
+                    completion_tokens += result["completion_tokens"]
+            # Each finished batch is on disk before the next one starts
+            f.flush()
+            os.fsync(f.fileno())
+
+            elapsed = time.time() - started
+            print(f"[{number}/{len(batches)}] {answered + failed}/{len(pending)} prompts, "
+                  f"{(answered + failed) / elapsed:.2f} prompts/sec, {completion_tokens / elapsed:.1f} tokens/sec")
+
+    elapsed = time.time() - started
+    return {
+        "prompts": len(items),
+        "skipped": len(items) - len(pending),
+        "answered": answered,
+        "failed": failed,
+        "batches": len(batches),
+        "padding_efficiency": round(prompt_tokens / padded_tokens, 3) if padded_tokens else 1.0,
+        "seconds": round(elapsed, 2),
+        "prompts_per_second": round(len(pending) / elapsed, 3) if elapsed else 0.0,
+        "tokens_per_second": round(completion_tokens / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek-R1 bulk generation from a JSONL file of prompts")
+    parser.add_argument("input", type=str, help="JSONL file with one prompt per line")
+    parser.add_argument("--output", type=str, required=True,
+                        help="JSONL file answers are appended to (also the resume checkpoint)")
+    parser.add_argument("--model", type=str, default="deepseek-ai/DeepSeek-R1",
+                        help="HuggingFace model identifier or local (prepared) model directory")
+    parser.add_argument("--batch-size", type=int, default=8, help="Maximum prompts per batch")
+    parser.add_argument("--max-batch-tokens", type=int, default=16384,
+                        help="Maximum padded prompt tokens per batch")
+    parser.add_argument("--max-new-tokens", type=int, default=DEFAULT_PARAMS["max_new_tokens"],
+                        help="Default maximum new tokens per prompt")
+    parser.add_argument("--temperature", type=float, default=DEFAULT_PARAMS["temperature"],
+                        help="Default sampling temperature")
+    parser.add_argument("--top-p", type=float, default=DEFAULT_PARAMS["top_p"], help="Default nucleus sampling top-p")
+    parser.add_argument("--greedy", action="store_true", help="Default to greedy decoding instead of sampling")
+    parser.add_argument("--restart", action="store_true", help="Discard existing answers instead of resuming")
+    parser.add_argument("--cpu", action="store_true", help="Force CPU usage")
+    parser.add_argument("--cpu-int8", action="store_true", help="Use CPU int8 dynamic quantization")
+    args = parser.parse_args()
+
+    defaults = dict(DEFAULT_PARAMS, max_new_tokens=args.max_new_tokens, temperature=args.temperature,
+                    top_p=args.top_p, do_sample=not args.greedy)
+    items = read_prompts(args.input, defaults)
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from deepseek_advanced import DeepSeekModel
+    model = DeepSeekModel(model_name=args.model, cpu_only=args.cpu, cpu_int8=args.cpu_int8).load_model()
+
+    summary = run(model, items, args.output, batch_size=args.batch_size, max_batch_tokens=args.max_batch_tokens)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
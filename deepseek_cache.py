@@ -0,0 +1,445 @@
+# DeepSeek Response Cache
+# Serves repeated vendor questions without running the model. Entries are keyed on the
+# normalised message, language, model and generation parameters, held in memory under an
+# entry/byte budget with TTL and LRU eviction, and optionally persisted to a SQLite file so
+# the cache survives restarts. An optional semantic layer also matches near-verbatim repeats:
+# the same question with its word order changed or a word added or dropped. Its default
+# embedding hashes words and character trigrams, so it compares spelling, not meaning; the
+# mean of the serving model's hidden states can be used instead to also match paraphrases. A
+# hit also needs the same numbers as the stored question, and with a catalogue the same
+# products, areas and orders.
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+import numpy as np
+
+
+def normalize_message(message: str) -> str:
+    """Canonical form of a message for cache lookups: NFC, case-folded, single-spaced"""
+    text = unicodedata.normalize("NFC", message).casefold()
+    text = " ".join(text.split())
+    return text.strip(" ?!.।॥")
+
+
+# Digit runs in any script (5, ५, ૫), with decimal and thousands separators
+NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def message_numbers(message: str) -> FrozenSet[str]:
+    """Numbers in a message, with digits of every script written as ASCII digits"""
+    return frozenset("".join(str(unicodedata.digit(c)) if c.isdigit() else c for c in number)
+                     for number in NUMBER.findall(normalize_message(message)))
+
+
+def cache_key(message: str, language: str, model_name: str, params: Dict[str, Any]) -> str:
+    """Stable key for a (message, language, model, generation parameters) combination"""
+    payload = json.dumps(
+        [normalize_message(message), language.lower(), model_name, sorted(params.items())],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """Greedy decoding always gives the same answer; sampled answers only match by chance"""
+    return not params.get("do_sample", False) or params.get("temperature", 1.0) == 0
+
+
+class ResponseCache:
+    """
+    In-memory LRU response cache with TTL and optional SQLite persistence.
+
+    Hits are only served for deterministic generation parameters unless allow_sampled is set,
+    in which case a cached sampled answer stands in for a fresh sample.
+    """
+
+    def __init__(self,
+                 model_name: str,
+                 max_entries: int = 10000,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 24 * 3600.0,
+                 path: Optional[str] = None,
+                 allow_sampled: bool = False):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.allow_sampled = allow_sampled
+
+        # key -> (response, expires_at), ordered from least to most recently used
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def cacheable(self, params: Dict[str, Any]) -> bool:
+        return self.allow_sampled or is_deterministic(params)
+
+    def get(self, message: str, language: str, params: Dict[str, Any]) -> Optional[str]:
+        """Return the cached response, or None on a miss or for uncacheable parameters"""
+        if not self.cacheable(params):
+            self.bypassed += 1
+            return None
+        key = cache_key(message, language, self.model_name, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                self._remove_locked(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, message: str, language: str, params: Dict[str, Any], response: str):
+        """Store a generated response (ignored for uncacheable parameters)"""
+        if not self.cacheable(params):
+            return
+        key = cache_key(message, language, self.model_name, params)
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._insert_locked(key, response, expires_at)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, expires_at))
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "persistent": self._db is not None,
+            }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _load(self):
+        """Warm the in-memory cache from disk, most recently written entries last"""
+        now = time.time()
+        self._db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, response, expires_at FROM responses ORDER BY rowid DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        with self._lock:
+            for key, response, expires_at in reversed(rows):
+                self._insert_locked(key, response, expires_at)
+
+    def _insert_locked(self, key: str, response: str, expires_at: float):
+        if key in self._entries:
+            self._remove_locked(key)
+        self._entries[key] = (response, expires_at)
+        self._bytes += len(response.encode("utf-8"))
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove_locked(oldest)
+            self.evictions += 1
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (oldest,))
+
+    def _remove_locked(self, key: str):
+        response, _ = self._entries.pop(key)
+        self._bytes -= len(response.encode("utf-8"))
+
+
+def hashed_ngram_vector(text: str, dim: int = 128) -> np.ndarray:
+    """
+    Cheap sentence embedding: signed feature hashing of words and character trigrams.
+
+    Works the same for Latin, Devanagari and Gujarati script and needs no model.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in normalize_message(text).split():
+        word = word.strip(".,;:!?'\"()।॥")
+        if not word:
+            continue
+        padded = f" {word} "
+        features = [word] + [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def hidden_state_vector(model, tokenizer, text: str, max_tokens: int = 128) -> np.ndarray:
+    """
+    Model sentence embedding: the mean of a causal LM's last hidden states over the text's tokens.
+
+    Unlike hashed_ngram_vector it reflects what the model understands, so paraphrases ("onion
+    rate today?", "today's onion price") land close together. Costs a forward pass of the
+    base model (no lm_head) over at most max_tokens tokens.
+    """
+    import torch
+
+    ids = tokenizer(normalize_message(text), add_special_tokens=False)["input_ids"][:max_tokens]
+    if not ids:
+        ids = [tokenizer.eos_token_id]
+    with torch.no_grad():
+        hidden = model.base_model(input_ids=torch.tensor([ids], device=model.device)).last_hidden_state[0]
+    vector = hidden.float().mean(dim=0).cpu().numpy()
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+# Set-bit count per byte, for numpy versions without np.bitwise_count
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount64(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class VectorIndex:
+    """
+    Array-backed cosine-similarity index with incremental inserts and LRU eviction.
+
+    Vectors live in one preallocated float32 matrix. Each row also gets a 64-bit
+    random-hyperplane signature, and the Hamming distance between signatures tracks the
+    angle between vectors. A search therefore first keeps the rows whose signature is
+    within reach of the similarity threshold (one vectorised XOR/popcount pass). It then
+    computes exact cosine scores only for the closest of those candidates. At 100k rows
+    this stays under a millisecond, where a full matrix-vector product does not.
+    """
+
+    SIGNATURE_BITS = 64
+    RERANK_LIMIT = 256
+
+    def __init__(self, dim: int, capacity: int = 100000, seed: int = 0):
+        self.dim = dim
+        self.capacity = capacity
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((dim, self.SIGNATURE_BITS)).astype(np.float32)
+        self._bit_weights = (np.uint64(1) << np.arange(self.SIGNATURE_BITS, dtype=np.uint64))
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._signatures = np.zeros(capacity, dtype=np.uint64)
+        self._groups = np.full(capacity, -1, dtype=np.int32)  # -1 marks a free row
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._payloads: List[Any] = [None] * capacity
+        self._size = 0  # rows [0, _size) have been used at least once
+        self._free: List[int] = []
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return self._size - len(self._free)
+
+    def signature(self, vector: np.ndarray) -> np.uint64:
+        bits = (vector @ self._planes) > 0
+        return np.uint64(np.sum(self._bit_weights[bits], dtype=np.uint64))
+
+    def add(self, vector: np.ndarray, payload: Any, group: int = 0) -> int:
+        """Insert a unit vector under a group id, evicting the least recently used row when full"""
+        if self._free:
+            row = self._free.pop()
+        elif self._size < self.capacity:
+            row = self._size
+            self._size += 1
+        else:
+            row = int(np.argmin(self._last_used[:self._size]))
+            self.evictions += 1
+        self._vectors[row] = vector
+        self._signatures[row] = self.signature(vector)
+        self._groups[row] = group
+        self._last_used[row] = time.time()
+        self._payloads[row] = payload
+        return row
+
+    def remove(self, row: int):
+        if self._groups[row] >= 0:
+            self._groups[row] = -1
+            self._payloads[row] = None
+            self._last_used[row] = 0.0
+            self._free.append(row)
+
+    def search(self, vector: np.ndarray, group: int = 0, threshold: float = 0.9) -> Tuple[Optional[int], float]:
+        """Return (row, score) of the most similar vector in group with score >= threshold"""
+        if self._size == 0:
+            return None, 0.0
+
+        # Allow the signature distance expected at the threshold angle plus three standard deviations
+        p = math.acos(max(-1.0, min(1.0, threshold))) / math.pi
+        bits = self.SIGNATURE_BITS
+        max_distance = int(bits * p + 3 * math.sqrt(bits * p * (1 - p))) + 1
+
+        distances = _popcount64(self._signatures[:self._size] ^ self.signature(vector))
+        candidates = np.flatnonzero(distances <= max_distance)
+        candidates = candidates[self._groups[candidates] == group]
+        if len(candidates) == 0:
+            return None, 0.0
+        if len(candidates) > self.RERANK_LIMIT:
+            # Only the signature-nearest candidates can plausibly be the best match
+            nearest = np.argpartition(distances[candidates], self.RERANK_LIMIT)[:self.RERANK_LIMIT]
+            candidates = candidates[nearest]
+
+        scores = self._vectors[candidates] @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None, float(scores[best])
+        row = int(candidates[best])
+        self._last_used[row] = time.time()
+        return row, float(scores[best])
+
+    def payload(self, row: int) -> Any:
+        return self._payloads[row]
+
+
+class SemanticCache:
+    """
+    Near-duplicate answer cache: returns the stored answer of the most similar earlier
+    question with the same language, model and generation parameters when the cosine
+    similarity clears the threshold.
+
+    The default hashed n-gram embedding only catches near-verbatim repeats ("onion price
+    today" for "today onion price"): paraphrases such as "onion rate today?" and "today's
+    onion price" score well below a safe threshold. Pass embed (text -> unit vector, such as
+    hidden_state_vector with the serving model) to match paraphrases; it may return None when
+    it cannot embed right now (the model is unloaded), which makes the lookup a miss. The
+    index is sized by the first vector, and thresholds differ between embeddings. Whatever the
+    embedding, a hit is refused when the two questions differ in their numbers or in the names
+    entities(message) returns (catalogue products, areas, orders), so "5 kg" never answers
+    "50 kg". Like ResponseCache, sampled answers are only served with allow_sampled.
+    """
+
+    def __init__(self,
+                 model_name: str,
+                 threshold: float = 0.85,
+                 max_entries: int = 100000,
+                 ttl_seconds: float = 24 * 3600.0,
+                 dim: int = 128,
+                 embed: Optional[Callable[[str], np.ndarray]] = None,
+                 entities: Optional[Callable[[str], Iterable[str]]] = None,
+                 allow_sampled: bool = False):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.embed = embed or (lambda text: hashed_ngram_vector(text, dim))
+        self.entities = entities
+        self.allow_sampled = allow_sampled
+        self.max_entries = max_entries
+        self.index: Optional[VectorIndex] = None
+        self._groups: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.refused = 0
+        self.expirations = 0
+        self.lookup_seconds = 0.0
+
+    def cacheable(self, params: Dict[str, Any]) -> bool:
+        return self.allow_sampled or is_deterministic(params)
+
+    def facts(self, message: str) -> FrozenSet[str]:
+        """What two questions must share for one's answer to serve the other"""
+        facts = message_numbers(message)
+        if self.entities is not None:
+            facts |= frozenset(self.entities(message))
+        return facts
+
+    def _group(self, language: str, params: Dict[str, Any]) -> int:
+        key = json.dumps([language.lower(), self.model_name, sorted(params.items())], ensure_ascii=False)
+        return self._groups.setdefault(key, len(self._groups))
+
+    def get(self, message: str, language: str, params: Dict[str, Any]) -> Optional[str]:
+        """Return the answer of a near-duplicate question, or None on a miss or for uncacheable parameters"""
+        if not self.cacheable(params):
+            with self._lock:
+                self.bypassed += 1
+            return None
+        started = time.perf_counter()
+        vector = self.embed(message)
+        if vector is None:
+            with self._lock:
+                self.bypassed += 1
+            return None
+        facts = self.facts(message)
+        with self._lock:
+            row, _ = self._index(vector).search(vector, self._group(language, params), self.threshold)
+            if row is not None and self.index.payload(row)[1] < time.time():
+                self.index.remove(row)
+                self.expirations += 1
+                row = None
+            if row is not None and self.index.payload(row)[2] != facts:
+                # Similar wording, but other numbers or products: the answer would be wrong
+                self.refused += 1
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.lookup_seconds += time.perf_counter() - started
+            return self.index.payload(row)[0] if row is not None else None
+
+    def put(self, message: str, language: str, params: Dict[str, Any], response: str):
+        """Store a generated answer (ignored for uncacheable parameters)"""
+        if not self.cacheable(params):
+            return
+        vector = self.embed(message)
+        if vector is None:
+            return
+        facts = self.facts(message)
+        with self._lock:
+            self._index(vector).add(vector, (response, time.time() + self.ttl_seconds, facts), self._group(language, params))
+
+    def _index(self, vector: np.ndarray) -> VectorIndex:
+        if self.index is None:
+            self.index = VectorIndex(len(vector), capacity=self.max_entries)
+        return self.index
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.index) if self.index is not None else 0,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "refused": self.refused,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.index.evictions if self.index is not None else 0,
+                "expirations": self.expirations,
+                "mean_lookup_ms": 1000 * self.lookup_seconds / lookups if lookups else 0.0,
+            }
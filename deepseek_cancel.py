@@ -0,0 +1,68 @@
+# DeepSeek Request Cancellation
+# A request carries an optional deadline and a cancellation token. Whoever gives up on the
+# request cancels the token: a disconnected HTTP client, a closed daemon connection, or an
+# explicit cancel op. Generation checks both between decode steps and stops early with the
+# text produced so far, so cores are not spent on answers nobody will read.
+
+from typing import Callable, List, Optional
+import threading
+import time
+
+# Finish reasons for requests stopped before max_new_tokens or end-of-sequence
+CANCELLED = "cancelled"
+DEADLINE = "deadline"
+TRUNCATED_REASONS = (CANCELLED, DEADLINE)
+
+
+class CancellationToken:
+    """Thread-safe flag set once when the caller gives up on a request"""
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = CANCELLED):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """Run callback when the token is cancelled (right away if it already is)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+def stop_reason(cancel_token: Optional[CancellationToken], deadline: Optional[float]) -> Optional[str]:
+    """CANCELLED or DEADLINE once generation should stop, None while it may continue"""
+    if cancel_token is not None and cancel_token.cancelled:
+        return CANCELLED
+    if deadline is not None and time.time() > deadline:
+        return DEADLINE
+    return None
+
+
+def stopping_criteria(cancel_token: Optional[CancellationToken] = None, deadline: Optional[float] = None):
+    """A StoppingCriteriaList that ends model.generate() once the request is cancelled or late"""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class CancellationCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            stop = stop_reason(cancel_token, deadline) is not None
+            return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([CancellationCriteria()])
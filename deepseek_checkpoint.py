@@ -0,0 +1,178 @@
+# DeepSeek Prepared Checkpoints
+# One-time conversion of a model into a local safetensors checkpoint already in the serving
+# dtype. Loading a prepared checkpoint skips the hub lookup and the generic from_pretrained
+# conversion path: the model skeleton is built on the meta device and the weights are assigned
+# straight from the memory-mapped safetensors files. Checkpoints prepared on demand (for the
+# CPU worker pool) are kept under ~/.cache/deepseek, keyed by the source model's revision.
+#
+# Usage:
+#   python deepseek_checkpoint.py prepare --model deepseek-ai/DeepSeek-R1 --output ./deepseek-r1-bf16 --dtype bfloat16
+#   python deepseek_web_app.py --model ./deepseek-r1-bf16 --load-model-on-startup
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Written next to the weights; its presence marks a directory as a prepared checkpoint
+MANIFEST_NAME = "deepseek_prepared.json"
+
+DTYPES = ("float32", "float16", "bfloat16")
+
+# Root of the on-disk caches derived from a model (prepared checkpoints, int8 models)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "deepseek")
+
+
+def model_slug(model_name: str) -> str:
+    """A file-name-safe form of a hub id or (absolute) local model path"""
+    source = os.path.abspath(model_name) if os.path.isdir(model_name) else model_name
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", source).strip("_")
+
+
+def model_revision(model_name: str) -> str:
+    """The hub commit of a model, or the newest modification time of a local model directory"""
+    if os.path.isdir(model_name):
+        paths = [os.path.join(model_name, f) for f in os.listdir(model_name)]
+        return f"mtime{int(max((os.path.getmtime(p) for p in paths), default=0))}"
+    from transformers import AutoConfig
+
+    commit = getattr(AutoConfig.from_pretrained(model_name, trust_remote_code=True), "_commit_hash", None)
+    return commit[:12] if commit else "unknown"
+
+
+def cache_key(model_name: str) -> str:
+    """
+    What a cached conversion of model_name depends on: the source model, its revision and the
+    transformers version whose model classes it was built with. A new revision of either gets
+    a new key, so stale conversions are never loaded.
+    """
+    import transformers
+
+    return f"{model_slug(model_name)}@{model_revision(model_name)}-transformers{transformers.__version__}"
+
+
+def prune_cache(directory: str, model_name: str, keep: str, suffix: str = ""):
+    """Delete the entries of directory for other revisions of model_name than keep"""
+    for path in glob.glob(os.path.join(directory, f"{glob.escape(model_slug(model_name))}@*{suffix}")):
+        if os.path.basename(path) != keep:
+            logger.info(f"Removing stale cache entry {path}")
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def is_prepared(path) -> bool:
+    """True if path is a directory written by prepare_checkpoint()"""
+    return os.path.isfile(os.path.join(str(path), MANIFEST_NAME))
+
+
+def prepare_checkpoint(model_name: str, output_dir: str, dtype: str = "bfloat16") -> str:
+    """Load model_name once, cast it to dtype and save model and tokenizer as safetensors"""
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    started = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True,
+                                                 torch_dtype=getattr(torch, dtype))
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump({"source": model_name, "dtype": dtype, "prepared_at": time.time()}, f, indent=2)
+    logger.info(f"Prepared {model_name} as {dtype} in {output_dir} ({time.time() - started:.1f}s)")
+    return output_dir
+
+
+def prepared_dtype(path: str) -> str:
+    with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as f:
+        return json.load(f)["dtype"]
+
+
+def ensure_prepared(model_name: str, dtype: str = "bfloat16", cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """
+    A prepared checkpoint of model_name in dtype: model_name itself if it already is one,
+    otherwise one prepared once under cache_dir/prepared (older revisions are removed).
+    """
+    if is_prepared(model_name) and prepared_dtype(model_name) == dtype:
+        return model_name
+    directory = os.path.join(cache_dir, "prepared")
+    name = f"{cache_key(model_name)}-{dtype}"
+    path = os.path.join(directory, name)
+    if not is_prepared(path):
+        # Prepared beside the target and renamed into place, so a half-written checkpoint is never loaded
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        prepare_checkpoint(model_name, tmp_path, dtype)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    prune_cache(directory, model_name, name, f"-{dtype}")
+    return path
+
+
+def load_prepared_model(path: str):
+    """Build the model from a prepared checkpoint with memory-mapped weights and no dtype conversion"""
+    import torch
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    dtype = getattr(torch, prepared_dtype(path))
+
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=dtype)
+
+    state_dict = {}
+    for shard in sorted(glob.glob(os.path.join(path, "*.safetensors"))):
+        state_dict.update(load_file(shard))
+    # Not strict: tied weights are saved once and filled in by tie_weights(), and non-persistent
+    # buffers are not saved at all. Anything else that does not line up is an error.
+    result = model.load_state_dict(state_dict, assign=True, strict=False)
+    if result.unexpected_keys:
+        raise ValueError(f"Prepared checkpoint {path} has unexpected weights: "
+                         f"{', '.join(result.unexpected_keys[:5])}")
+    model.tie_weights()
+
+    missing = [name for name, tensor in [*model.named_parameters(), *model.named_buffers()]
+               if tensor.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Prepared checkpoint {path} is missing weights: {', '.join(missing[:5])}")
+    model.eval()
+    return model
+
+
+def load_model(model_name: str, device: str = "cpu", **model_kwargs):
+    """Load a prepared checkpoint directly, anything else through from_pretrained(**model_kwargs)"""
+    if is_prepared(model_name):
+        model = load_prepared_model(model_name)
+        return model if device == "cpu" else model.to(device)
+    from transformers import AutoModelForCausalLM
+
+    return AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True, **model_kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek-R1 checkpoint preparation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prepare = subparsers.add_parser("prepare", help="Write a local safetensors checkpoint in the serving dtype")
+    prepare.add_argument("--model", type=str, default="deepseek-ai/DeepSeek-R1",
+                         help="HuggingFace model identifier or local model directory")
+    prepare.add_argument("--output", type=str, required=True, help="Directory for the prepared checkpoint")
+    prepare.add_argument("--dtype", choices=DTYPES, default="bfloat16", help="Weight dtype to store")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.command == "prepare":
+        prepare_checkpoint(args.model, args.output, args.dtype)
+
+
+if __name__ == "__main__":
+    main()
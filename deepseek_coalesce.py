@@ -0,0 +1,209 @@
+# DeepSeek Request Coalescing
+# When a price alert goes out, hundreds of vendors ask the same question within seconds.
+# Concurrent requests with the same response-cache key (normalised message, language, model
+# and generation parameters) share one generation: the first request starts it, later ones
+# attach to it and receive its tokens from the start, then as they are produced. The shared
+# generation is only cancelled once every attached client has given up, and a follower whose
+# leader has not produced a token within max_wait seconds generates its own answer instead.
+
+from typing import Any, Callable, Dict, List, Optional
+import threading
+
+from deepseek_cache import is_deterministic
+from deepseek_cancel import CANCELLED, CancellationToken
+
+
+class Flight:
+    """One generation in progress and the requests that receive its output"""
+
+    def __init__(self, key: str):
+        self.key = key
+        # Cancels the generation; only set once every attached request has been cancelled
+        self.cancel_token = CancellationToken()
+        self.generation = None
+        self.tokens: List[int] = []
+        self.finished = False
+        self.failed = False
+        self.followers = 0
+        self._views: List[Any] = []
+        self._submitted = threading.Event()
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+
+    def wait_started(self, timeout: Optional[float]) -> bool:
+        """Wait for the first token (or the end) of the generation; False if it could not start"""
+        return self._started.wait(timeout) and self._submitted.wait() and not self.failed
+
+    def attach(self, view) -> bool:
+        """Replay the output so far to a request and keep it updated; False if the flight was abandoned"""
+        with self._lock:
+            if self.failed or self.cancel_token.cancelled:
+                return False
+            self._adopt(view)
+            for token_id in self.tokens:
+                view._append(token_id)
+            finished = self.finished
+            if not finished:
+                self._views.append(view)
+        if finished:
+            self._finish_view(view)
+        elif view.cancel_token is not None:
+            view.cancel_token.add_callback(lambda: self._leave(view))
+        return True
+
+    def submitted(self, generation):
+        """The leader submitted the generation; its attached requests take over its prompt and tier"""
+        with self._lock:
+            self.generation = generation
+            for view in self._views:
+                self._adopt(view)
+        self._submitted.set()
+
+    def fail(self):
+        """The generation could not be submitted; waiting followers generate on their own"""
+        with self._lock:
+            self.failed = True
+            self._views = []
+        self._submitted.set()
+        self._started.set()
+
+    def _on_token(self, token_id: int):
+        with self._lock:
+            self.tokens.append(token_id)
+            for view in self._views:
+                view._append(token_id)
+        self._started.set()
+
+    def _on_done(self, generation):
+        with self._lock:
+            self.generation = generation
+            self.finished = True
+            views, self._views = self._views, []
+        self._started.set()
+        for view in views:
+            self._finish_view(view)
+
+    def _adopt(self, view):
+        if self.generation is not None:
+            view.input_ids = self.generation.input_ids
+            view.model_tier = self.generation.model_tier
+
+    def _finish_view(self, view):
+        generation = self.generation
+        self._adopt(view)
+        view.timings.update(generation.timings)
+        view.started_at = generation.started_at
+        view.preemptions = generation.preemptions
+        view.tokens_saved = generation.tokens_saved
+        view.reasoning = generation.reasoning
+        view._finish(generation.finish_reason, generation.error)
+
+    def _leave(self, view):
+        """A client gave up: detach its request, and stop the generation once nobody is left"""
+        with self._lock:
+            if view not in self._views:
+                return
+            self._views.remove(view)
+            abandoned = not self._views
+        if abandoned:
+            self.cancel_token.cancel()
+        view._finish(CANCELLED)
+
+
+class RequestCoalescer:
+    """
+    Single-flight table of the generations in progress, keyed like the response cache.
+
+    Only deterministic generation parameters are coalesced unless allow_sampled is set, in
+    which case one sample stands in for all concurrent identical requests.
+    """
+
+    def __init__(self, max_wait: float = 10.0, allow_sampled: bool = False):
+        self.max_wait = max_wait
+        self.allow_sampled = allow_sampled
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+        # Generations started, requests served by another request's generation (generations
+        # saved), and followers that stopped waiting and generated their own answer
+        self.leaders = 0
+        self.followers = 0
+        self.fallbacks = 0
+        self.largest_flight = 0
+
+    def coalescable(self, params: Dict[str, Any]) -> bool:
+        return self.allow_sampled or is_deterministic(params)
+
+    def submit(self,
+               key: str,
+               start: Callable[..., Any],
+               input_ids: List[int],
+               stream: bool = False,
+               cancel_token: Optional[CancellationToken] = None,
+               tenant: Optional[str] = None,
+               priority: Optional[str] = None,
+               on_token: Optional[Callable[[int], None]] = None,
+               on_done: Optional[Callable[[Any], None]] = None):
+        """
+        Return a GenerationRequest that receives the output of the generation in flight for key.
+
+        When there is none, start(on_token, on_done, cancel_token) submits it and the caller
+        leads the flight. A follower blocks until the leader's first token for at most max_wait
+        seconds; if it is not there by then, None is returned and the caller generates on its own.
+        Exceptions from start() propagate to the leader.
+        """
+        from deepseek_batching import GenerationRequest
+
+        view = GenerationRequest(input_ids, stream=stream, cancel_token=cancel_token, tenant=tenant,
+                                 priority=priority, on_token=on_token, on_done=on_done)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight(key)
+        if leader:
+            flight.attach(view)
+            try:
+                flight.submitted(start(flight._on_token, lambda generation: self._land(flight, generation),
+                                       flight.cancel_token))
+            except BaseException:
+                self._remove(flight)
+                flight.fail()
+                raise
+            with self._lock:
+                self.leaders += 1
+            return view
+
+        view.coalesced = True
+        if not (flight.wait_started(self.max_wait) and flight.attach(view)):
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        with self._lock:
+            self.followers += 1
+            flight.followers += 1
+            self.largest_flight = max(self.largest_flight, flight.followers + 1)
+        return view
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.leaders + self.followers
+            return {
+                "in_flight": len(self._flights),
+                "generations": self.leaders,
+                "generations_saved": self.followers,
+                "coalesce_rate": self.followers / requests if requests else 0.0,
+                "fallbacks": self.fallbacks,
+                "largest_flight": self.largest_flight,
+                "max_wait": self.max_wait,
+            }
+
+    def _land(self, flight: Flight, generation):
+        # Later identical requests are answered by the response cache instead
+        self._remove(flight)
+        flight._on_done(generation)
+
+    def _remove(self, flight: Flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
@@ -0,0 +1,373 @@
+# DeepSeek Conversation Context
+# Keeps chat prompts within a token budget however long a conversation gets. The system
+# prompt and the most recent turns are sent verbatim. Older turns are replaced by a rolling
+# summary that is appended to the system prompt. Summaries are written on a background
+# thread, so a request never waits for one. Until a summary for the latest trimmed turns is
+# ready, the previous summary is used.
+#
+# The window slides in steps. Once a prompt goes over the budget, old turns are trimmed until it
+# fits under a lower watermark. The first messages of the prompt then stay the same for the next
+# few turns, so session KV caches and the prompt assembly caches keep matching.
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import hashlib
+import logging
+import threading
+import time
+
+from deepseek_prompts import encode_chat
+
+logger = logging.getLogger(__name__)
+
+# Summaries are appended to the system prompt under this heading
+SUMMARY_HEADING = "Summary of the earlier conversation:"
+
+SUMMARY_INSTRUCTION = (
+    "Summarise this conversation between a street food vendor and the BazaarBandhu assistant in a "
+    "few sentences. Keep names, products, quantities, prices, orders and anything still unresolved. "
+    "Write in the language the conversation uses."
+)
+
+# summarize(previous_summary, messages) -> summary text covering both
+Summarizer = Callable[[Optional[str], List[Dict[str, str]]], str]
+
+
+class Compaction(NamedTuple):
+    """Messages to send, and how much of the conversation they replaced"""
+    messages: List[Dict[str, str]]
+    # Estimated prompt tokens of the full and the compacted conversation
+    tokens_before: int
+    tokens_after: int
+    # Earlier messages left out, and how many of those the included summary covers
+    dropped: int
+    summarized: int
+
+
+class _Conversation:
+    """Window position and summaries of one conversation"""
+
+    def __init__(self):
+        self.start = 0
+        self.start_hash = history_hash(())
+        # Number of history messages covered -> (hash of those messages, summary text, its tokens)
+        self.summaries: Dict[int, Tuple[str, str, int]] = {}
+        self.pending: Optional[int] = None
+
+
+def history_hash(messages: Sequence[Dict[str, str]]) -> str:
+    digest = hashlib.sha1()
+    for message in messages:
+        digest.update(message["role"].encode("utf-8") + b"\0" + message["content"].encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+def summary_messages(previous: Optional[str], messages: Sequence[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Chat messages asking the model to fold messages into the previous summary"""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous:
+        transcript = f"{SUMMARY_HEADING}\n{previous}\n\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": transcript},
+    ]
+
+
+def model_summarizer(tokenizer, generate: Callable[[List[int], int], List[int]],
+                     max_new_tokens: int = 128) -> Summarizer:
+    """
+    A Summarizer running the chat model: generate(prompt_ids, max_new_tokens) returns output ids.
+
+    The reasoning section the R1 template opens is closed in the prompt, so every generated
+    token goes to the summary.
+    """
+    from deepseek_reasoning import ReasoningTracker, split_answer
+
+    def summarize(previous, messages):
+        prompt_ids = encode_chat(tokenizer, summary_messages(previous, messages))
+        reasoning = ReasoningTracker.create(tokenizer, prompt_ids)
+        if reasoning is not None and reasoning.in_reasoning:
+            prompt_ids = prompt_ids + reasoning.close_ids
+        output_ids = generate(prompt_ids, max_new_tokens)
+        answer_ids, _ = split_answer(tokenizer, prompt_ids, output_ids)
+        return tokenizer.decode(answer_ids, skip_special_tokens=True).strip()
+
+    return summarize
+
+
+class ModelLock:
+    """
+    Serialises one model between requests and background summaries.
+
+    Requests go first: a summary starts only while no request holds or waits for the model.
+    A summary that has already started is not interrupted.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = 0
+
+    @contextmanager
+    def foreground(self):
+        with self._cond:
+            self._waiting += 1
+            while self._busy:
+                self._cond.wait()
+            self._waiting -= 1
+            self._busy = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def background(self):
+        with self._cond:
+            while self._busy or self._waiting:
+                self._cond.wait()
+            self._busy = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+
+class ContextManager:
+    """
+    Fits chat messages into max_tokens prompt tokens.
+
+    fit() keeps leading system messages and the newest messages, and swaps older ones for a
+    summary when summarize is given (otherwise they are dropped). Counts are estimates from
+    per-message token counts; the prompt actually sent may differ by a few template tokens.
+
+    summary_tokens defaults to 128, or a quarter of max_tokens for small budgets. A summary is
+    left out of a prompt it would push over max_tokens; only a system prompt and newest message
+    that are over the budget by themselves are sent as they are.
+    """
+
+    def __init__(self, tokenizer, max_tokens: int, summarize: Optional[Summarizer] = None,
+                 summary_tokens: Optional[int] = None, low_watermark: float = 0.75,
+                 max_conversations: int = 10000, max_cached_counts: int = 4096):
+        if max_tokens < 1:
+            raise ValueError(f"max_tokens must be positive, got {max_tokens}")
+        if summary_tokens is None:
+            summary_tokens = min(128, max_tokens // 4)
+        elif summarize is not None and not 0 <= summary_tokens < max_tokens:
+            raise ValueError(f"summary_tokens ({summary_tokens}) must leave room in max_tokens ({max_tokens})")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        # Room kept free for the summary
+        self.summary_tokens = summary_tokens
+        self.low_watermark = low_watermark
+        self.max_conversations = max_conversations
+        self.max_cached_counts = max_cached_counts
+
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._overhead: Optional[Tuple[int, int]] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-summary") \
+            if summarize is not None else None
+
+        self.requests = 0
+        self.compacted = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.summaries_written = 0
+        self.summary_failures = 0
+        self.summary_seconds = 0.0
+
+    def fit(self, messages: Sequence[Dict[str, str]], conversation: Optional[str] = None) -> Compaction:
+        """
+        The messages to send for this turn; the last message is always kept.
+
+        conversation identifies the chat (a session id) so the window and summaries carry over
+        between turns; without one, the first history message identifies it.
+        """
+        messages = list(messages)
+        first = 0
+        while first < len(messages) - 1 and messages[first]["role"] == "system":
+            first += 1
+        system, history = messages[:first], messages[first:]
+        counts = [self.count(message) for message in messages]
+        base = self.template_overhead()[0]
+        before = base + sum(counts)
+        history_counts = counts[first:]
+        # Tokens outside the window: template, system prompt and room for the summary
+        reserved = base + sum(counts[:first])
+        summary_room = self.summary_tokens + self.count_text(self._note("")) if self.summarize is not None else 0
+
+        key = conversation or history_hash(history[:1])
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += before
+            state = self._conversations.get(key)
+            if state is None:
+                if before <= self.max_tokens:
+                    self.tokens_after += before
+                    return Compaction(messages, before, before, 0, 0)
+                state = self._conversations[key] = _Conversation()
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            self._conversations.move_to_end(key)
+
+            # An edited or different conversation under the same key starts over
+            if not self._matches(state, history):
+                state.start, state.start_hash, state.summaries = 0, history_hash(()), {}
+            # A summary may come out longer than planned for
+            summary_room = max([summary_room] + [tokens for _, _, tokens in state.summaries.values()])
+            # but never more room than the system prompt and the newest message leave
+            summary_room = min(summary_room, max(0, self.max_tokens - reserved - history_counts[-1]))
+            start = self._slide(state.start, history, history_counts, reserved + summary_room)
+            if start != state.start:
+                state.start, state.start_hash = start, history_hash(history[:start])
+
+            summary, covered = self._summary(state, start)
+            if self.summarize is not None and covered < start and state.pending is None:
+                state.pending = start
+                self._executor.submit(self._write_summary, state, history[:start], summary, history[covered:start])
+
+        after = base + sum(counts[:first]) + sum(history_counts[start:])
+        if summary:
+            summary_tokens = self.count_text(self._note(summary))
+            if after + summary_tokens <= self.max_tokens:
+                after += summary_tokens
+            else:
+                # Dropping the summary is all that is left to keep the prompt in budget
+                summary, covered = None, 0
+        if after > self.max_tokens:
+            logger.warning(f"System prompt and newest message take {after} tokens, over the "
+                           f"{self.max_tokens}-token context budget")
+        fitted = self._with_summary(system, summary) + history[start:]
+        with self._lock:
+            if start:
+                self.compacted += 1
+            self.tokens_after += after
+        return Compaction(fitted, before, after, start, covered)
+
+    def count(self, message: Dict[str, str]) -> int:
+        """Estimated prompt tokens of one message, its role markers included"""
+        return self.count_text(message["content"]) + self.template_overhead()[1]
+
+    def count_text(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                return count
+        count = len(self.tokenizer.encode(text, add_special_tokens=False))
+        with self._lock:
+            self._counts[text] = count
+            while len(self._counts) > self.max_cached_counts:
+                self._counts.popitem(last=False)
+        return count
+
+    def template_overhead(self) -> Tuple[int, int]:
+        """Template tokens per prompt (BOS, generation prompt) and per message (role markers)"""
+        if self._overhead is None:
+            text = self.count_text("x")
+            one = len(encode_chat(self.tokenizer, [{"role": "user", "content": "x"}]))
+            three = len(encode_chat(self.tokenizer, [{"role": "user", "content": "x"},
+                                                     {"role": "assistant", "content": "x"},
+                                                     {"role": "user", "content": "x"}]))
+            per_message = max(0, (three - one) // 2 - text)
+            self._overhead = (max(0, one - text - per_message), per_message)
+        return self._overhead
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until queued summaries are written (for tests and benchmarks)"""
+        if self._executor is None:
+            return True
+        return self._executor.submit(lambda: None).result(timeout) is None
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "max_tokens": self.max_tokens,
+                "conversations": len(self._conversations),
+                "requests": self.requests,
+                "compacted": self.compacted,
+                "prompt_tokens_before": self.tokens_before,
+                "prompt_tokens_after": self.tokens_after,
+                "summaries_written": self.summaries_written,
+                "summary_failures": self.summary_failures,
+                "mean_summary_seconds": self.summary_seconds / self.summaries_written if self.summaries_written else 0.0,
+            }
+
+    def _slide(self, start: int, history: List[Dict[str, str]], counts: List[int], reserved: int) -> int:
+        """New window start: unchanged while the prompt fits, else moved to fit the low watermark"""
+        budget = self.max_tokens - reserved
+        if sum(counts[start:]) <= budget:
+            return start
+        target = budget * self.low_watermark
+        last = len(history) - 1
+        remaining = sum(counts[start:])
+        while start < last and remaining > target:
+            remaining -= counts[start]
+            start += 1
+        # Start the window at a user message so the roles still alternate
+        while start < last and history[start]["role"] != "user":
+            start += 1
+        return start
+
+    @staticmethod
+    def _matches(state: _Conversation, history: List[Dict[str, str]]) -> bool:
+        """False if history is not a continuation of what the conversation's summaries cover"""
+        if state.start >= len(history) or state.start_hash != history_hash(history[:state.start]):
+            return False
+        return all(covered <= len(history) and summary_hash == history_hash(history[:covered])
+                   for covered, (summary_hash, _, _) in state.summaries.items())
+
+    @staticmethod
+    def _summary(state: _Conversation, start: int) -> Tuple[Optional[str], int]:
+        """The newest summary covering no more than the dropped messages, and how many it covers"""
+        for covered in sorted(state.summaries, reverse=True):
+            if covered <= start:
+                return state.summaries[covered][1], covered
+        return None, 0
+
+    def _with_summary(self, system: List[Dict[str, str]], summary: Optional[str]) -> List[Dict[str, str]]:
+        if not summary:
+            return list(system)
+        if not system:
+            return [{"role": "system", "content": self._note(summary).lstrip()}]
+        # Folded into the last system message so the template sees a single system prompt
+        last = system[-1]
+        return system[:-1] + [{"role": "system", "content": last["content"] + self._note(summary)}]
+
+    @staticmethod
+    def _note(summary: str) -> str:
+        return f"\n\n{SUMMARY_HEADING}\n{summary}"
+
+    def _write_summary(self, state: _Conversation, covered_messages: List[Dict[str, str]],
+                       previous: Optional[str], new_messages: List[Dict[str, str]]):
+        """Fold new_messages into previous; the result covers covered_messages"""
+        covered = len(covered_messages)
+        started = time.perf_counter()
+        try:
+            summary = self.summarize(previous, new_messages)
+        except Exception as e:
+            logger.error(f"Error summarising conversation: {e}")
+            with self._lock:
+                self.summary_failures += 1
+                state.pending = None
+            return
+        tokens = self.count_text(self._note(summary))
+        with self._lock:
+            state.pending = None
+            self.summary_seconds += time.perf_counter() - started
+            if summary:
+                self.summaries_written += 1
+                state.summaries[covered] = (history_hash(covered_messages), summary, tokens)
+                # Only the newest summary is needed from here on
+                for older in [c for c in state.summaries if c < covered]:
+                    del state.summaries[older]
@@ -1,19 +1,22 @@
 # DeepSeek-R1 Model Demo
 # This script demonstrates how to use the DeepSeek-R1 model from Hugging Face
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
+import os
+
+# DEEPSEEK_MODEL may point at a local checkpoint made by deepseek_checkpoint.py prepare
+MODEL_NAME = os.environ.get("DEEPSEEK_MODEL", "deepseek-ai/DeepSeek-R1")
+
+def load_model():
+    """Return the tokenizer and model, loaded on the first call and reused by the model registry"""
+    from deepseek_registry import registry
+    
+    # float16 on CUDA; the registry hands back the same handle for every later message
+    loaded = registry.get(MODEL_NAME)
+    return loaded.tokenizer, loaded.model
 
 def generate_response(user_message):
     # Load the tokenizer and model
-    print("Loading DeepSeek-R1 model and tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained("deepseek-ai/DeepSeek-R1", trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(
-        "deepseek-ai/DeepSeek-R1", 
-        trust_remote_code=True,
-        torch_dtype=torch.float16,  # Use float16 for efficiency
-        device_map="auto"  # Automatically determine the best device mapping
-    )
+    tokenizer, model = load_model()
     
     # Create the messages list with the user's message
     messages = [
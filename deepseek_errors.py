@@ -0,0 +1,23 @@
+# DeepSeek Serving Errors
+# Exceptions shared by the schedulers and the HTTP front ends. Kept free of torch/transformers
+# imports so front ends can handle them without paying for the model stack at import time.
+
+
+class QueueFullError(Exception):
+    """Raised by submit() when the scheduler queue is at its depth limit"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Inference queue is full, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """A request's deadline passed before it could be served"""
+
+
+class KVPoolExhausted(Exception):
+    """The paged KV cache pool has no free block left, even after reclaiming idle caches"""
+
+
+class SessionBusyError(Exception):
+    """A chat turn arrived while its session was still answering the previous one"""
@@ -0,0 +1,227 @@
+# DeepSeek Fair Scheduling
+# Orders requests waiting for the model by priority class, then fairly across tenants.
+# Interactive requests (vendor chats) are always served before batch requests (bulk scripts).
+# Within a class, tenants share slots in proportion to their weights: start-time fair
+# queueing, with a request's cost being the tokens it may generate. A tenant may also have a
+# token-rate limit (a token bucket that may go into debt and holds back its requests until it
+# is refilled) and a cap on queued requests. Front ends pass each request's tenant id and
+# priority; tenants without a policy get the "default" one.
+#
+# Policy file (JSON):
+#   {"default": {"weight": 1},
+#    "supplier-bulk": {"weight": 0.5, "tokens_per_second": 200, "max_queued": 50}}
+
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+import json
+import threading
+import time
+
+# Priority classes, most urgent first
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+DEFAULT_TENANT = "default"
+
+
+class TenantPolicy(NamedTuple):
+    weight: float = 1.0
+    # Prompt + generated tokens per second; None means unlimited
+    tokens_per_second: Optional[float] = None
+    # Bucket size in tokens (default: 10 seconds' worth)
+    burst: Optional[float] = None
+    max_queued: Optional[int] = None
+
+
+def load_policies(path: Optional[str]) -> Dict[str, TenantPolicy]:
+    """Tenant policies from a JSON file mapping tenant id to TenantPolicy fields"""
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return {tenant: TenantPolicy(**fields) for tenant, fields in config.items()}
+
+
+def priority_rank(priority: Optional[str]) -> int:
+    """Index of a priority class; raises ValueError for unknown classes"""
+    if priority is None:
+        return 0
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+    return PRIORITIES.index(priority)
+
+
+class TokenBucket:
+    """Token-rate limiter that allows debt: a tenant may start a request while its level is positive"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * 10
+        self.level = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.burst, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until the level is positive again"""
+        self.refill(now)
+        return 0.0 if self.level > 0 else (-self.level + 1e-6) / self.rate
+
+
+class Tenant:
+    """Queues and counters of one tenant"""
+
+    def __init__(self, name: str, policy: TenantPolicy):
+        self.name = name
+        self.policy = policy
+        self.bucket = TokenBucket(policy.tokens_per_second, policy.burst) if policy.tokens_per_second else None
+        # Per priority class: (virtual start tag, item) in arrival order
+        self.queues: List[Deque[Tuple[float, Any]]] = [deque() for _ in PRIORITIES]
+        self.last_finish = [0.0] * len(PRIORITIES)
+        self.admitted = 0
+        self.rejected = 0
+        self.tokens = 0
+        self.preempted = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self.queues)
+
+
+class FairQueue:
+    """
+    Thread-safe queue of waiting requests: by priority class, then weighted-fair across tenants.
+
+    put() returns False when the tenant's queue cap is reached. get() returns the next item
+    whose tenant is not rate limited, or None when nothing is ready in time.
+    """
+
+    def __init__(self, policies: Optional[Dict[str, TenantPolicy]] = None):
+        self.policies = dict(policies or {})
+        self._tenants: Dict[str, Tenant] = {}
+        self._virtual_time = [0.0] * len(PRIORITIES)
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def tenant(self, name: Optional[str]) -> Tenant:
+        name = name or DEFAULT_TENANT
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            policy = self.policies.get(name) or self.policies.get(DEFAULT_TENANT) or TenantPolicy()
+            tenant = self._tenants[name] = Tenant(name, policy)
+        return tenant
+
+    def put(self, item, tenant: Optional[str] = None, priority: Optional[str] = None, cost: float = 1.0) -> bool:
+        rank = priority_rank(priority)
+        with self._cond:
+            state = self.tenant(tenant)
+            if state.policy.max_queued is not None and state.queued >= state.policy.max_queued:
+                state.rejected += 1
+                return False
+            # Start-time fair queueing: a tenant's tags advance by cost / weight per request
+            start = max(self._virtual_time[rank], state.last_finish[rank])
+            state.last_finish[rank] = start + cost / state.policy.weight
+            state.queues[rank].append((start, item))
+            self._size += 1
+            self._cond.notify()
+        return True
+
+    def requeue(self, item, tenant: Optional[str] = None, priority: Optional[str] = None, preempted: bool = True):
+        """Put a preempted (or not yet startable) item back at the head of its tenant's queue, ignoring the cap"""
+        rank = priority_rank(priority)
+        with self._cond:
+            state = self.tenant(tenant)
+            state.preempted += preempted
+            state.admitted -= 1
+            state.queues[rank].appendleft((self._virtual_time[rank], item))
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, timeout: Optional[float] = None):
+        """Next item to serve; blocks up to timeout (None: until one is ready or the queue is closed)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                item, wait = self._pop()
+                if item is not None:
+                    return item
+                if self._closed and not self._size:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # Wake up for new items, or when a rate-limited tenant's bucket refills
+                waits = [w for w in (remaining, wait) if w is not None]
+                self._cond.wait(min(waits) if waits else None)
+
+    def waiting_rank(self) -> Optional[int]:
+        """Most urgent priority class with a request ready to run, or None"""
+        now = time.monotonic()
+        with self._cond:
+            for rank in range(len(PRIORITIES)):
+                if any(t.queues[rank] and (t.bucket is None or t.bucket.ready_in(now) == 0)
+                       for t in self._tenants.values()):
+                    return rank
+        return None
+
+    def charge(self, tenant: Optional[str], tokens: int):
+        """Count tokens processed for a tenant against its rate limit"""
+        with self._cond:
+            state = self.tenant(tenant)
+            state.tokens += tokens
+            if state.bucket is not None:
+                state.bucket.refill(time.monotonic())
+                state.bucket.level -= tokens
+
+    def close(self):
+        """Let get() return None once the queue is empty"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._cond:
+            return {
+                name: {
+                    "queued": {priority: len(t.queues[rank]) for rank, priority in enumerate(PRIORITIES)},
+                    "admitted": t.admitted,
+                    "rejected": t.rejected,
+                    "preempted": t.preempted,
+                    "tokens": t.tokens,
+                    "weight": t.policy.weight,
+                    "rate_limited": t.bucket is not None and t.bucket.ready_in(now) > 0,
+                }
+                for name, t in self._tenants.items()
+            }
+
+    def _pop(self):
+        """(item, None), or (None, seconds until a rate-limited tenant may run again)"""
+        now = time.monotonic()
+        wait = None
+        for rank in range(len(PRIORITIES)):
+            best = None
+            for tenant in self._tenants.values():
+                queue = tenant.queues[rank]
+                if not queue:
+                    continue
+                if tenant.bucket is not None:
+                    ready_in = tenant.bucket.ready_in(now)
+                    if ready_in > 0:
+                        wait = ready_in if wait is None else min(wait, ready_in)
+                        continue
+                if best is None or queue[0][0] < best.queues[rank][0][0]:
+                    best = tenant
+            if best is not None:
+                start, item = best.queues[rank].popleft()
+                self._virtual_time[rank] = max(self._virtual_time[rank], start)
+                best.admitted += 1
+                self._size -= 1
+                return item, None
+        return None, wait
@@ -0,0 +1,139 @@
+# DeepSeek KV Cache Helpers
+# Converts between transformers cache objects and plain per-layer (key, value) tensors so the
+# serving code can pad, merge, slice and crop caches independently of the transformers version.
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+# One (key, value) pair per layer, each shaped [batch, heads, seq_len, head_dim]
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def cache_to_layers(past_key_values) -> KVLayers:
+    """Return the per-layer (key, value) tensors held by a cache object or legacy tuple"""
+    if past_key_values is None:
+        return []
+    if isinstance(past_key_values, (tuple, list)):
+        return [(k, v) for k, v in past_key_values]
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def layers_to_cache(layers: KVLayers) -> DynamicCache:
+    """Build a fresh DynamicCache holding the given per-layer tensors"""
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(layers):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def layers_seq_length(layers: KVLayers) -> int:
+    """Number of cached positions (including any padding)"""
+    return layers[0][0].shape[-2] if layers else 0
+
+
+def layers_nbytes(layers: KVLayers) -> int:
+    """Memory held by the cached tensors in bytes"""
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+def select_rows(layers: KVLayers, rows: Sequence[int]) -> KVLayers:
+    """Keep only the given batch rows"""
+    index = torch.tensor(rows, dtype=torch.long, device=layers[0][0].device)
+    return [(k.index_select(0, index), v.index_select(0, index)) for k, v in layers]
+
+
+def slice_positions(layers: KVLayers, start: int, end: Optional[int] = None) -> KVLayers:
+    """Keep cached positions [start, end) of every row"""
+    return [(k[:, :, start:end, :], v[:, :, start:end, :]) for k, v in layers]
+
+
+def left_pad(layers: KVLayers, length: int) -> KVLayers:
+    """Left-pad every layer with zeros along the sequence axis up to length"""
+    pad = length - layers_seq_length(layers)
+    if pad <= 0:
+        return layers
+    padded = []
+    for k, v in layers:
+        zeros = k.new_zeros(k.shape[0], k.shape[1], pad, k.shape[3])
+        padded.append((torch.cat([zeros, k], dim=2), torch.cat([zeros.clone(), v], dim=2)))
+    return padded
+
+
+def concat_rows(parts: Sequence[KVLayers]) -> KVLayers:
+    """Stack several left-aligned caches into one batch, left-padding to the longest"""
+    length = max(layers_seq_length(part) for part in parts)
+    parts = [left_pad(part, length) for part in parts]
+    return [
+        (torch.cat([part[i][0] for part in parts], dim=0), torch.cat([part[i][1] for part in parts], dim=0))
+        for i in range(len(parts[0]))
+    ]
+
+
+def clone_layers(layers: KVLayers) -> KVLayers:
+    """Deep copy, so a shared cache survives generate() appending to it"""
+    return [(k.clone(), v.clone()) for k, v in layers]
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    """Length of the shared leading run of two token id sequences"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache:
+    """
+    Precomputed KV state for fixed prompt prefixes (e.g. per-language system prompts).
+
+    DynamicCache appends by concatenation, so the cached tensors are never written to and
+    one entry can seed any number of requests without copying.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    @torch.no_grad()
+    def add(self, key, prefix_ids: Sequence[int]):
+        """Run prefill over prefix_ids once and keep the resulting KV state under key"""
+        input_ids = torch.tensor([list(prefix_ids)], dtype=torch.long, device=self.model.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        self._entries[key] = (tuple(prefix_ids), cache_to_layers(outputs.past_key_values))
+
+    def prefix_ids(self, key) -> Tuple[int, ...]:
+        return self._entries[key][0]
+
+    def lookup(self, key, input_ids: Sequence[int]):
+        """
+        Return (cache, prefix_length) for a prompt starting with the cached prefix, else (None, 0).
+
+        At least one prompt token is always left uncached so generation has something to feed.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            prefix_ids, layers = entry
+            if len(input_ids) > len(prefix_ids) and tuple(input_ids[:len(prefix_ids)]) == prefix_ids:
+                self.hits += 1
+                return layers_to_cache(layers), len(prefix_ids)
+        self.misses += 1
+        return None, 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes": sum(layers_nbytes(layers) for _, layers in self._entries.values()),
+        }
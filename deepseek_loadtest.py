@@ -0,0 +1,471 @@
+# DeepSeek Load Test
+# Replays a multilingual corpus of vendor questions against the chat endpoints or the server
+# script at a fixed concurrency or arrival rate, and reports latency percentiles,
+# time-to-first-token, output tokens/sec, error rate and peak RSS as diffable JSON.
+#
+# Without --model, --url or --daemon it builds a tiny random model and serves it in-process,
+# so it runs offline on a CPU box:
+#   python deepseek_loadtest.py --target web --concurrency 8 --requests 64 --output base.json
+#   python deepseek_loadtest.py --target web --rate 4 --requests 64 --compare base.json
+#   python deepseek_loadtest.py --url http://127.0.0.1:5000 --concurrency 16
+#
+# With --max-p95-regression, --max-throughput-drop or --max-error-rate it exits with status 1
+# when the run misses them, so it can gate a CI job:
+#   python deepseek_loadtest.py --compare base.json --max-p95-regression 10 --max-error-rate 0.01
+
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from deepseek_metrics import percentile
+
+# Vendor questions per language; requests cycle through them in a seeded shuffled order
+CORPUS = {
+    "english": [
+        "What is today's onion price?",
+        "How do I register as a supplier?",
+        "Which suppliers near Dadar deliver tomatoes today?",
+        "Where is my order?",
+        "Can I pay for my order on delivery?",
+        "What is the minimum order quantity for potatoes?",
+        "How do I change my delivery address?",
+        "Which supplier has the cheapest garlic this week?",
+    ],
+    "hindi": [
+        "आज प्याज का भाव क्या है?",
+        "मैं सप्लायर के रूप में कैसे रजिस्टर करूँ?",
+        "मेरा ऑर्डर कहाँ है?",
+        "क्या मैं डिलीवरी पर भुगतान कर सकता हूँ?",
+        "आलू का न्यूनतम ऑर्डर कितना है?",
+        "दादर के पास टमाटर कौन पहुँचाता है?",
+    ],
+    "marathi": [
+        "आज कांद्याचा भाव काय आहे?",
+        "मी पुरवठादार म्हणून नोंदणी कशी करू?",
+        "माझी ऑर्डर कुठे आहे?",
+        "मी डिलिव्हरीवर पैसे देऊ शकतो का?",
+        "बटाट्याची किमान ऑर्डर किती आहे?",
+        "दादरजवळ टोमॅटो कोण पोहोचवतो?",
+    ],
+    "gujarati": [
+        "આજે ડુંગળીનો ભાવ શું છે?",
+        "હું સપ્લાયર તરીકે કેવી રીતે નોંધણી કરું?",
+        "મારો ઓર્ડર ક્યાં છે?",
+        "શું હું ડિલિવરી પર ચુકવણી કરી શકું?",
+        "બટાકાનો ન્યૂનતમ ઓર્ડર કેટલો છે?",
+        "દાદર પાસે ટામેટાં કોણ પહોંચાડે છે?",
+    ],
+}
+
+
+def build_workload(count, seed=0):
+    """count (language, message) pairs interleaving all languages"""
+    rng = random.Random(seed)
+    pool = [(language, message) for language, messages in CORPUS.items() for message in messages]
+    workload = []
+    while len(workload) < count:
+        rng.shuffle(pool)
+        workload.extend(pool)
+    return workload[:count]
+
+
+def peak_rss_mb():
+    """Peak resident set of this process plus any waited-for children"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+    return round(max(own, children) * scale / 2 ** 20, 1)
+
+
+# ---------------------------------------------------------------------------
+# Targets: each send(language, message) returns a result dict for one request
+# ---------------------------------------------------------------------------
+
+def http_sender(url, timeout):
+    """POST to /api/chat/stream and time the server-sent events"""
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+
+    def send(language, message):
+        started = time.perf_counter()
+        result = {"language": language, "ok": False, "ttft": None, "tokens": 0}
+        connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+        try:
+            body = json.dumps({"message": message, "language": language}, ensure_ascii=False).encode("utf-8")
+            connection.request("POST", "/api/chat/stream", body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            if response.status != 200:
+                result["error"] = f"http {response.status}"
+                response.read()
+                return result
+            event = None
+            for raw in response:
+                line = raw.decode("utf-8").rstrip("\r\n")
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "token" and result["ttft"] is None:
+                        result["ttft"] = time.perf_counter() - started
+                    elif event == "error":
+                        result["error"] = data.get("error", "error event")
+                    elif event == "done":
+                        result["ok"] = "error" not in result
+                        result["tokens"] = data.get("usage", {}).get("completion_tokens", 0)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            connection.close()
+            result["latency"] = time.perf_counter() - started
+        return result
+
+    return send
+
+
+def daemon_sender(address, timeout):
+    """Stream requests through a running deepseek_server.py daemon"""
+    import deepseek_server
+
+    def send(language, message):
+        started = time.perf_counter()
+        result = {"language": language, "ok": False, "ttft": None, "tokens": 0}
+
+        def on_event(event):
+            if result["ttft"] is None:
+                result["ttft"] = time.perf_counter() - started
+
+        try:
+            reply = deepseek_server.request_daemon(
+                address, {"op": "generate", "message": message, "language": language, "stream": True},
+                timeout=timeout, on_event=on_event)
+            finish_server_result(result, reply, language)
+        except (OSError, ValueError, ConnectionError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["latency"] = time.perf_counter() - started
+        return result
+
+    return send
+
+
+def finish_server_result(result, reply, language):
+    """Fill a result from a daemon reply; generate_response signals failure with the error text"""
+    import deepseek_server
+
+    if not reply.get("ok"):
+        result["error"] = reply.get("error", "request failed")
+    elif reply.get("response") == deepseek_server.get_error_message(language):
+        result["error"] = "generation failed"
+    else:
+        result["ok"] = True
+        result["tokens"] = reply.get("usage", {}).get("completion_tokens", 0)
+
+
+def server_sender(timeout):
+    """Queue requests on an in-process InferenceWorker, the engine behind the daemon"""
+    import deepseek_server
+
+    worker = deepseek_server.InferenceWorker().start()
+    while not worker.ready:
+        if worker.load_failed:
+            raise RuntimeError("Model failed to load")
+        time.sleep(0.1)
+
+    def send(language, message):
+        started = time.perf_counter()
+        result = {"language": language, "ok": False, "ttft": None, "tokens": 0}
+        finished = threading.Event()
+
+        def reply(payload):
+            if "event" in payload:
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - started
+                return
+            finish_server_result(result, payload, language)
+            finished.set()
+
+        worker.submit({"id": None, "message": message, "language": language, "stream": True}, reply)
+        if not finished.wait(timeout):
+            result["error"] = "timeout"
+        result["latency"] = time.perf_counter() - started
+        return result
+
+    return send
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_web_app(args, model_path, use_async):
+    """Load the model into deepseek_web_app and serve it on a local port; returns the base URL"""
+    import deepseek_web_app as web
+
+    web.MODEL_NAME = model_path
+    web.MAX_BATCH_SIZE = args.max_batch_size
+    web.MAX_QUEUE_DEPTH = args.max_queue_depth
+    web.REQUEST_TIMEOUT = args.timeout
+    web.GENERATION_PARAMS["max_new_tokens"] = args.max_new_tokens
+    if args.allow_cache:
+        from deepseek_cache import ResponseCache
+        web.response_cache = ResponseCache(model_path, allow_sampled=True)
+    web.load_model_in_background()
+    if not web.model_loaded:
+        raise RuntimeError("Model failed to load")
+
+    port = free_port()
+    if use_async:
+        import uvicorn
+        import deepseek_async_app
+        server = uvicorn.Server(uvicorn.Config(deepseek_async_app.app, host="127.0.0.1", port=port,
+                                               log_level="warning"))
+        threading.Thread(target=server.run, daemon=True).start()
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log line per request
+        server = make_server("127.0.0.1", port, web.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return url
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Web app did not start listening")
+
+
+def make_sender(args):
+    if args.url:
+        return http_sender(args.url, args.timeout), args.url
+    if args.daemon:
+        return daemon_sender(args.daemon, args.timeout), args.daemon
+
+    model_path = args.model
+    if model_path is None:
+        from deepseek_tiny_model import create_tiny_model
+        model_path = create_tiny_model(os.path.join(args.scratch, "tiny-model"),
+                                       hidden_size=args.hidden_size, num_layers=args.layers)
+    if args.target == "server":
+        import deepseek_server
+        deepseek_server.MODEL_NAME = model_path
+        deepseek_server.GENERATION_PARAMS["max_new_tokens"] = args.max_new_tokens
+        if not args.allow_cache:
+            deepseek_server.response_cache = None
+        return server_sender(args.timeout), f"in-process server ({model_path})"
+    url = start_web_app(args, model_path, use_async=args.target == "async")
+    return http_sender(url, args.timeout), f"in-process {args.target} app ({model_path})"
+
+
+# ---------------------------------------------------------------------------
+# Load generation and reporting
+# ---------------------------------------------------------------------------
+
+def run_load(send, workload, concurrency, rate=None, seed=0):
+    """
+    Send the workload with at most `concurrency` requests in flight.
+
+    Without a rate every slot sends its next request as soon as the previous one finishes
+    (closed loop); with a rate requests arrive as a Poisson process of that many per second
+    (open loop) and latency includes any wait for a free slot.
+    """
+    results = []
+    lock = threading.Lock()
+    rng = random.Random(seed)
+
+    def timed(language, message, arrived):
+        waited = time.perf_counter() - arrived
+        result = send(language, message)
+        result["latency"] += waited
+        if result["ttft"] is not None:
+            result["ttft"] += waited
+        with lock:
+            results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        next_arrival = started
+        for language, message in workload:
+            if rate:
+                next_arrival += rng.expovariate(rate)
+                time.sleep(max(0.0, next_arrival - time.perf_counter()))
+            pool.submit(timed, language, message, time.perf_counter())
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    """Aggregate figures over a list of per-request results"""
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    tokens = sum(r["tokens"] for r in ok)
+
+    def ms(values, q):
+        return round(percentile(values, q) * 1000, 1) if values else None
+
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r.get("error", "unknown")] = errors.get(r.get("error", "unknown"), 0) + 1
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "latency_ms": {"p50": ms(latencies, 50), "p95": ms(latencies, 95), "p99": ms(latencies, 99),
+                       "mean": round(statistics.mean(latencies) * 1000, 1) if latencies else None},
+        "ttft_ms": {"p50": ms(ttfts, 50), "p95": ms(ttfts, 95), "p99": ms(ttfts, 99)},
+        "output_tokens": tokens,
+        "output_tokens_per_second": round(tokens / elapsed, 2) if elapsed else 0.0,
+        "requests_per_second": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+    }
+
+
+def compare(current, baseline):
+    """Print the change of the headline figures against a previous results file"""
+    rows = [
+        ("latency p50 ms", ("latency_ms", "p50")),
+        ("latency p95 ms", ("latency_ms", "p95")),
+        ("latency p99 ms", ("latency_ms", "p99")),
+        ("ttft p50 ms", ("ttft_ms", "p50")),
+        ("ttft p95 ms", ("ttft_ms", "p95")),
+        ("output tok/s", ("output_tokens_per_second",)),
+        ("error rate", ("error_rate",)),
+        ("peak RSS MB", ("peak_rss_mb",)),
+    ]
+
+    def lookup(summary, path):
+        for key in path:
+            summary = summary.get(key) if isinstance(summary, dict) else None
+        return summary
+
+    print(f"\n{'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for label, path in rows:
+        old, new = lookup(baseline["summary"], path), lookup(current["summary"], path)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "-"
+        print(f"{label:<16} {str(old):>10} {str(new):>10} {change:>8}")
+
+
+def check_thresholds(current, baseline, args):
+    """Messages for each threshold the run misses (empty when it passes)"""
+    failures = []
+    summary = current["summary"]
+    if args.max_error_rate is not None and summary["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {summary['error_rate']} is above {args.max_error_rate}")
+    if baseline is None:
+        return failures
+    old, new = baseline["summary"]["latency_ms"]["p95"], summary["latency_ms"]["p95"]
+    if args.max_p95_regression is not None and old:
+        if new is None:
+            failures.append("no request succeeded, so latency p95 could not be measured")
+        elif (new - old) / old * 100 > args.max_p95_regression:
+            failures.append(f"latency p95 rose {(new - old) / old * 100:.1f}% ({old} -> {new} ms), "
+                            f"more than {args.max_p95_regression}%")
+    old, new = baseline["summary"]["output_tokens_per_second"], summary["output_tokens_per_second"]
+    if args.max_throughput_drop is not None and old and (old - new) / old * 100 > args.max_throughput_drop:
+        failures.append(f"output tok/s fell {(old - new) / old * 100:.1f}% ({old} -> {new}), "
+                        f"more than {args.max_throughput_drop}%")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek-R1 load test")
+    parser.add_argument("--target", choices=["web", "async", "server"], default="web",
+                        help="In-process target: Flask app, async app, or the daemon's inference worker")
+    parser.add_argument("--url", type=str, default=None, help="Load-test a running web app instead")
+    parser.add_argument("--daemon", type=str, default=None, help="Load-test a running deepseek_server.py daemon")
+    parser.add_argument("--model", type=str, default=None,
+                        help="Model for in-process targets (default: a tiny random model)")
+    parser.add_argument("--hidden-size", type=int, default=128, help="Hidden size of the tiny model")
+    parser.add_argument("--layers", type=int, default=2, help="Layers of the tiny model")
+    parser.add_argument("--requests", type=int, default=64, help="Requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Poisson arrival rate in requests/sec (default: closed loop)")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="Tokens generated per request")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Batch size of in-process web targets")
+    parser.add_argument("--max-queue-depth", type=int, default=1024, help="Queue depth of in-process web targets")
+    parser.add_argument("--allow-cache", action="store_true",
+                        help="Let repeated prompts be answered from the response cache")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests sent first")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for workload order and arrivals")
+    parser.add_argument("--output", type=str, default=None, help="Write machine-readable results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Results file to compare against")
+    parser.add_argument("--max-p95-regression", type=float, default=None, metavar="PERCENT",
+                        help="With --compare, fail if latency p95 rises more than this many percent")
+    parser.add_argument("--max-throughput-drop", type=float, default=None, metavar="PERCENT",
+                        help="With --compare, fail if output tokens/sec falls more than this many percent")
+    parser.add_argument("--max-error-rate", type=float, default=None, metavar="RATE",
+                        help="Fail if more than this share of requests (0-1) fails")
+    args = parser.parse_args()
+    # The tiny model of in-process targets; removed before exiting
+    scratch = tempfile.TemporaryDirectory(prefix="deepseek-loadtest-")
+    args.scratch = scratch.name
+    if (args.max_p95_regression is not None or args.max_throughput_drop is not None) and not args.compare:
+        parser.error("--max-p95-regression and --max-throughput-drop need --compare")
+
+    send, target = make_sender(args)
+    for language, message in build_workload(args.warmup, seed=args.seed + 1):
+        send(language, message)
+
+    workload = build_workload(args.requests, seed=args.seed)
+    print(f"Sending {len(workload)} requests to {target} "
+          f"({'rate %.2f/s' % args.rate if args.rate else 'closed loop'}, concurrency {args.concurrency})")
+    results, elapsed = run_load(send, workload, args.concurrency, rate=args.rate, seed=args.seed)
+
+    summary = summarize(results, elapsed)
+    summary["duration_s"] = round(elapsed, 3)
+    summary["peak_rss_mb"] = peak_rss_mb()
+    report = {
+        "config": {
+            "target": args.url or args.daemon or args.target,
+            "model": args.model or f"tiny(hidden={args.hidden_size}, layers={args.layers})",
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "max_new_tokens": args.max_new_tokens,
+            "seed": args.seed,
+        },
+        "summary": summary,
+        "per_language": {
+            language: summarize([r for r in results if r["language"] == language], elapsed)
+            for language in CORPUS
+        },
+    }
+
+    print(json.dumps(report["summary"], indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"Results written to {args.output}")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        compare(report, baseline)
+    failures = check_thresholds(report, baseline, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.stdout.flush()
+    scratch.cleanup()
+    os._exit(1 if failures else 0)  # in-process servers run on daemon threads that never return
+
+
+if __name__ == "__main__":
+    main()
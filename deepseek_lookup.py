@@ -0,0 +1,503 @@
+# DeepSeek Lookup Fast Path
+# Much of the assistant's traffic is catalogue lookups: what onions cost today, who supplies
+# tomatoes in Dadar, where order BB1024 is. Those answers are already in our data, so a
+# 500-token generation only makes them slower and sometimes wrong. Before generation, the fast
+# path looks for a lookup intent (price, supplier, order status, FAQ) in English, Hindi, Marathi
+# or Gujarati, finds the products, areas and orders named in the message through an in-memory
+# inverted index over a local catalogue file, and answers from a per-language template.
+# Messages it is unsure about (long ones, ones that need reasoning, ones naming nothing in the
+# catalogue) are declined and generated as before. The file is re-read when it changes on disk.
+#
+# Catalogue file (JSON); names and other text fields are a string or a {language: text} map,
+# and "aliases" may list spellings and inflected stems (कांद्या, ડુંગળી) matched as word prefixes:
+#   {"products": [{"id": "onion", "name": {"english": "Onion", "hindi": "प्याज"},
+#                  "aliases": ["kanda", "कांद्या"], "price": 32, "unit": {"english": "kg", "hindi": "किलो"}}],
+#    "suppliers": [{"name": "Sharma Traders", "area": {"english": "Dadar", "marathi": "दादर"},
+#                   "products": ["onion"], "phone": "98200 00000"}],
+#    "orders": [{"id": "BB1024", "status": "out_for_delivery", "eta": {"english": "today, 6 pm"}}],
+#    "faq": [{"question": {"english": "How do I register as a supplier?"},
+#             "answer": {"english": "Open Supplier Registration from the menu ..."}}],
+#    "max_words": 16, "faq_threshold": 0.6, "templates": {"english": {"price": "..."}}}
+
+from collections import Counter, defaultdict, deque
+from typing import Any, Deque, Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Set, Tuple
+import json
+import logging
+import math
+import os
+import re
+import string
+import threading
+import time
+
+from deepseek_cache import normalize_message
+from deepseek_metrics import percentile
+from deepseek_routing import HARD_KEYWORDS
+
+logger = logging.getLogger(__name__)
+
+# Intents answered without generation
+INTENTS = ("price", "supplier", "order", "faq")
+
+# Longest message, in words, the fast path answers; longer ones usually need the model
+MAX_WORDS = 16
+# Share of an FAQ question's (IDF-weighted) words a message must match to get its answer
+FAQ_THRESHOLD = 0.6
+# Suppliers or prices listed in one answer
+MAX_RESULTS = 3
+# Shortest index term matched as a prefix of a longer word (inflections, postpositions)
+MIN_STEM = 3
+# Seconds between checks of the catalogue file for changes
+CHECK_INTERVAL = 2.0
+# Recent lookup latencies kept for percentiles
+LATENCY_WINDOW = 1000
+
+# Words that mark each intent; phrases match anywhere in the message, single words whole.
+# Romanised Hindi (bhav, kitne) is common in every language's messages, so all lists are used
+INTENT_KEYWORDS = {
+    "price": {
+        "english": ("price", "prices", "rate", "rates", "cost", "how much", "bhav", "bhaav", "daam", "kitne"),
+        "hindi": ("भाव", "दाम", "कीमत", "रेट", "कितने का", "कितने की"),
+        "marathi": ("भाव", "किंमत", "दर", "रेट", "किती रुपये"),
+        "gujarati": ("ભાવ", "કિંમત", "રેટ", "કેટલા રૂપિયા"),
+    },
+    "supplier": {
+        "english": ("supplier", "suppliers", "seller", "sellers", "vendor", "vendors", "wholesaler",
+                    "wholesalers", "who sells", "where can i buy", "where to buy"),
+        "hindi": ("सप्लायर", "विक्रेता", "थोक", "कौन बेचता", "कहाँ मिलेगा", "कहां मिलेगा"),
+        "marathi": ("पुरवठादार", "सप्लायर", "विक्रेता", "घाऊक", "कुठे मिळेल"),
+        "gujarati": ("સપ્લાયર", "વેપારી", "વિક્રેતા", "જથ્થાબંધ", "ક્યાં મળશે"),
+    },
+    "order": {
+        "english": ("order", "orders", "delivery", "track", "status"),
+        "hindi": ("ऑर्डर", "आर्डर", "डिलीवरी", "स्थिति"),
+        "marathi": ("ऑर्डर", "डिलिव्हरी", "स्थिती"),
+        "gujarati": ("ઓર્ડર", "ડિલિવરી", "સ્થિતિ"),
+    },
+}
+
+# Words that make a message more than a lookup of today's data, by the reason it is declined
+# for: another time than now, a negation or complaint, or a request to do or write something.
+# Like the intent keywords, every language's list is checked (without the nukta, see tokenize)
+DECLINE_KEYWORDS = {
+    "time": {
+        "english": ("yesterday", "tomorrow", "last week", "last month", "last year", "next week", "next month",
+                    "next year", "ago", "previous", "earlier", "history", "trend", "forecast", "predict",
+                    "future", "used to", "kal", "parso"),
+        "hindi": ("कल", "परसों", "पिछले", "पिछली", "पिछला", "अगले", "अगली", "अगला", "पहले", "था", "थी", "थे"),
+        "marathi": ("काल", "उद्या", "परवा", "मागील", "मागच्या", "मागचा", "पुढील", "पुढच्या", "पूर्वी", "होता",
+                    "होती"),
+        "gujarati": ("ગઈકાલે", "કાલે", "આવતીકાલે", "ગયા", "ગયે", "આવતા", "આવતી", "પહેલા", "હતો", "હતી",
+                     "હતું", "હતા"),
+    },
+    "negation": {
+        "english": ("not", "don't", "dont", "doesn't", "doesnt", "isn't", "isnt", "didn't", "didnt", "never",
+                    "without", "too high", "too much", "too expensive", "expensive", "costly", "nahi", "nahin"),
+        "hindi": ("नहीं", "नही", "मत", "बिना", "महंगा", "महँगा", "महंगी", "बहुत ज्यादा"),
+        "marathi": ("नाही", "नको", "नका", "महाग", "खूप जास्त"),
+        "gujarati": ("નથી", "નહીં", "નહિ", "વગર", "મોંઘો", "મોંઘું", "મોંઘા", "મોંઘી", "બહુ વધારે"),
+    },
+    "request": {
+        "english": ("write", "poem", "story", "song", "joke", "essay", "translate", "summarise", "summarize",
+                    "lower", "reduce", "increase", "change", "cancel", "negotiate", "discount", "complain",
+                    "complaint"),
+        "hindi": ("लिखो", "लिखिए", "लिखें", "कविता", "कहानी", "गाना", "चुटकुला", "कम करो", "कम कीजिए",
+                  "कम करें", "बढाओ", "बदलो", "रद्द", "मोलभाव", "छूट", "शिकायत"),
+        "marathi": ("लिहा", "कविता", "गोष्ट", "गाणे", "विनोद", "कमी करा", "वाढवा", "बदला", "रद्द", "सवलत",
+                    "तक्रार"),
+        "gujarati": ("લખો", "કવિતા", "વાર્તા", "ગીત", "ટુચકો", "ઓછો કરો", "ઓછું કરો", "ઓછા કરો", "વધારો",
+                     "બદલો", "રદ", "છૂટ", "ફરિયાદ"),
+    },
+}
+
+# Words an FAQ question may leave out of a message that still gets its answer: a message word
+# outside the question that is not one of these ("unregister" against "register") declines it
+STOP_WORDS = frozenset((
+    "a", "an", "the", "i", "me", "my", "we", "our", "you", "your", "it", "this", "that", "is", "are", "am",
+    "be", "do", "does", "can", "could", "how", "what", "which", "where", "when", "who", "to", "as", "of",
+    "for", "in", "on", "at", "with", "from", "by", "about", "and", "or", "any", "there", "please", "tell",
+    "kaise", "kya", "hai", "ka", "ki", "ke",
+    "मैं", "मुझे", "मेरा", "मेरी", "मेरे", "आप", "आपका", "आपकी", "कैसे", "क्या", "कब", "कहाँ", "कहां", "कौन",
+    "का", "की", "के", "को", "में", "से", "पर", "है", "हैं", "हो", "कर", "करूँ", "करूं", "करें", "सकता",
+    "सकती", "सकते", "और", "या", "भी", "तो", "जी", "कृपया", "बताइए", "बताओ",
+    "मी", "मला", "माझा", "माझी", "माझे", "तुम्ही", "तुमचा", "तुमची", "कसे", "कसा", "कशी", "काय", "कधी",
+    "कुठे", "कोण", "चा", "ची", "चे", "ला", "मध्ये", "आहे", "आहेत", "करू", "करा", "शकतो", "शकते", "आणि",
+    "किंवा", "पण", "सांगा",
+    "હું", "મને", "મારો", "મારી", "મારું", "તમે", "તમારો", "તમારી", "કેવી", "રીતે", "શું", "ક્યારે", "ક્યાં",
+    "કોણ", "નો", "ની", "નું", "ના", "ને", "માં", "થી", "છે", "છું", "કરું", "કરો", "શકું", "અને", "અથવા", "પણ",
+    "કૃપા", "કરીને", "કહો",
+))
+
+# Answer templates by language; unknown languages get English. A catalogue file may override them
+TEMPLATES = {
+    "english": {
+        "price": "Current price: {items}.",
+        "price_item": "{name} ₹{price}/{unit}",
+        "supplier_area_product": "Suppliers of {product} in {area}: {items}.",
+        "supplier_area": "Suppliers in {area}: {items}.",
+        "supplier_product": "Suppliers of {product}: {items}.",
+        "supplier_none": "No supplier is listed for that yet.",
+        "order": "Order {id} is {status}.",
+        "order_eta": "Order {id} is {status}, expected {eta}.",
+        "order_unknown": "I could not find order {id}. Please check the order number.",
+    },
+    "hindi": {
+        "price": "मौजूदा भाव: {items}।",
+        "price_item": "{name} ₹{price}/{unit}",
+        "supplier_area_product": "{area} में {product} के सप्लायर: {items}।",
+        "supplier_area": "{area} में सप्लायर: {items}।",
+        "supplier_product": "{product} के सप्लायर: {items}।",
+        "supplier_none": "इसके लिए अभी कोई सप्लायर सूचीबद्ध नहीं है।",
+        "order": "ऑर्डर {id} की स्थिति: {status}।",
+        "order_eta": "ऑर्डर {id} की स्थिति: {status}, अपेक्षित {eta}।",
+        "order_unknown": "ऑर्डर {id} नहीं मिला। कृपया ऑर्डर नंबर जाँचें।",
+    },
+    "marathi": {
+        "price": "सध्याचा भाव: {items}.",
+        "price_item": "{name} ₹{price}/{unit}",
+        "supplier_area_product": "{area} मधील {product} पुरवठादार: {items}.",
+        "supplier_area": "{area} मधील पुरवठादार: {items}.",
+        "supplier_product": "{product} पुरवठादार: {items}.",
+        "supplier_none": "यासाठी अद्याप कोणताही पुरवठादार नोंदलेला नाही.",
+        "order": "ऑर्डर {id} ची स्थिती: {status}.",
+        "order_eta": "ऑर्डर {id} ची स्थिती: {status}, अपेक्षित {eta}.",
+        "order_unknown": "ऑर्डर {id} सापडली नाही. कृपया ऑर्डर क्रमांक तपासा.",
+    },
+    "gujarati": {
+        "price": "હાલનો ભાવ: {items}.",
+        "price_item": "{name} ₹{price}/{unit}",
+        "supplier_area_product": "{area}માં {product}ના સપ્લાયર: {items}.",
+        "supplier_area": "{area}માં સપ્લાયર: {items}.",
+        "supplier_product": "{product}ના સપ્લાયર: {items}.",
+        "supplier_none": "આ માટે હજી કોઈ સપ્લાયર નોંધાયેલ નથી.",
+        "order": "ઓર્ડર {id} ની સ્થિતિ: {status}.",
+        "order_eta": "ઓર્ડર {id} ની સ્થિતિ: {status}, અપેક્ષિત {eta}.",
+        "order_unknown": "ઓર્ડર {id} મળ્યો નથી. કૃપા કરીને ઓર્ડર નંબર તપાસો.",
+    },
+}
+
+# Order status codes as shown to the vendor
+STATUS_LABELS = {
+    "english": {"placed": "placed", "confirmed": "confirmed", "packed": "packed",
+                "out_for_delivery": "out for delivery", "delivered": "delivered", "cancelled": "cancelled"},
+    "hindi": {"placed": "प्राप्त हुआ", "confirmed": "पुष्टि हुई", "packed": "पैक हुआ",
+              "out_for_delivery": "डिलीवरी के लिए निकला", "delivered": "डिलीवर हुआ", "cancelled": "रद्द"},
+    "marathi": {"placed": "मिळाली", "confirmed": "निश्चित", "packed": "पॅक झाली",
+                "out_for_delivery": "डिलिव्हरीसाठी निघाली", "delivered": "पोहोचली", "cancelled": "रद्द"},
+    "gujarati": {"placed": "મળ્યો", "confirmed": "પુષ્ટિ થઈ", "packed": "પેક થયો",
+                 "out_for_delivery": "ડિલિવરી માટે નીકળ્યો", "delivered": "પહોંચી ગયો", "cancelled": "રદ"},
+}
+
+PUNCTUATION = string.punctuation + "।॥“”‘’…"
+# Words shaped like an order number (BB1024, bb-1024)
+ORDER_ID = re.compile(r"^[a-z]{1,4}-?\d{3,}$")
+
+
+def tokenize(text: str) -> List[str]:
+    """Words of a normalised message, without punctuation or the Devanagari nukta (फ़ = फ)"""
+    words = (word.strip(PUNCTUATION).replace("\u093c", "") for word in normalize_message(text).split())
+    return [word for word in words if word]
+
+
+def localized(value: Any, language: str) -> str:
+    """A catalogue text field in the given language, falling back to English, then any language"""
+    if isinstance(value, dict):
+        value = value.get(language) or value.get("english") or next(iter(value.values()), "")
+    return str(value)
+
+
+def variants(value: Any) -> List[str]:
+    """Every spelling of a catalogue text field"""
+    return [str(v) for v in value.values()] if isinstance(value, dict) else [str(value)]
+
+
+def has_keyword(text: str, words: Set[str], keywords: Sequence[str]) -> bool:
+    return any((keyword in text) if " " in keyword else (keyword in words) for keyword in keywords)
+
+
+class LookupResult(NamedTuple):
+    # The answer, or None when the message is left to the model
+    answer: Optional[str]
+    intent: Optional[str]
+    # Why the message was declined (length, reasoning, arithmetic, time, negation, request,
+    # no_match, no_intent)
+    reason: Optional[str]
+    seconds: float
+
+
+class CatalogueIndex:
+    """Inverted index from words to the products, areas, orders and FAQ entries they name"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.products = data.get("products", [])
+        self.suppliers = data.get("suppliers", [])
+        self.orders = {str(order["id"]).casefold(): order for order in data.get("orders", [])}
+        self.faq = data.get("faq", [])
+        self.max_words = data.get("max_words", MAX_WORDS)
+        self.faq_threshold = data.get("faq_threshold", FAQ_THRESHOLD)
+        self.templates = {language: {**TEMPLATES.get(language, TEMPLATES["english"]), **overrides}
+                          for language, overrides in data.get("templates", {}).items()}
+
+        # Entity names: term -> names containing it; a name matches once all its terms do
+        self._names: List[Tuple[str, Any, int]] = []
+        self._name_terms: Dict[str, Set[int]] = defaultdict(set)
+        self.areas: Dict[str, Any] = {}
+        for product in self.products:
+            for name in variants(product.get("name", product["id"])) + [product["id"]] + product.get("aliases", []):
+                self._add_name("product", product["id"], name)
+        for supplier in self.suppliers:
+            area = supplier.get("area")
+            if area is None:
+                continue
+            key = localized(area, "english").casefold()
+            self.areas.setdefault(key, area)
+            for name in variants(area) + supplier.get("area_aliases", []):
+                self._add_name("area", key, name)
+        self._stems = {term for term in self._name_terms if len(term) >= MIN_STEM}
+
+        # FAQ questions, one document per language, with inverse document frequencies for scoring
+        self._faq_docs: List[int] = []
+        self._faq_terms: Dict[str, Set[int]] = defaultdict(set)
+        self._doc_words: List[Set[str]] = []
+        for index, entry in enumerate(self.faq):
+            for question in variants(entry["question"]):
+                words = set(tokenize(question))
+                for word in words:
+                    self._faq_terms[word].add(len(self._faq_docs))
+                self._faq_docs.append(index)
+                self._doc_words.append(words)
+        self._idf = {word: self._weight(len(docs)) for word, docs in self._faq_terms.items()}
+        self._doc_weights = [sum(self._idf[word] for word in words) for words in self._doc_words]
+
+    def _add_name(self, kind: str, key: Any, name: str):
+        terms = tokenize(name)
+        if not terms:
+            return
+        self._names.append((kind, key, len(set(terms))))
+        for term in set(terms):
+            self._name_terms[term].add(len(self._names) - 1)
+
+    def _weight(self, document_frequency: int) -> float:
+        return math.log((len(self._faq_docs) + 1) / (document_frequency + 1)) + 1.0
+
+    def _term(self, word: str) -> Optional[str]:
+        """The index term a message word matches: itself, or its longest indexed stem"""
+        if word in self._name_terms:
+            return word
+        for end in range(len(word) - 1, MIN_STEM - 1, -1):
+            if word[:end] in self._stems:
+                return word[:end]
+        return None
+
+    def entities(self, words: Sequence[str]) -> Dict[str, List[Any]]:
+        """Products and areas named in a message, in order of first mention"""
+        matched: Counter = Counter()
+        for term in dict.fromkeys(filter(None, map(self._term, words))):
+            for name in self._name_terms[term]:
+                matched[name] += 1
+        found: Dict[str, List[Any]] = {"product": [], "area": []}
+        for name, count in matched.items():
+            kind, key, size = self._names[name]
+            if count == size and key not in found[kind]:
+                found[kind].append(key)
+        return found
+
+    def best_faq(self, words: Sequence[str]) -> Tuple[Optional[int], float]:
+        """
+        The FAQ entry sharing the most weight with the message, and its Dice score. Only questions
+        containing every message word but stop-words are considered.
+        """
+        words = set(words)
+        scores: Dict[int, float] = defaultdict(float)
+        for word in words:
+            for doc in self._faq_terms.get(word, ()):
+                scores[doc] += self._idf[word]
+        scores = {doc: score for doc, score in scores.items() if words - self._doc_words[doc] <= STOP_WORDS}
+        if not scores:
+            return None, 0.0
+        query_weight = sum(self._idf.get(word, self._weight(0)) for word in words)
+        doc = max(scores, key=lambda doc: scores[doc] / (query_weight + self._doc_weights[doc]))
+        return self._faq_docs[doc], 2 * scores[doc] / (query_weight + self._doc_weights[doc])
+
+    def product(self, product_id: str) -> Dict[str, Any]:
+        return next(product for product in self.products if product["id"] == product_id)
+
+    def template(self, language: str, name: str) -> str:
+        templates = self.templates.get(language) or TEMPLATES.get(language) or TEMPLATES["english"]
+        return templates[name]
+
+
+def load_catalogue(path: str) -> CatalogueIndex:
+    with open(path, encoding="utf-8") as f:
+        return CatalogueIndex(json.load(f))
+
+
+class LookupFastPath:
+    """
+    Answers catalogue lookups from the index, and keeps hit rate and latency figures.
+
+    The catalogue file is checked for changes at most every check_interval seconds, from the
+    lookup that comes due; a file that fails to load leaves the previous index in place.
+    """
+
+    def __init__(self, path: str, check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.index = load_catalogue(path)
+        self._signature = self._stat()
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.intents: Counter = Counter()
+        self.declined: Counter = Counter()
+        self.reloads = 0
+        self.reload_errors = 0
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def lookup(self, message: str, language: str = "english") -> LookupResult:
+        """Answer a lookup message, or decline it (answer None) so it is generated"""
+        started = time.perf_counter()
+        self._refresh()
+        answer, intent, reason = self._answer(self.index, message, language.lower())
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.lookups += 1
+            if answer is not None:
+                self.intents[intent] += 1
+            else:
+                self.declined[reason] += 1
+            self._latencies.append(seconds)
+        return LookupResult(answer, intent, reason, seconds)
+
+    def names(self, message: str) -> FrozenSet[str]:
+        """The catalogue products and areas and the order numbers a message names"""
+        words = tokenize(message)
+        found = self.index.entities(words)
+        return frozenset([f"{kind}:{key}" for kind, keys in found.items() for key in keys]
+                         + [f"order:{word.replace('-', '')}" for word in words if ORDER_ID.match(word)])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = self._latencies
+            hits = sum(self.intents.values())
+            return {
+                "lookups": self.lookups,
+                "hits": hits,
+                "hit_rate": hits / self.lookups if self.lookups else 0.0,
+                "intents": dict(self.intents),
+                "declined": dict(self.declined),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 4),
+                "products": len(self.index.products),
+                "suppliers": len(self.index.suppliers),
+                "orders": len(self.index.orders),
+                "faq": len(self.index.faq),
+                "reloads": self.reloads,
+                "reload_errors": self.reload_errors,
+            }
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return
+        try:
+            index = load_catalogue(self.path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Keeping the previous lookup catalogue, {self.path} failed to load: {e}")
+            with self._lock:
+                self._signature = signature
+                self.reload_errors += 1
+            return
+        with self._lock:
+            self.index, self._signature = index, signature
+            self.reloads += 1
+
+    def _answer(self, index: CatalogueIndex, message: str,
+                language: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        words = tokenize(message)
+        text = " ".join(words)
+        if len(words) > index.max_words:
+            return None, None, "length"
+        word_set = set(words)
+        if any(has_keyword(text, word_set, keywords) for keywords in HARD_KEYWORDS.values()):
+            return None, None, "reasoning"
+        if sum(any(c.isdigit() for c in word) for word in words) >= 2:
+            return None, None, "arithmetic"
+        for reason, keywords in DECLINE_KEYWORDS.items():
+            if any(has_keyword(text, word_set, words) for words in keywords.values()):
+                return None, None, reason
+
+        # Keywords of every language: vendors mix English words into Hindi, Marathi and Gujarati
+        intents = {intent for intent, keywords in INTENT_KEYWORDS.items()
+                   if any(has_keyword(text, word_set, words) for words in keywords.values())}
+        order_ids = [word.replace("-", "") for word in words if ORDER_ID.match(word)]
+        if order_ids and ("order" in intents or order_ids[0] in index.orders):
+            return self._order(index, order_ids[0], language), "order", None
+
+        found = index.entities(words)
+        if "price" in intents and found["product"]:
+            return self._price(index, found["product"], language), "price", None
+        if (found["area"] or found["product"]) and ("supplier" in intents or (found["area"] and found["product"])):
+            return self._suppliers(index, found, language), "supplier", None
+
+        if index.faq:
+            entry, score = index.best_faq(words)
+            if entry is not None and score >= index.faq_threshold:
+                answer = index.faq[entry]["answer"]
+                # An answer in the wrong language is worse than a generated one
+                if not isinstance(answer, dict) or language in answer:
+                    return localized(answer, language), "faq", None
+        return None, None, "no_match" if intents else "no_intent"
+
+    def _price(self, index: CatalogueIndex, product_ids: List[str], language: str) -> str:
+        items = []
+        for product_id in product_ids[:MAX_RESULTS]:
+            product = index.product(product_id)
+            price = product.get("price")
+            items.append(index.template(language, "price_item").format(
+                name=localized(product.get("name", product_id), language),
+                price=f"{price:g}" if isinstance(price, (int, float)) else price,
+                unit=localized(product.get("unit", "kg"), language),
+            ))
+        return index.template(language, "price").format(items="; ".join(items))
+
+    def _suppliers(self, index: CatalogueIndex, found: Dict[str, List[Any]], language: str) -> str:
+        areas, products = found["area"], found["product"]
+        matches = [supplier for supplier in index.suppliers
+                   if (not areas or localized(supplier.get("area", ""), "english").casefold() in areas)
+                   and (not products or any(p in supplier.get("products", ()) for p in products))]
+        if not matches:
+            return index.template(language, "supplier_none")
+        items = ", ".join(f"{supplier['name']} ({supplier['phone']})" if supplier.get("phone") else supplier["name"]
+                          for supplier in matches[:MAX_RESULTS])
+        fields = {"items": items}
+        if areas:
+            fields["area"] = localized(index.areas[areas[0]], language)
+        if products:
+            fields["product"] = localized(index.product(products[0]).get("name", products[0]), language)
+        name = "supplier_" + "_".join(part for part in ("area", "product") if part in fields)
+        return index.template(language, name).format(**fields)
+
+    def _order(self, index: CatalogueIndex, order_id: str, language: str) -> str:
+        order = index.orders.get(order_id)
+        if order is None:
+            return index.template(language, "order_unknown").format(id=order_id.upper())
+        labels = STATUS_LABELS.get(language, STATUS_LABELS["english"])
+        status = labels.get(order.get("status"), str(order.get("status", "")).replace("_", " "))
+        fields = {"id": order["id"], "status": status}
+        if order.get("eta"):
+            fields["eta"] = localized(order["eta"], language)
+        return index.template(language, "order_eta" if "eta" in fields else "order").format(**fields)
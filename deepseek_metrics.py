@@ -0,0 +1,276 @@
+# DeepSeek Inference Metrics
+# Per-request stage timings (chat template, queue wait, prefill, decode, detokenize), token
+# counts and throughput aggregated into Prometheus histograms, plus gauges sampled at scrape
+# time. Recording a request is a handful of bisects and additions under one lock, so it is
+# cheap enough to leave on in production.
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+import os
+import threading
+import time
+
+from deepseek_fairness import DEFAULT_TENANT, INTERACTIVE
+
+# Pipeline stages every request is broken into (stages that do not apply are left out)
+STAGES = ("template", "queue", "prefill", "decode", "detokenize")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Lookup fast-path answers take microseconds, well below LATENCY_BUCKETS
+LOOKUP_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    """q-th percentile (0-100) of values with linear interpolation, as numpy.percentile; 0.0 if empty"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # Per label set: [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], Optional[float]]):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def samples(self) -> Iterable[str]:
+        try:
+            value = self.read()
+        except Exception:
+            value = None
+        if value is not None:
+            yield f"{self.name} {_format_value(value)}"
+
+
+def process_resident_bytes() -> Optional[int]:
+    """Current RSS from /proc (Linux), else the peak RSS reported by getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cuda_allocated_bytes() -> Optional[int]:
+    """Bytes allocated on the current CUDA device, if torch is loaded and CUDA is in use"""
+    import sys
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.memory_allocated()
+
+
+class InferenceMetrics:
+    """The request metrics shared by the web app and the server daemon"""
+
+    def __init__(self, prefix: str = "deepseek"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = Counter(f"{prefix}_requests_total", "Chat requests by outcome")
+        self.stage_seconds = Histogram(f"{prefix}_stage_seconds", "Time spent per request in each stage",
+                                       LATENCY_BUCKETS)
+        self.request_seconds = Histogram(f"{prefix}_request_seconds", "End-to-end request latency",
+                                         LATENCY_BUCKETS)
+        self.prompt_tokens = Histogram(f"{prefix}_prompt_tokens", "Prompt length in tokens", TOKEN_BUCKETS)
+        self.output_tokens = Histogram(f"{prefix}_output_tokens", "Generated tokens per request", TOKEN_BUCKETS)
+        self.tokens_per_second = Histogram(f"{prefix}_decode_tokens_per_second",
+                                           "Decode throughput per request", RATE_BUCKETS)
+        self.tokens_saved = Counter(f"{prefix}_tokens_saved_total",
+                                    "Decode tokens not generated because the request was cancelled or late")
+        self.reasoning_tokens = Histogram(f"{prefix}_reasoning_tokens",
+                                          "Tokens generated inside the <think> section per request", TOKEN_BUCKETS)
+        self.answer_tokens = Histogram(f"{prefix}_answer_tokens",
+                                       "Tokens generated after the <think> section per request", TOKEN_BUCKETS)
+        self.budget_exhausted = Counter(f"{prefix}_thinking_budget_exhausted_total",
+                                        "Requests whose reasoning was closed at the thinking budget")
+        self.tenant_queue_seconds = Histogram(f"{prefix}_tenant_queue_seconds",
+                                              "Time requests waited for a decode slot, per tenant and priority",
+                                              LATENCY_BUCKETS)
+        self.tenant_tokens = Counter(f"{prefix}_tenant_tokens_total",
+                                     "Prompt and generated tokens processed, per tenant and priority")
+        self.preemptions = Counter(f"{prefix}_preemptions_total",
+                                   "Times a running request gave its slot to a more urgent one, per tenant")
+        self.uncompacted_prompt_tokens = Histogram(f"{prefix}_uncompacted_prompt_tokens",
+                                                   "Estimated prompt length of conversations that were compacted",
+                                                   TOKEN_BUCKETS)
+        self.compactions = Counter(f"{prefix}_context_compactions_total",
+                                   "Requests whose conversation history was trimmed or summarised")
+        self.tier_seconds = Histogram(f"{prefix}_tier_request_seconds",
+                                      "Latency of requests answered by each model tier, including escalation",
+                                      LATENCY_BUCKETS)
+        self.tier_requests = Counter(f"{prefix}_tier_requests_total",
+                                     "Requests answered per model tier, and whether a smaller tier was tried first")
+        self.lookup_seconds = Histogram(f"{prefix}_lookup_seconds",
+                                        "Time the lookup fast path took, answered or declined", LOOKUP_BUCKETS)
+        self.lookups = Counter(f"{prefix}_lookups_total",
+                               "Messages checked by the lookup fast path, by intent answered or reason declined")
+        self._metrics = [self.requests, self.stage_seconds, self.request_seconds, self.prompt_tokens,
+                         self.output_tokens, self.tokens_per_second, self.tokens_saved, self.reasoning_tokens,
+                         self.answer_tokens, self.budget_exhausted, self.tenant_queue_seconds, self.tenant_tokens,
+                         self.preemptions, self.uncompacted_prompt_tokens, self.compactions, self.tier_seconds,
+                         self.tier_requests, self.lookup_seconds, self.lookups]
+        self.gauge("process_resident_memory_bytes", "Resident memory of this process", process_resident_bytes)
+        self.gauge("cuda_memory_allocated_bytes", "Memory allocated on the CUDA device", cuda_allocated_bytes)
+        self.gauge("uptime_seconds", "Seconds since the process started", lambda: time.time() - self.started_at)
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], Optional[float]]):
+        """Register a gauge sampled at scrape time, replacing any earlier gauge of that name"""
+        gauge = Gauge(f"{self.prefix}_{name}", help_text, read)
+        with self._lock:
+            self._metrics = [m for m in self._metrics if m.name != gauge.name] + [gauge]
+
+    def count(self, outcome: str):
+        """Count a request that finished without running the model (cached, rejected, ...)"""
+        with self._lock:
+            self.requests.inc(outcome=outcome)
+
+    def saved(self, tokens: int, reason: str):
+        """Count decode tokens skipped because a request stopped early (cancelled, deadline, ...)"""
+        with self._lock:
+            self.tokens_saved.inc(tokens, reason=reason)
+
+    def reasoning(self, language: str, reasoning_tokens: int, answer_tokens: int, budget_exhausted: bool = False):
+        """Record how a request's output split into reasoning and answer tokens, per language"""
+        language = language.lower()
+        with self._lock:
+            self.reasoning_tokens.observe(reasoning_tokens, language=language)
+            self.answer_tokens.observe(answer_tokens, language=language)
+            if budget_exhausted:
+                self.budget_exhausted.inc(language=language)
+
+    def tenant(self, tenant: Optional[str], priority: Optional[str], queue_seconds: float, tokens: int,
+               preemptions: int = 0):
+        """Record a request's queue wait and token usage against its tenant and priority class"""
+        tenant = tenant or DEFAULT_TENANT
+        priority = priority or INTERACTIVE
+        with self._lock:
+            self.tenant_queue_seconds.observe(queue_seconds, tenant=tenant, priority=priority)
+            self.tenant_tokens.inc(tokens, tenant=tenant, priority=priority)
+            if preemptions:
+                self.preemptions.inc(preemptions, tenant=tenant)
+
+    def compaction(self, tokens_before: int):
+        """Record a request whose conversation was compacted down from tokens_before prompt tokens"""
+        with self._lock:
+            self.uncompacted_prompt_tokens.observe(tokens_before)
+            self.compactions.inc()
+
+    def tier(self, tier: str, seconds: float, escalated: bool = False):
+        """Record a request answered by a model tier (see deepseek_routing)"""
+        with self._lock:
+            self.tier_seconds.observe(seconds, tier=tier)
+            self.tier_requests.inc(tier=tier, escalated=str(escalated).lower())
+
+    def lookup(self, result):
+        """Record a message checked by the lookup fast path (see deepseek_lookup)"""
+        answered = result.answer is not None
+        with self._lock:
+            self.lookup_seconds.observe(result.seconds, result="answered" if answered else "declined")
+            self.lookups.inc(intent=result.intent or "none", result=result.reason or "answered")
+            if answered:
+                self.requests.inc(outcome="lookup")
+
+    def record(self, stages: Dict[str, float], prompt_tokens: int = 0, output_tokens: int = 0,
+               outcome: str = "ok"):
+        """Record one request: its stage durations in seconds and its token counts"""
+        decode = stages.get("decode")
+        with self._lock:
+            self.requests.inc(outcome=outcome)
+            for stage, seconds in stages.items():
+                self.stage_seconds.observe(seconds, stage=stage)
+            self.request_seconds.observe(sum(stages.values()))
+            if prompt_tokens:
+                self.prompt_tokens.observe(prompt_tokens)
+            if output_tokens:
+                self.output_tokens.observe(output_tokens)
+                if decode:
+                    self.tokens_per_second.observe(output_tokens / decode)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric in self._metrics:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# Content type Prometheus expects for the text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,340 @@
+# DeepSeek Paged KV Cache
+# Keeps the KV state of running sequences and cached sessions in one preallocated pool of
+# fixed-size blocks instead of a contiguous tensor per sequence. A sequence owns a block table,
+# which lists its blocks in order. Its memory grows one block at a time, so no sequence is
+# padded to the longest one in the batch. A finished sequence hands its blocks back at once.
+# Full blocks are indexed by a hash of every token up to their end. Prompts that start the
+# same way, such as those sharing a per-language system prompt, share the blocks of their
+# common prefix. Shared blocks are reference counted. A sequence that writes into a shared
+# block gets its own copy first (copy-on-write).
+#
+# Attention still needs contiguous keys and values. PagedCache is a transformers Cache that
+# writes each layer's new states into the pool and then gathers that layer's blocks for the
+# forward pass. Only one layer's batch is contiguous at any time. It uses the Cache layer API
+# of transformers 5.
+
+from typing import Callable, Dict, List, Optional, Sequence
+import threading
+
+import torch
+from transformers.cache_utils import Cache, CacheLayerMixin
+
+from deepseek_errors import KVPoolExhausted
+
+# Block 0 is never handed out and stays zero: padding positions read from it
+_PAD_SLOT = 0
+
+
+class BlockTable:
+    """The pool blocks holding one sequence's KV state, in order, and how many positions are filled"""
+
+    def __init__(self, pool: "KVBlockPool", blocks: Optional[List[int]] = None, length: int = 0,
+                 hashes: Optional[List[int]] = None):
+        self.pool = pool
+        self.blocks = blocks if blocks is not None else []
+        self.length = length
+        # Prefix hash of each committed full block
+        self.hashes = hashes if hashes is not None else []
+
+    def slots(self) -> torch.Tensor:
+        """Pool slot of every filled position"""
+        size = self.pool.block_size
+        positions = torch.arange(self.length, device=self.pool.device)
+        blocks = torch.tensor(self.blocks, dtype=torch.long, device=self.pool.device)
+        return blocks[positions // size] * size + positions % size
+
+
+class KVBlockPool:
+    """
+    Preallocated key/value blocks shared by every sequence of one model.
+
+    Tables come from match() (sharing any indexed prefix) or fork(). reserve() makes room for
+    new positions, commit() indexes a table's full blocks for reuse and free() gives its blocks
+    back. When no block is free, reclaim (if set) is called to release an idle cache, such as
+    the least recently used session's; it returns False when there is nothing left to release.
+    """
+
+    def __init__(self, num_layers: int, num_heads: int, key_dim: int, value_dim: int, num_blocks: int,
+                 block_size: int = 16, dtype: torch.dtype = torch.float32, device="cpu"):
+        if num_blocks < 2:
+            raise ValueError("A KV cache pool needs at least two blocks")
+        self.num_layers = num_layers
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.device = torch.device(device)
+        # [layer, slot, head, dim]; slot = block * block_size + offset
+        self.keys = torch.zeros((num_layers, num_blocks * block_size, num_heads, key_dim), dtype=dtype, device=device)
+        self.values = torch.zeros((num_layers, num_blocks * block_size, num_heads, value_dim), dtype=dtype,
+                                  device=device)
+        self.bytes_per_block = (self.keys.element_size() * (key_dim + value_dim)
+                                * num_layers * num_heads * block_size)
+        self.reclaim: Optional[Callable[[], bool]] = None
+
+        self._free = list(range(num_blocks - 1, _PAD_SLOT, -1))
+        self._refs = [0] * num_blocks
+        # Prefix hash -> full block with those contents, and back
+        self._index: Dict[int, int] = {}
+        self._block_hash: Dict[int, int] = {}
+        # Reentrant: tables left on garbage-collected requests are freed from finalizers
+        self._lock = threading.RLock()
+
+        self.peak_used_blocks = 0
+        self.lookups = 0
+        self.prefix_hits = 0
+        self.prefix_hit_tokens = 0
+        self.cow_copies = 0
+        self.reclaimed = 0
+        self.exhausted = 0
+
+    @classmethod
+    def for_model(cls, model, memory_bytes: int, block_size: int = 16) -> "KVBlockPool":
+        """A pool of as many blocks as fit in memory_bytes, shaped for model's attention layers"""
+        config = model.config.get_text_config() if hasattr(model.config, "get_text_config") else model.config
+        num_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        # Multi-head latent attention (DeepSeek-V3/R1) has wider keys than values
+        key_dim = (config.qk_nope_head_dim + config.qk_rope_head_dim) if hasattr(config, "qk_rope_head_dim") \
+            else head_dim
+        value_dim = getattr(config, "v_head_dim", None) or head_dim
+        dtype = model.dtype if model.dtype.is_floating_point else torch.float32
+        element_size = torch.empty((), dtype=dtype).element_size()
+        block_bytes = element_size * (key_dim + value_dim) * config.num_hidden_layers * num_heads * block_size
+        return cls(config.num_hidden_layers, num_heads, key_dim, value_dim,
+                   max(2, int(memory_bytes // block_bytes)), block_size, dtype, model.device)
+
+    @property
+    def usable_blocks(self) -> int:
+        return self.num_blocks - 1
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    @property
+    def nbytes(self) -> int:
+        return self.num_blocks * self.bytes_per_block
+
+    def match(self, token_ids: Sequence[int]) -> BlockTable:
+        """A table sharing the indexed blocks of the longest cached prefix, leaving at least one token out"""
+        table = BlockTable(self)
+        size = self.block_size
+        with self._lock:
+            self.lookups += 1
+            prefix_hash = None
+            for start in range(0, len(token_ids) - size, size):
+                prefix_hash = hash((prefix_hash, tuple(token_ids[start:start + size])))
+                block = self._index.get(prefix_hash)
+                if block is None:
+                    break
+                self._refs[block] += 1
+                table.blocks.append(block)
+                table.hashes.append(prefix_hash)
+                table.length += size
+            if table.length:
+                self.prefix_hits += 1
+                self.prefix_hit_tokens += table.length
+        return table
+
+    def fork(self, table: BlockTable, length: Optional[int] = None) -> BlockTable:
+        """A table sharing the first length positions of table; whichever writes first copies the block"""
+        length = table.length if length is None else min(length, table.length)
+        blocks = table.blocks[:-(-length // self.block_size)]
+        with self._lock:
+            for block in blocks:
+                self._refs[block] += 1
+        return BlockTable(self, list(blocks), length, table.hashes[:length // self.block_size])
+
+    def reserve(self, table: BlockTable, count: int):
+        """Make room for count more positions at the end of table; raises KVPoolExhausted"""
+        if count <= 0:
+            return
+        if table.length % self.block_size:
+            # Writing continues inside the last block
+            self._make_writable(table)
+        needed = -(-(table.length + count) // self.block_size) - len(table.blocks)
+        if needed > 0:
+            table.blocks += self._allocate(needed)
+        table.length += count
+
+    def commit(self, table: BlockTable, token_ids: Sequence[int]):
+        """Index table's full blocks by the tokens they hold (token_ids from position 0) for reuse"""
+        size = self.block_size
+        full = min(table.length, len(token_ids)) // size
+        with self._lock:
+            prefix_hash = table.hashes[-1] if table.hashes else None
+            for i in range(len(table.hashes), full):
+                prefix_hash = hash((prefix_hash, tuple(token_ids[i * size:(i + 1) * size])))
+                table.hashes.append(prefix_hash)
+                block = table.blocks[i]
+                if prefix_hash not in self._index and block not in self._block_hash:
+                    self._index[prefix_hash] = block
+                    self._block_hash[block] = prefix_hash
+
+    def free(self, table: BlockTable):
+        """Give table's blocks back; blocks no other table shares are free again at once"""
+        blocks, table.blocks, table.length, table.hashes = table.blocks, [], 0, []
+        self._release(blocks)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            used = self.usable_blocks - len(self._free)
+            return {
+                "block_size": self.block_size,
+                "blocks": self.usable_blocks,
+                "used_blocks": used,
+                "free_blocks": len(self._free),
+                "shared_blocks": sum(1 for refs in self._refs if refs > 1),
+                "cached_blocks": len(self._index),
+                "utilization": used / self.usable_blocks,
+                "peak_used_blocks": self.peak_used_blocks,
+                "bytes": self.nbytes,
+                "bytes_per_block": self.bytes_per_block,
+                "lookups": self.lookups,
+                "prefix_hits": self.prefix_hits,
+                "prefix_hit_tokens": self.prefix_hit_tokens,
+                "cow_copies": self.cow_copies,
+                "reclaimed": self.reclaimed,
+                "exhausted": self.exhausted,
+            }
+
+    def ensure_free(self, count: int) -> bool:
+        """Reclaim idle caches until count blocks are free; False if there are not enough to reclaim"""
+        # Called without the lock: reclaiming frees blocks through free()
+        while len(self._free) < count:
+            if self.reclaim is None or not self.reclaim():
+                return False
+            self.reclaimed += 1
+        return True
+
+    def _allocate(self, count: int) -> List[int]:
+        while True:
+            with self._lock:
+                if len(self._free) >= count:
+                    blocks = [self._free.pop() for _ in range(count)]
+                    for block in blocks:
+                        self._refs[block] = 1
+                    self.peak_used_blocks = max(self.peak_used_blocks, self.usable_blocks - len(self._free))
+                    return blocks
+            if not self.ensure_free(count):
+                with self._lock:
+                    self.exhausted += 1
+                raise KVPoolExhausted(f"KV cache pool is full ({count} more blocks needed)")
+
+    def _make_writable(self, table: BlockTable):
+        last = table.blocks[-1]
+        with self._lock:
+            if self._refs[last] == 1:
+                # Its contents are about to change, so it no longer matches its prefix hash
+                self._unindex(last)
+                return
+        block = self._allocate(1)[0]
+        size = self.block_size
+        self.keys[:, block * size:(block + 1) * size] = self.keys[:, last * size:(last + 1) * size]
+        self.values[:, block * size:(block + 1) * size] = self.values[:, last * size:(last + 1) * size]
+        table.blocks[-1] = block
+        self.cow_copies += 1
+        self._release([last])
+
+    def _release(self, blocks: Sequence[int]):
+        with self._lock:
+            for block in blocks:
+                self._refs[block] -= 1
+                if self._refs[block] == 0:
+                    self._unindex(block)
+                    self._free.append(block)
+
+    def _unindex(self, block: int):
+        prefix_hash = self._block_hash.pop(block, None)
+        if prefix_hash is not None:
+            del self._index[prefix_hash]
+
+
+class _PagedLayer(CacheLayerMixin):
+    """One model layer's view of a PagedCache"""
+
+    is_sliding = False
+
+    def __init__(self, cache: "PagedCache", layer_idx: int):
+        super().__init__()
+        self.cache = cache
+        self.layer_idx = layer_idx
+        self.is_initialized = True
+
+    def lazy_initialization(self, key_states, value_states):
+        pass
+
+    def update(self, key_states, value_states, *args, **kwargs):
+        return self.cache._update(self.layer_idx, key_states, value_states)
+
+    def get_mask_sizes(self, query_length: int):
+        return self.cache.past_length + query_length, 0
+
+    def get_seq_length(self) -> int:
+        return self.cache.past_length
+
+    def get_max_length(self) -> int:
+        return -1
+
+
+class PagedCache(Cache):
+    """
+    A transformers Cache over block tables of a KVBlockPool, one table per batch row.
+
+    The batching scheduler reserve()s each row's new positions and calls plan() before a forward
+    pass. Their states are written to the pool, and every row is gathered left-padded to match
+    the attention mask plan() returns. Without a plan (model.generate() with a single table),
+    the cache reserves each forward pass's positions itself.
+    """
+
+    def __init__(self, pool: KVBlockPool, tables: Sequence[BlockTable]):
+        super().__init__(layers=[_PagedLayer(self, layer_idx) for layer_idx in range(pool.num_layers)])
+        self.pool = pool
+        self.tables = list(tables)
+        self.past_length = max((table.length for table in self.tables), default=0)
+        self._plan = None
+
+    def plan(self, new_counts: Sequence[int]) -> torch.Tensor:
+        """
+        Lay out the next forward pass, in which the last new_counts[i] positions of row i are new.
+
+        Returns its attention mask: each row's earlier positions left-padded to the longest,
+        then its new positions left-padded to the longest. The input ids are left-padded the same way.
+        """
+        device = self.pool.device
+        pasts = [table.length - count for table, count in zip(self.tables, new_counts)]
+        past_width, new_width = max(pasts), max(new_counts)
+        reads, writes, masks = [], [], []
+        for table, past, count in zip(self.tables, pasts, new_counts):
+            slots = table.slots()
+            padding = [torch.full((past_width - past,), _PAD_SLOT, device=device), slots[:past],
+                       torch.full((new_width - count,), _PAD_SLOT, device=device), slots[past:]]
+            reads.append(torch.cat(padding))
+            writes.append(slots[past:])
+            masks.append(torch.cat([torch.zeros(past_width - past), torch.ones(past),
+                                    torch.zeros(new_width - count), torch.ones(count)]))
+        mask = torch.stack(masks).to(device=device, dtype=torch.long)
+        self._plan = (torch.stack(reads), torch.cat(writes), mask[:, past_width:].bool())
+        self.past_length = past_width
+        return mask
+
+    def _update(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor):
+        if self._plan is None:
+            # model.generate(): every position of the forward pass is new
+            count = key_states.shape[-2]
+            for table in self.tables:
+                self.pool.reserve(table, count)
+            self.plan([count] * len(self.tables))
+        read_index, write_slots, new_positions = self._plan
+
+        keys, values = self.pool.keys[layer_idx], self.pool.values[layer_idx]
+        # [batch, heads, new, dim] -> [new position, heads, dim] of the real (unpadded) positions
+        keys.index_copy_(0, write_slots, key_states.transpose(1, 2)[new_positions].to(keys.dtype))
+        values.index_copy_(0, write_slots, value_states.transpose(1, 2)[new_positions].to(values.dtype))
+        batch, width = read_index.shape
+        layer_keys = keys.index_select(0, read_index.view(-1)).view(batch, width, *keys.shape[1:])
+        layer_values = values.index_select(0, read_index.view(-1)).view(batch, width, *values.shape[1:])
+
+        if layer_idx == self.pool.num_layers - 1:
+            self._plan = None
+            self.past_length = max(table.length for table in self.tables)
+        return layer_keys.transpose(1, 2).to(key_states.dtype), layer_values.transpose(1, 2).to(value_states.dtype)
@@ -0,0 +1,191 @@
+# DeepSeek Prompt Assembly
+# Builds chat prompt token ids without re-rendering the Jinja chat template and re-tokenising
+# the fixed system prompt on every request. For each message layout (the sequence of roles),
+# the template is rendered once with placeholder contents. The text between placeholders (BOS,
+# role markers, the generation prompt) is tokenised once and cached. A request then
+# concatenates the cached fragments with its tokenised message contents. System prompts and
+# earlier session turns come from a small cache of tokenised texts.
+#
+# Concatenating separately tokenised pieces matches tokenising the whole string only when
+# every piece boundary falls on an added token such as <｜User｜>, because the tokenizer
+# splits on added tokens before anything else. The DeepSeek-R1 template has this property.
+# Layouts with any other boundary fall back to apply_chat_template. The first prompt of every
+# layout is also checked against apply_chat_template, and the layout is disabled on a mismatch.
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import re
+import threading
+import weakref
+
+# Placeholder contents; private-use characters never appear in real chat text
+_PLACEHOLDER = "\ue000{}\ue001"
+_PLACEHOLDER_PATTERN = re.compile("\ue000(\\d+)\ue001")
+
+# A layout is a list of cached fragment ids and message indexes whose content goes there
+Layout = List[Union[List[int], int]]
+
+
+class ChatPromptBuilder:
+    """Token ids of chat prompts, assembled from cached template fragments"""
+
+    def __init__(self, tokenizer, max_layouts: int = 256, max_cached_texts: int = 1024):
+        self.tokenizer = tokenizer
+        self.max_layouts = max_layouts
+        self.max_cached_texts = max_cached_texts
+        added = list(tokenizer.added_tokens_decoder.values())
+        # Added tokens that split text cleanly on both sides
+        self._boundaries = tuple(token.content for token in added if not token.lstrip and not token.rstrip)
+        self._added_texts = tuple(token.content for token in added)
+        self._added_first_chars = frozenset(text[0] for text in self._added_texts if text)
+
+        # (roles, add_generation_prompt) -> layout, or None where the template needs the slow path
+        self._layouts: "OrderedDict[Tuple[Tuple[str, ...], bool], Optional[Layout]]" = OrderedDict()
+        self._texts: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.fallbacks = 0
+        self.layouts_built = 0
+        self.layouts_rejected = 0
+
+    def encode(self, messages: Sequence[Dict[str, str]], add_generation_prompt: bool = True) -> List[int]:
+        """Token ids identical to apply_chat_template(messages, tokenize=True)["input_ids"]"""
+        if not self._plain(messages):
+            self.fallbacks += 1
+            return self.render(messages, add_generation_prompt)
+
+        key = (tuple(message["role"] for message in messages), add_generation_prompt)
+        with self._lock:
+            known = key in self._layouts
+            layout = self._layouts.get(key)
+            if known:
+                self._layouts.move_to_end(key)
+        if not known:
+            return self._first_use(key, messages, add_generation_prompt)
+        if layout is None:
+            self.fallbacks += 1
+            return self.render(messages, add_generation_prompt)
+
+        self.hits += 1
+        return self._assemble(layout, messages)
+
+    def render(self, messages: Sequence[Dict[str, str]], add_generation_prompt: bool = True) -> List[int]:
+        """The reference path: render the template and tokenise the whole prompt"""
+        return self.tokenizer.apply_chat_template(
+            list(messages),
+            add_generation_prompt=add_generation_prompt,
+            tokenize=True,
+            return_dict=True
+        )["input_ids"]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+            "layouts": len(self._layouts),
+            "layouts_built": self.layouts_built,
+            "layouts_rejected": self.layouts_rejected,
+            "cached_texts": len(self._texts),
+        }
+
+    def _plain(self, messages: Sequence[Dict[str, str]]) -> bool:
+        """Only role/content messages whose content the template cannot treat specially"""
+        for message in messages:
+            content = message.get("content")
+            if len(message) != 2 or not isinstance(content, str) or "role" not in message:
+                return False
+            # Templates may rewrite content around added tokens (R1 drops text before </think>)
+            if not self._added_first_chars.isdisjoint(content) and any(text in content for text in self._added_texts):
+                return False
+            if "\ue000" in content:
+                return False
+        return True
+
+    def _first_use(self, key, messages, add_generation_prompt) -> List[int]:
+        layout = self._build(key[0], add_generation_prompt)
+        reference = self.render(messages, add_generation_prompt)
+        if layout is not None and self._assemble(layout, messages) != reference:
+            layout = None
+        with self._lock:
+            self.layouts_built += 1
+            if layout is None:
+                self.layouts_rejected += 1
+            self._layouts[key] = layout
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+        self.fallbacks += 1
+        return reference
+
+    def _build(self, roles: Tuple[str, ...], add_generation_prompt: bool) -> Optional[Layout]:
+        """Render the template around placeholder contents and tokenise the fixed text between them"""
+        placeholders = [{"role": role, "content": _PLACEHOLDER.format(index)} for index, role in enumerate(roles)]
+        try:
+            rendered = self.tokenizer.apply_chat_template(
+                placeholders, add_generation_prompt=add_generation_prompt, tokenize=False
+            )
+        except Exception:
+            return None
+
+        pieces = _PLACEHOLDER_PATTERN.split(rendered)
+        last = len(pieces) - 2
+        for position in range(1, len(pieces), 2):
+            # Fixed text must meet every content at an added token (or the start/end of the prompt)
+            before, after = pieces[position - 1], pieces[position + 1]
+            if not (before.endswith(self._boundaries) or position == 1 and not before):
+                return None
+            if not (after.startswith(self._boundaries) or position == last and not after):
+                return None
+
+        layout: Layout = []
+        for position, piece in enumerate(pieces):
+            if position % 2:
+                layout.append(int(piece))
+            elif piece:
+                layout.append(self.tokenizer.encode(piece, add_special_tokens=False))
+        return layout
+
+    def _assemble(self, layout: Layout, messages: Sequence[Dict[str, str]]) -> List[int]:
+        input_ids: List[int] = []
+        last = len(messages) - 1
+        for part in layout:
+            if isinstance(part, list):
+                input_ids += part
+            elif part == last and messages[part]["role"] == "user":
+                # The new user message is rarely seen again, so it is not cached
+                input_ids += self.tokenizer.encode(messages[part]["content"], add_special_tokens=False)
+            else:
+                input_ids += self._text_ids(messages[part]["content"])
+        return input_ids
+
+    def _text_ids(self, text: str) -> List[int]:
+        """Token ids of a system prompt or earlier turn, from a small LRU cache"""
+        with self._lock:
+            ids = self._texts.get(text)
+            if ids is not None:
+                self._texts.move_to_end(text)
+                return ids
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        with self._lock:
+            self._texts[text] = ids
+            while len(self._texts) > self.max_cached_texts:
+                self._texts.popitem(last=False)
+        return ids
+
+
+_builders: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_builders_lock = threading.Lock()
+
+
+def prompt_builder(tokenizer) -> ChatPromptBuilder:
+    """The shared ChatPromptBuilder of a tokenizer"""
+    with _builders_lock:
+        builder = _builders.get(tokenizer)
+        if builder is None:
+            builder = _builders[tokenizer] = ChatPromptBuilder(tokenizer)
+        return builder
+
+
+def encode_chat(tokenizer, messages: Sequence[Dict[str, str]], add_generation_prompt: bool = True) -> List[int]:
+    """Chat prompt token ids for messages, as apply_chat_template(..., tokenize=True) returns them"""
+    return prompt_builder(tokenizer).encode(messages, add_generation_prompt)
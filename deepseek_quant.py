@@ -0,0 +1,113 @@
+# DeepSeek CPU Quantisation
+# int8 dynamic quantisation for CPU-only nodes, where the bitsandbytes 4/8-bit paths do not
+# apply. Linear weights are stored as int8 with a per-tensor scale and activations are quantised
+# on the fly, so matmuls run on the int8 CPU kernels. The quantised weights are cached on disk
+# and later starts load them directly instead of loading fp32 weights and quantising again.
+
+import logging
+import os
+import time
+import warnings
+
+import deepseek_checkpoint
+
+logger = logging.getLogger(__name__)
+
+# Packed int8 weights are tied to the torch version that packed them
+DEFAULT_CACHE_DIR = os.path.join(deepseek_checkpoint.DEFAULT_CACHE_DIR, "int8")
+
+# Layers left in full precision: the output projection dominates quality loss for little gain
+SKIP_MODULES = ("lm_head",)
+
+
+def quantized_cache_path(model_name: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """Cache file for the int8 weights of a model's revision under the running transformers and torch"""
+    import torch
+
+    return os.path.join(cache_dir, f"{deepseek_checkpoint.cache_key(model_name)}"
+                                   f"-int8-torch{torch.__version__.split('+')[0]}.pt")
+
+
+def int8_module_names(model):
+    """Names of the Linear layers quantize_int8() replaces"""
+    import torch
+
+    return [name for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and name.split(".")[-1] not in SKIP_MODULES]
+
+
+def quantize_int8(model):
+    """Replace the model's Linear layers (except SKIP_MODULES) with int8 dynamic-quantised ones"""
+    import torch
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    spec = {name: default_dynamic_qconfig for name in int8_module_names(model)}
+    with warnings.catch_warnings():
+        # Eager-mode quantisation is deprecated in favour of torchao but still the CPU fast path
+        warnings.simplefilter("ignore")
+        return quantize_dynamic(model, qconfig_spec=spec, dtype=torch.qint8, inplace=True)
+
+
+def int8_skeleton(model_name: str):
+    """The model's int8 module structure with no weights loaded (fp32 parameters on the meta device)"""
+    import torch
+    from accelerate import init_empty_weights
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=torch.float32)
+    # quantize_int8() cannot pack meta weights, so its Linear layers are swapped in directly;
+    # their int8 placeholders are overwritten by the cached weights
+    for name in int8_module_names(model):
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, child)
+        setattr(parent, child, DynamicLinear(linear.in_features, linear.out_features,
+                                             bias_=linear.bias is not None, dtype=torch.qint8))
+    return model
+
+
+def load_int8_model(model_name: str, cache_dir: str = DEFAULT_CACHE_DIR):
+    """Load the cached int8 weights, or load fp32 weights, quantise them and cache the result"""
+    import torch
+
+    path = quantized_cache_path(model_name, cache_dir)
+    if os.path.exists(path):
+        started = time.time()
+        # Tensors only: nothing in the cache file is executed
+        state_dict = torch.load(path, weights_only=True)
+        model = int8_skeleton(model_name)
+        model.load_state_dict(state_dict, assign=True)
+        model.tie_weights()
+        logger.info(f"Loaded cached int8 weights from {path} ({time.time() - started:.1f}s)")
+        return model.eval()
+
+    started = time.time()
+    model = deepseek_checkpoint.load_model(model_name, torch_dtype=torch.float32).float().eval()
+    model = quantize_int8(model)
+    logger.info(f"Quantised {model_name} to int8 ({time.time() - started:.1f}s)")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    deepseek_checkpoint.prune_cache(cache_dir, model_name, os.path.basename(path), ".pt")
+    return model
+
+
+def model_nbytes(model) -> int:
+    """Bytes held by parameters, buffers and packed int8 weights"""
+    import torch
+
+    tensors = []
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            tensors.append(value)
+        elif isinstance(value, tuple):
+            # Packed quantised Linear params unpack to (int8 weight, bias)
+            tensors.extend(t for t in value if isinstance(t, torch.Tensor))
+    # Tied weights appear under several names but are stored once
+    unique = {(t.data_ptr(), t.numel()): t for t in tensors}
+    return sum(t.numel() * t.element_size() for t in unique.values())
@@ -0,0 +1,150 @@
+# DeepSeek Reasoning Budget
+# DeepSeek-R1 writes a <think>...</think> reasoning section before its answer, and its chat
+# template opens that section at the end of the prompt. Left alone, the reasoning can use up
+# most of max_new_tokens, and the answer gets cut off. With a thinking budget, the
+# reasoning is capped: once it reaches the budget, the closing tag is forced in and the model
+# moves on to the answer. Reasoning tokens are dropped from the text returned to clients, and
+# reasoning and answer tokens are counted separately so budgets can be tuned per language.
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+# Forced in when the budget runs out, the way the model closes its reasoning itself
+CLOSE_TEXT = "\n" + THINK_END + "\n\n"
+
+
+@lru_cache(maxsize=8)
+def _think_ids(tokenizer) -> Optional[Tuple[int, int, Tuple[int, ...], frozenset]]:
+    """(start id, end id, closing ids, newline ids) for tokenizers with single-token think tags"""
+    vocab = tokenizer.get_vocab()
+    if THINK_START not in vocab or THINK_END not in vocab:
+        return None
+    close_ids = tuple(tokenizer.encode(CLOSE_TEXT, add_special_tokens=False))
+    newline_ids = frozenset(tokenizer.encode("\n", add_special_tokens=False)
+                            + tokenizer.encode("\n\n", add_special_tokens=False))
+    return vocab[THINK_START], vocab[THINK_END], close_ids, newline_ids
+
+
+class ReasoningTracker:
+    """
+    Follows one sequence's generated tokens through the reasoning and answer phases.
+
+    observe() every generated token in order. forced_token() returns the token to emit next
+    while the closing tag is being forced after the budget runs out, otherwise None.
+    """
+
+    def __init__(self, start_id: int, end_id: int, in_reasoning: bool, budget: Optional[int] = None,
+                 close_ids: Sequence[int] = (), newline_ids: Iterable[int] = ()):
+        self.start_id = start_id
+        self.end_id = end_id
+        self.in_reasoning = in_reasoning
+        self.budget = budget
+        self.close_ids = list(close_ids)
+        self.newline_ids = frozenset(newline_ids)
+        self.reasoning_tokens = 0
+        self.answer_tokens = 0
+        self.budget_exhausted = False
+        self._forcing: List[int] = []
+        # Newlines right after </think> only separate it from the answer
+        self._answer_started = True
+
+    @classmethod
+    def create(cls, tokenizer, prompt_ids: Sequence[int], budget: Optional[int] = None) -> Optional["ReasoningTracker"]:
+        """Tracker for a prompt, or None if the tokenizer has no think tags"""
+        ids = _think_ids(tokenizer)
+        if ids is None:
+            return None
+        start_id, end_id, close_ids, newline_ids = ids
+        return cls(start_id, end_id, prompt_in_reasoning(prompt_ids, start_id, end_id), budget,
+                   close_ids, newline_ids)
+
+    def forced_token(self) -> Optional[int]:
+        if not self._forcing and self.in_reasoning and self.budget is not None \
+                and self.reasoning_tokens >= self.budget:
+            self.budget_exhausted = True
+            self._forcing = list(self.close_ids)
+        return self._forcing[0] if self._forcing else None
+
+    def observe(self, token_id: int) -> bool:
+        """Record a generated token; True if it belongs to the answer shown to the client"""
+        if self._forcing and self._forcing[0] == token_id:
+            self._forcing.pop(0)
+        if self.in_reasoning:
+            self.reasoning_tokens += 1
+            if token_id == self.end_id:
+                self.in_reasoning = False
+                self._answer_started = False
+            return False
+        if token_id == self.start_id:
+            self.in_reasoning = True
+            self.reasoning_tokens += 1
+            return False
+        if not self._answer_started and token_id in self.newline_ids:
+            self.reasoning_tokens += 1
+            return False
+        self._answer_started = True
+        self.answer_tokens += 1
+        return True
+
+    def stats(self) -> Dict[str, object]:
+        return {"reasoning_tokens": self.reasoning_tokens, "answer_tokens": self.answer_tokens,
+                "thinking_budget_exhausted": self.budget_exhausted}
+
+
+def prompt_in_reasoning(prompt_ids: Sequence[int], start_id: int, end_id: int) -> bool:
+    """True if the prompt ends inside an open <think> section (the R1 generation prompt does)"""
+    for token_id in reversed(prompt_ids):
+        if token_id == end_id:
+            return False
+        if token_id == start_id:
+            return True
+    return False
+
+
+def split_answer(tokenizer, prompt_ids: Sequence[int], output_ids: Sequence[int]
+                 ) -> Tuple[List[int], Optional[ReasoningTracker]]:
+    """The answer tokens of output_ids without the reasoning, and the tracker holding the counts"""
+    tracker = ReasoningTracker.create(tokenizer, prompt_ids)
+    if tracker is None:
+        return list(output_ids), None
+    return [token_id for token_id in output_ids if tracker.observe(token_id)], tracker
+
+
+def parse_budgets(values: Optional[Sequence[str]]) -> Dict[str, int]:
+    """Parse --thinking-budget values: "256" sets the default, "hindi=384" one language's budget"""
+    budgets = {}
+    for value in values or []:
+        language, sep, tokens = value.rpartition("=")
+        budgets[language.lower() if sep else "default"] = int(tokens)
+    return budgets
+
+
+def budget_for(budgets: Dict[str, int], language: str) -> Optional[int]:
+    """Thinking budget for a language; None when reasoning is not capped"""
+    return budgets.get(language.lower(), budgets.get("default"))
+
+
+def budget_processor(tracker: ReasoningTracker):
+    """A LogitsProcessorList that makes model.generate() follow the tracker's forced tokens"""
+    import torch
+    from transformers import LogitsProcessor, LogitsProcessorList
+
+    class ThinkingBudgetProcessor(LogitsProcessor):
+        def __init__(self):
+            self.seen = None
+
+        def __call__(self, input_ids, scores):
+            # The first call sees the prompt; later calls add one new token per step
+            if self.seen is not None:
+                for token_id in input_ids[0, self.seen:].tolist():
+                    tracker.observe(token_id)
+            self.seen = input_ids.shape[-1]
+            forced = tracker.forced_token()
+            if forced is not None:
+                scores = torch.full_like(scores, float("-inf"))
+                scores[:, forced] = 0.0
+            return scores
+
+    return LogitsProcessorList([ThinkingBudgetProcessor()])
@@ -0,0 +1,326 @@
+# DeepSeek Model Registry
+# One process-wide place that owns loaded models. A model is identified by
+# (name, dtype, quantisation, device). Asking for a model that is already loaded returns the
+# same handle. Several models can be resident at once under a memory budget, with the least
+# recently used one unloaded first. Models idle past a TTL are unloaded so shared nodes do not
+# hold weights overnight. A background thread learns each model's traffic by hour of day and
+# loads a model shortly before the hour its traffic usually returns.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Weight of a day's traffic after one more day has passed
+FORECAST_DECAY = 0.5
+
+
+class ModelKey(NamedTuple):
+    name: str
+    dtype: str = "auto"
+    quant: str = "none"
+    device: str = "auto"
+
+
+class TrafficForecast:
+    """Requests per hour of day for each model, averaged over past days with exponential decay"""
+
+    def __init__(self, decay: float = FORECAST_DECAY):
+        self.decay = decay
+        # key -> 24 hourly [value, day the value was last decayed to]
+        self._hours: Dict[ModelKey, List[List[float]]] = {}
+
+    def observe(self, key: ModelKey, at: Optional[float] = None):
+        day, hour = self._slot(time.time() if at is None else at)
+        bins = self._hours.setdefault(key, [[0.0, day] for _ in range(24)])
+        self._decay(bins[hour], day)
+        bins[hour][0] += 1.0
+
+    def expected(self, key: ModelKey, at: float) -> float:
+        """Requests expected in the hour containing at, from the same hour on earlier days"""
+        bins = self._hours.get(key)
+        if bins is None:
+            return 0.0
+        day, hour = self._slot(at)
+        value, last_day = bins[hour]
+        # Hits from "today" in that hour have not happened yet when looking ahead
+        return value * self.decay ** max(day - last_day - 1, 0) * (1.0 - self.decay)
+
+    def _decay(self, slot: List[float], day: int):
+        if slot[1] != day:
+            slot[0] *= self.decay ** (day - slot[1])
+            slot[1] = day
+
+    @staticmethod
+    def _slot(at: float):
+        local = time.localtime(at)
+        return int((at + local.tm_gmtoff) // 86400), local.tm_hour
+
+
+class RegisteredModel:
+    """A registry entry: the loaded DeepSeekModel (or None) plus what is needed to reload it"""
+
+    def __init__(self, key: ModelKey):
+        self.key = key
+        self.handle = None
+        self.nbytes = 0
+        self.in_use = 0
+        self.loads = 0
+        self.last_used = time.time()
+        self.on_load: List[Callable] = []
+        self.on_unload: List[Callable] = []
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Loaded models keyed by ModelKey, with LRU eviction under a budget, idle unload and warm-up"""
+
+    def __init__(self,
+                 memory_budget_bytes: Optional[int] = None,
+                 idle_ttl: Optional[float] = None,
+                 warm_ahead: float = 900.0,
+                 warm_threshold: float = 1.0,
+                 check_interval: float = 30.0):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_ttl = idle_ttl
+        self.warm_ahead = warm_ahead
+        self.warm_threshold = warm_threshold
+        self.check_interval = check_interval
+        self.forecast = TrafficForecast()
+
+        # Ordered from least to most recently used
+        self._models: "OrderedDict[ModelKey, RegisteredModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.idle_unloads = 0
+        self.warmups = 0
+
+    @staticmethod
+    def key(model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+            device: Optional[str] = None) -> ModelKey:
+        return ModelKey(model_name, dtype or "auto", quant or "none", device or "auto")
+
+    def get(self, model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+            device: Optional[str] = None, on_load: Optional[Callable] = None,
+            on_unload: Optional[Callable] = None):
+        """
+        Return the loaded DeepSeekModel for this key, loading it if needed.
+
+        on_load(model) runs after every (re)load of the key, including background warm-ups, and
+        on_unload() after it is unloaded; both are remembered for the life of the registry.
+        """
+        key = self.key(model_name, dtype, quant, device)
+        entry = self._entry(key, on_load, on_unload)
+        self.forecast.observe(key)
+        self._ensure_thread()
+        return self._load(entry)
+
+    @contextmanager
+    def use(self, model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+            device: Optional[str] = None):
+        """get() the model and keep it from being evicted or unloaded until the block exits"""
+        key = self.key(model_name, dtype, quant, device)
+        entry = self._entry(key)
+        with self._lock:
+            entry.in_use += 1
+        try:
+            yield self.get(model_name, dtype, quant, device)
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    def touch(self, model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+              device: Optional[str] = None):
+        """Mark a model as used by a request that does not go through get()"""
+        key = self.key(model_name, dtype, quant, device)
+        self.forecast.observe(key)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                entry.last_used = time.time()
+                self._models.move_to_end(key)
+
+    def warm(self, model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+             device: Optional[str] = None) -> threading.Thread:
+        """Load a model in a background thread"""
+        entry = self._entry(self.key(model_name, dtype, quant, device))
+        thread = threading.Thread(target=self._warm, args=(entry,), name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, model_name: str, dtype: Optional[str] = None, quant: Optional[str] = None,
+               device: Optional[str] = None):
+        entry = self._models.get(self.key(model_name, dtype, quant, device))
+        if entry is not None:
+            self._unload(entry)
+
+    def unload_idle(self, now: Optional[float] = None) -> List[ModelKey]:
+        """Unload models unused for idle_ttl seconds, unless traffic is expected within warm_ahead"""
+        if self.idle_ttl is None:
+            return []
+        now = time.time() if now is None else now
+        with self._lock:
+            idle = [entry for entry in self._models.values()
+                    if entry.handle is not None and entry.in_use == 0
+                    and now - entry.last_used > self.idle_ttl
+                    and self.forecast.expected(entry.key, now + self.warm_ahead) < self.warm_threshold]
+        for entry in idle:
+            logger.info(f"Unloading {entry.key.name} after {now - entry.last_used:.0f}s idle")
+            self._unload(entry)
+            self.idle_unloads += 1
+        return [entry.key for entry in idle]
+
+    def warm_predicted(self, now: Optional[float] = None) -> List[ModelKey]:
+        """Start loading unloaded models whose traffic is expected within warm_ahead seconds"""
+        now = time.time() if now is None else now
+        with self._lock:
+            due = [entry for entry in self._models.values()
+                   if entry.handle is None and entry.loads > 0 and not entry.lock.locked()
+                   and self.forecast.expected(entry.key, now + self.warm_ahead) >= self.warm_threshold]
+        for entry in due:
+            logger.info(f"Warming up {entry.key.name} ahead of expected traffic")
+            threading.Thread(target=self._warm, args=(entry,), name="model-warmup", daemon=True).start()
+        return [entry.key for entry in due]
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self._models.values() if entry.handle is not None)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "models": [
+                    {
+                        "name": entry.key.name,
+                        "dtype": entry.key.dtype,
+                        "quant": entry.key.quant,
+                        "device": entry.key.device,
+                        "loaded": entry.handle is not None,
+                        "bytes": entry.nbytes,
+                        "in_use": entry.in_use,
+                        "idle_seconds": round(time.time() - entry.last_used, 1),
+                    }
+                    for entry in self._models.values()
+                ],
+                "loaded_bytes": self.loaded_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "idle_unloads": self.idle_unloads,
+                "warmups": self.warmups,
+            }
+
+    def _entry(self, key: ModelKey, on_load: Optional[Callable] = None,
+               on_unload: Optional[Callable] = None) -> RegisteredModel:
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                entry = self._models[key] = RegisteredModel(key)
+            self._models.move_to_end(key)
+            entry.last_used = time.time()
+            if on_load is not None and on_load not in entry.on_load:
+                entry.on_load.append(on_load)
+            if on_unload is not None and on_unload not in entry.on_unload:
+                entry.on_unload.append(on_unload)
+            return entry
+
+    def _load(self, entry: RegisteredModel):
+        # Only one thread loads a given model; others wait for it and share the result
+        with entry.lock:
+            if entry.handle is not None:
+                self.hits += 1
+                return entry.handle
+
+            from deepseek_advanced import DeepSeekModel
+            from deepseek_quant import model_nbytes
+
+            # Make room first when the model's size is known from an earlier load
+            self._evict_for(entry, entry.nbytes)
+            key = entry.key
+            handle = DeepSeekModel(
+                model_name=key.name,
+                use_4bit=key.quant == "4bit",
+                use_8bit=key.quant == "8bit",
+                cpu_int8=key.quant == "int8",
+                device=None if key.device == "auto" else key.device,
+                dtype=None if key.dtype == "auto" else key.dtype,
+            ).load_model()
+
+            with self._lock:
+                entry.handle = handle
+                entry.nbytes = model_nbytes(handle.model)
+                entry.loads += 1
+                entry.last_used = time.time()
+                self.loads += 1
+
+        # Evict outside the entry lock: two models loading at once may each evict the other
+        self._evict_for(entry, 0)
+        for callback in list(entry.on_load):
+            callback(handle)
+        return handle
+
+    def _warm(self, entry: RegisteredModel):
+        try:
+            if entry.handle is None:
+                self._load(entry)
+                self.warmups += 1
+        except Exception as e:
+            logger.warning(f"Warm-up of {entry.key.name} failed: {e}")
+
+    def _evict_for(self, entry: RegisteredModel, incoming_bytes: int):
+        """Unload least recently used idle models until loaded + incoming fits the budget"""
+        if self.memory_budget_bytes is None:
+            return
+        with self._lock:
+            victims, total = [], self.loaded_bytes + incoming_bytes
+            for other in self._models.values():
+                if total <= self.memory_budget_bytes:
+                    break
+                if other is not entry and other.handle is not None and other.in_use == 0:
+                    victims.append(other)
+                    total -= other.nbytes
+        for victim in victims:
+            logger.info(f"Evicting {victim.key.name} to stay within the model memory budget")
+            self._unload(victim)
+            self.evictions += 1
+
+    def _unload(self, entry: RegisteredModel):
+        with entry.lock:
+            handle, entry.handle = entry.handle, None
+            if handle is None:
+                return
+            for callback in list(entry.on_unload):
+                callback()
+            handle.unload_model()
+
+    def _ensure_thread(self):
+        if self._thread is None and (self.idle_ttl is not None or self.memory_budget_bytes is not None):
+            self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.unload_idle()
+                self.warm_predicted()
+            except Exception as e:
+                logger.error(f"Model registry check failed: {e}")
+
+
+# Shared by every front end in the process
+registry = ModelRegistry()
@@ -0,0 +1,332 @@
+# DeepSeek Tiered Model Routing
+# Most vendor messages ("hi", "what are your hours", "onion price?") do not need the full
+# DeepSeek-R1 checkpoint. A router in front of generation sends each message to the smallest
+# model tier that should handle it. A cheap classifier looks at the message length, its
+# language and keywords of questions that need reasoning. A lower tier's first few tokens are
+# then held back until the model's own confidence in them (their mean probability) is known;
+# an unconfident answer is dropped before the client sees it and the message escalates to the
+# next tier. The serving model (--model) is always the last tier. Each tier runs its own
+# scheduler with its own batch size, queue depth, worker processes and answer length.
+#
+# Tier file (JSON), smallest tier first:
+#   {"probe_tokens": 8,
+#    "tiers": [{"name": "small", "model": "deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B",
+#               "max_words": 12, "languages": ["english", "hindi"], "min_confidence": 0.5,
+#               "max_batch_size": 32, "max_new_tokens": 64}]}
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import json
+import threading
+import time
+
+from deepseek_cache import normalize_message
+from deepseek_cancel import CancellationToken
+from deepseek_errors import QueueFullError
+from deepseek_metrics import percentile
+
+# Name of the last tier, the serving model itself
+FULL_TIER = "full"
+# Tokens of a lower tier's answer scored before it is shown or escalated
+PROBE_TOKENS = 8
+# Recent latencies kept per tier for percentiles
+LATENCY_WINDOW = 1000
+
+# Words that mark a question needing reasoning (explanations, comparisons, money sums, advice);
+# such messages go straight to the full model
+HARD_KEYWORDS = {
+    "english": ("why", "explain", "compare", "difference", "calculate", "profit", "loss", "loan", "interest",
+                "gst", "tax", "plan", "strategy", "recommend", "should i", "best way", "analyse", "analyze"),
+    "hindi": ("क्यों", "समझाइए", "समझाओ", "तुलना", "अंतर", "फर्क", "हिसाब", "मुनाफा", "नुकसान", "लोन", "ब्याज",
+              "जीएसटी", "टैक्स", "योजना", "सलाह"),
+    "marathi": ("कशामुळे", "समजावून", "तुलना", "फरक", "हिशोब", "नफा", "तोटा", "कर्ज", "व्याज", "जीएसटी",
+                "योजना", "सल्ला"),
+    "gujarati": ("કેમ", "સમજાવો", "સરખામણી", "તફાવત", "ગણતરી", "નફો", "નુકસાન", "લોન", "વ્યાજ", "જીએસટી",
+                 "ટેક્સ", "યોજના", "સલાહ"),
+}
+
+
+class TierPolicy(NamedTuple):
+    name: str
+    model: str
+    # Longest message, in words, routed to this tier
+    max_words: int = 16
+    # Languages the tier answers; None means all
+    languages: Optional[Tuple[str, ...]] = None
+    # Mean probability of the first probe tokens below which the answer escalates
+    min_confidence: float = 0.0
+    # Scheduler settings of the tier (None: the serving model's)
+    max_batch_size: Optional[int] = None
+    max_queue_depth: Optional[int] = None
+    workers: int = 0
+    max_new_tokens: Optional[int] = None
+
+
+def load_tiers(path: Optional[str]) -> Tuple[List[TierPolicy], Dict[str, Any]]:
+    """Tier policies from a JSON tier file, and its router options (probe_tokens, hard_keywords)"""
+    if not path:
+        return [], {}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    tiers = []
+    for fields in config.pop("tiers"):
+        languages = fields.pop("languages", None)
+        tiers.append(TierPolicy(**fields, languages=tuple(l.lower() for l in languages) if languages else None))
+    return tiers, config
+
+
+class QueryClassifier:
+    """Cheap message features that pick the first tier to try"""
+
+    def __init__(self, tiers: Sequence[TierPolicy], hard_keywords: Optional[Dict[str, Sequence[str]]] = None):
+        self.tiers = list(tiers)
+        self.hard_keywords = {language: tuple(words) for language, words in HARD_KEYWORDS.items()}
+        for language, words in (hard_keywords or {}).items():
+            self.hard_keywords[language] = self.hard_keywords.get(language, ()) + tuple(words)
+
+    def classify(self, message: str, language: str) -> Tuple[int, str]:
+        """Index of the first tier to try (len(tiers) is the full model) and why it was picked"""
+        language = language.lower()
+        text = normalize_message(message)
+        words = text.split()
+        # Keywords of every language: vendors mix English words into Hindi, Marathi and Gujarati
+        for keywords in self.hard_keywords.values():
+            for keyword in keywords:
+                if (keyword in text) if " " in keyword else (keyword in words):
+                    return len(self.tiers), "keyword"
+        # Two or more numbers usually mean a sum to work out
+        if sum(any(c.isdigit() for c in word) for word in words) >= 2:
+            return len(self.tiers), "arithmetic"
+        reason = "length"
+        for index, tier in enumerate(self.tiers):
+            if tier.languages is not None and language not in tier.languages:
+                reason = "language"
+                continue
+            if len(words) <= tier.max_words:
+                return index, "simple"
+        return len(self.tiers), reason
+
+
+class _Probe:
+    """Holds back a tier's first tokens and its completion until the router accepts the answer"""
+
+    def __init__(self, probe_tokens: int, on_token: Optional[Callable[[int], None]],
+                 on_done: Optional[Callable[[Any], None]]):
+        self.probe_tokens = probe_tokens
+        self.on_token = on_token
+        self.on_done = on_done
+        self.decided = threading.Event()
+        self._held: List[int] = []
+        self._finished = None
+        self._released = False
+        self._lock = threading.Lock()
+
+    def token(self, token_id: int):
+        with self._lock:
+            if not self._released:
+                self._held.append(token_id)
+                if len(self._held) >= self.probe_tokens:
+                    self.decided.set()
+                return
+        if self.on_token is not None:
+            self.on_token(token_id)
+
+    def done(self, generation):
+        with self._lock:
+            if not self._released:
+                self._finished = generation
+                self.decided.set()
+                return
+        if self.on_done is not None:
+            self.on_done(generation)
+
+    def release(self):
+        """Pass the held tokens, and the end if it was reached, on to the caller"""
+        with self._lock:
+            self._released = True
+            if self.on_token is not None:
+                for token_id in self._held:
+                    self.on_token(token_id)
+            if self._finished is not None and self.on_done is not None:
+                self.on_done(self._finished)
+
+
+class TierRouter:
+    """Routes messages across model tiers, escalating unconfident or overloaded lower tiers"""
+
+    def __init__(self,
+                 tiers: Sequence[TierPolicy],
+                 probe_tokens: int = PROBE_TOKENS,
+                 hard_keywords: Optional[Dict[str, Sequence[str]]] = None,
+                 on_served: Optional[Callable[[str, float, bool], None]] = None):
+        self.tiers = list(tiers)
+        self.names = [tier.name for tier in self.tiers] + [FULL_TIER]
+        self.classifier = QueryClassifier(self.tiers, hard_keywords)
+        self.probe_tokens = probe_tokens
+        # on_served(tier name, seconds, escalated) runs once per answered request
+        self.on_served = on_served
+        self._lock = threading.Lock()
+
+        # Per tier: requests first routed to it, requests it answered, answers it escalated
+        # (low confidence) or passed on (queue full), and recent latencies of its answers
+        self.routed = {name: 0 for name in self.names}
+        self.served = {name: 0 for name in self.names}
+        self.escalated = {name: 0 for name in self.names}
+        self.overflowed = {name: 0 for name in self.names}
+        self.latencies: Dict[str, Deque[float]] = {name: deque(maxlen=LATENCY_WINDOW) for name in self.names}
+        self.confidence: Dict[str, Deque[float]] = {name: deque(maxlen=LATENCY_WINDOW) for name in self.names}
+        self.reasons: Dict[str, int] = {}
+
+    def submit(self,
+               message: str,
+               language: str,
+               start: Callable[..., Any],
+               cancel_token: Optional[CancellationToken] = None,
+               on_token: Optional[Callable[[int], None]] = None,
+               on_done: Optional[Callable[[Any], None]] = None,
+               ready: Optional[Callable[[int], bool]] = None):
+        """
+        Generate with the first suitable tier and return the request of the tier that answers.
+
+        start(index, on_token, on_done, cancel_token, token_probs) submits the message to tier
+        index (len(tiers) is the full model) and returns its GenerationRequest. Tiers that
+        ready(index) reports as unavailable are skipped. The call blocks while a lower tier's
+        first probe_tokens tokens are scored; below the tier's min_confidence that generation
+        is cancelled and the next tier tries. A lower tier whose queue is full passes the
+        message on; QueueFullError from the full model propagates.
+        """
+        started = time.perf_counter()
+        index, reason = self.classifier.classify(message, language)
+        while index < len(self.tiers) and ready is not None and not ready(index):
+            index += 1
+        with self._lock:
+            self.routed[self.names[index]] += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+        escalated = False
+        while True:
+            name = self.names[index]
+
+            def served(generation, name=name, escalated=escalated):
+                self._observe(name, time.perf_counter() - started, escalated)
+                if on_done is not None:
+                    on_done(generation)
+
+            if index == len(self.tiers):
+                return start(index, on_token, served, cancel_token, None)
+
+            # The attempt has its own token so an escalated answer can be dropped on its own
+            attempt = CancellationToken()
+            if cancel_token is not None:
+                cancel_token.add_callback(attempt.cancel)
+            probe = _Probe(self.probe_tokens, on_token, served)
+            token_probs: List[float] = []
+            try:
+                generation = start(index, probe.token, probe.done, attempt, token_probs)
+            except QueueFullError:
+                with self._lock:
+                    self.overflowed[name] += 1
+                index, escalated = self._next(index, ready), True
+                continue
+            probe.decided.wait()
+            scored = token_probs[:self.probe_tokens]
+            confidence = sum(scored) / len(scored) if scored else None
+            if confidence is not None:
+                with self._lock:
+                    self.confidence[name].append(confidence)
+            tier = self.tiers[index]
+            if generation.error is not None or confidence is None or confidence >= tier.min_confidence \
+                    or (cancel_token is not None and cancel_token.cancelled):
+                probe.release()
+                return generation
+            attempt.cancel()
+            with self._lock:
+                self.escalated[name] += 1
+            index, escalated = self._next(index, ready), True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(self.served.values())
+            tiers = []
+            for name, model in zip(self.names, [tier.model for tier in self.tiers] + [None]):
+                latencies = self.latencies[name]
+                confidence = self.confidence[name]
+                tiers.append({
+                    "name": name,
+                    "model": model,
+                    "routed": self.routed[name],
+                    "served": self.served[name],
+                    "share": self.served[name] / total if total else 0.0,
+                    "escalated": self.escalated[name],
+                    "overflowed": self.overflowed[name],
+                    "p50_seconds": round(percentile(latencies, 50), 4),
+                    "p95_seconds": round(percentile(latencies, 95), 4),
+                    "mean_confidence": round(sum(confidence) / len(confidence), 4) if confidence else None,
+                })
+            return {"requests": total, "probe_tokens": self.probe_tokens, "reasons": dict(self.reasons),
+                    "tiers": tiers}
+
+    def _next(self, index: int, ready: Optional[Callable[[int], bool]]) -> int:
+        index += 1
+        while index < len(self.tiers) and ready is not None and not ready(index):
+            index += 1
+        return index
+
+    def _observe(self, name: str, seconds: float, escalated: bool):
+        with self._lock:
+            self.served[name] += 1
+            self.latencies[name].append(seconds)
+        if self.on_served is not None:
+            self.on_served(name, seconds, escalated)
+
+
+class TierServer:
+    """The tokenizer and scheduler of one lower tier, (re)started as the registry loads its model"""
+
+    def __init__(self, policy: TierPolicy, generation_params: Dict[str, Any], **scheduler_options):
+        self.policy = policy
+        self.name = policy.name
+        # Generation settings of the tier's answers
+        self.params = dict(generation_params)
+        if policy.max_new_tokens is not None:
+            self.params["max_new_tokens"] = policy.max_new_tokens
+        # max_batch_size, max_queue_depth, tenants, preemption; the tier's own values win
+        self.options = dict(scheduler_options)
+        for option in ("max_batch_size", "max_queue_depth"):
+            if getattr(policy, option) is not None:
+                self.options[option] = getattr(policy, option)
+        self.tokenizer = None
+        self.scheduler = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.scheduler is not None
+
+    def load(self, registry):
+        """Load the tier's model (in its own worker processes with policy.workers) and start serving"""
+        if self.policy.workers > 0:
+            from transformers import AutoTokenizer
+            from deepseek_workers import WorkerPool
+            tokenizer = AutoTokenizer.from_pretrained(self.policy.model, trust_remote_code=True)
+            scheduler = WorkerPool(self.policy.model, self.policy.workers, **self.options).start()
+            with self._lock:
+                self.tokenizer, self.scheduler = tokenizer, scheduler
+            return
+        self.start(registry.get(self.policy.model, on_load=self.start, on_unload=self.stop))
+
+    def start(self, loaded):
+        from deepseek_batching import ContinuousBatchingScheduler
+
+        with self._lock:
+            if self.scheduler is not None and self.scheduler.model is loaded.model:
+                return
+            loaded.model.eval()
+            self.tokenizer = loaded.tokenizer
+            self.scheduler = ContinuousBatchingScheduler(loaded.model, loaded.tokenizer, **self.options).start()
+
+    def stop(self):
+        with self._lock:
+            scheduler, self.scheduler = self.scheduler, None
+        if scheduler is not None:
+            scheduler.stop()
@@ -1,14 +1,33 @@
 #!/usr/bin/env python
 # DeepSeek Server Script
-# This script is called by the Node.js server to generate responses using DeepSeek-R1
+# This script is called by the Node.js server to generate responses using DeepSeek-R1.
+# It can run as a long-lived daemon (--serve) that loads the model once and answers
+# JSON-lines requests; the one-shot --message CLI is a thin client to that daemon.
 
 import argparse
+import http.server
 import json
 import sys
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import os
 import logging
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from deepseek_cache import ResponseCache, SemanticCache, hidden_state_vector
+from deepseek_cancel import CancellationToken, stop_reason, stopping_criteria
+from deepseek_context import ContextManager, ModelLock, model_summarizer
+from deepseek_fairness import PRIORITIES, FairQueue, load_policies, priority_rank
+from deepseek_lookup import LookupFastPath
+from deepseek_metrics import CONTENT_TYPE, InferenceMetrics
+from deepseek_prompts import encode_chat
+from deepseek_reasoning import ReasoningTracker, budget_for, budget_processor, parse_budgets, split_answer
+from deepseek_registry import registry
+from deepseek_streaming import TokenStreamer, timing_stats
 
 # Configure logging
 logging.basicConfig(
@@ -21,39 +40,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global variables for model and tokenizer
+# Model to load; DEEPSEEK_MODEL may point at another checkpoint or a local directory
+MODEL_NAME = os.environ.get("DEEPSEEK_MODEL", "deepseek-ai/DeepSeek-R1")
+
+# Languages with their own system prompt
+LANGUAGES = ("english", "hindi", "marathi", "gujarati")
+
+# Generation settings used for every request (also part of the response cache key)
+GENERATION_PARAMS = {
+    "max_new_tokens": 500,  # Adjust based on your needs
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "do_sample": True,
+}
+
+# Reasoning-token budgets by language ("default" for the rest); when set, the <think> section
+# is closed at the budget and left out of responses
+THINKING_BUDGETS = {}
+
+# Prompt-token budget for requests carrying conversation history: older turns are summarised
+# in the background and left out (None: history is sent in full)
+MAX_CONTEXT_TOKENS = None
+CONTEXT_SUMMARIES = True
+context = None
+# Daemon requests hold the model in the foreground; summaries wait for a gap between them
+model_lock = ModelLock()
+
+# Global variables for model and tokenizer, adopted from the process-wide model registry
 tokenizer = None
 model = None
+model_unloaded = False
+
+# KV state of each language's system-prompt prefix, computed once after the model loads
+use_prefix_cache = True
+prefix_cache = None
+
+# Answers to repeated questions; configured from the command line in main()
+response_cache = ResponseCache(MODEL_NAME)
+semantic_cache = None
+
+# Catalogue lookups answered from --lookup-data without generating; None when not configured
+lookup = None
+
+# Per-stage request timings and gauges, served by the "metrics" op and --metrics-listen
+metrics = InferenceMetrics()
+metrics.gauge("model_loaded", "1 once the model is loaded", lambda: int(model is not None))
+
+# Default daemon address: a Unix domain socket where supported, localhost TCP otherwise
+DEFAULT_LISTEN = os.environ.get(
+    "DEEPSEEK_SOCKET",
+    os.path.join(tempfile.gettempdir(), "deepseek_server.sock")
+    if hasattr(socket, "AF_UNIX") else "127.0.0.1:8765"
+)
 
 def load_model():
     """Load the DeepSeek-R1 model and tokenizer"""
     global tokenizer, model
     
     try:
-        logger.info("Loading DeepSeek-R1 model and tokenizer...")
+        # Imported on first use so client calls and health probes never load torch
+        import torch
         
-        # Load tokenizer
-        tokenizer = AutoTokenizer.from_pretrained("deepseek-ai/DeepSeek-R1", trust_remote_code=True)
+        logger.info("Loading DeepSeek-R1 model and tokenizer...")
         
         # Determine device
         device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Using device: {device}")
         
-        # Model loading parameters
-        model_kwargs = {
-            "trust_remote_code": True,
-            "device_map": "auto"
-        }
-        
-        # Use half precision for CUDA
-        if device == "cuda":
-            model_kwargs["torch_dtype"] = torch.float16
-        
-        # Load model
-        model = AutoModelForCausalLM.from_pretrained(
-            "deepseek-ai/DeepSeek-R1",
-            **model_kwargs
-        )
+        # The registry loads the model once per process (half precision on CUDA, prepared
+        # checkpoints memory-mapped without conversion) and may unload it when idle
+        adopt_model(registry.get(MODEL_NAME, on_load=adopt_model, on_unload=forget_model))
         
         logger.info("Model loaded successfully")
         return True
@@ -61,15 +117,132 @@ def load_model():
         logger.error(f"Error loading model: {str(e)}")
         return False
 
-def generate_response(message, language="english"):
-    """Generate a response using the DeepSeek-R1 model"""
+def adopt_model(loaded):
+    """Serve a model (re)loaded by the registry and rebuild its system-prompt prefix cache"""
+    global tokenizer, model, model_unloaded
+    
+    if loaded.model is model:
+        return
+    tokenizer, model = loaded.tokenizer, loaded.model
+    model_unloaded = False
+    if use_prefix_cache:
+        build_prefix_cache()
+    start_context()
+
+def start_context():
+    """Create the context manager once the tokenizer is loaded (kept across model reloads)"""
+    global context
+    
+    if MAX_CONTEXT_TOKENS is None or context is not None:
+        return
+    summarize = model_summarizer(tokenizer, summary_ids) if CONTEXT_SUMMARIES else None
+    context = ContextManager(tokenizer, MAX_CONTEXT_TOKENS, summarize=summarize)
+
+def summary_ids(prompt_ids, max_new_tokens):
+    """Greedily generate a conversation summary; runs on the context manager's background thread"""
+    import torch
+    
+    with model_lock.background(), registry.use(MODEL_NAME), torch.no_grad():
+        if model is None:
+            raise RuntimeError("model is not loaded")
+        input_ids = torch.tensor([prompt_ids], device=model.device)
+        outputs = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                 max_new_tokens=max_new_tokens, do_sample=False)
+    return outputs[0][len(prompt_ids):].tolist()
+
+def forget_model():
+    """Drop every reference to a model the registry is unloading"""
+    global tokenizer, model, prefix_cache, model_unloaded
+    
+    logger.info("Model unloaded; it will be reloaded on the next request")
+    tokenizer, model, prefix_cache = None, None, None
+    model_unloaded = True
+
+def system_prefix_ids(language):
+    """Token ids the chat template puts before any user text for a language's system prompt"""
+    from deepseek_kv import common_prefix_length
+    
+    def render(user_text):
+        return tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": get_system_prompt(language)},
+                {"role": "user", "content": user_text},
+            ],
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True
+        )["input_ids"]
+    
+    # Whatever two different user messages share is the fixed prefix
+    first, second = render("a"), render("z")
+    return first[:common_prefix_length(first, second)]
+
+def build_prefix_cache():
+    """Precompute the system-prompt KV prefix for every supported language"""
+    global prefix_cache
+    from deepseek_kv import PrefixCache
+    
+    try:
+        cache = PrefixCache(model)
+        for language in LANGUAGES:
+            prefix = system_prefix_ids(language)
+            if prefix:
+                cache.add(language, prefix)
+                logger.info(f"Cached {len(prefix)} system-prompt tokens for {language}")
+        prefix_cache = cache
+    except Exception as e:
+        logger.warning(f"System-prompt prefix cache disabled: {str(e)}")
+        prefix_cache = None
+
+def generate_response(message, language="english", on_text=None, stats=None, cancel_token=None, deadline=None,
+                      history=None, conversation=None, fast_path=True, raise_errors=False):
+    """
+    Generate a response using the DeepSeek-R1 model.
+    
+    on_text, if given, is called with each piece of text as soon as it is decoded.
+    stats, if given, is filled with usage and timing figures for the request.
+    Decoding stops early once cancel_token is cancelled or the deadline (epoch seconds) passes;
+    the partial response is returned and stats gets truncated=True and the finish_reason.
+    history holds earlier messages of the conversation identified by conversation; with
+    --max-context-tokens it is compacted to fit the budget.
+    Catalogue lookups are answered without generating unless fast_path is False.
+    A failure returns the localized apology, or raises with raise_errors (the daemon then
+    replies ok: false, so clients can tell it from an answer).
+    """
     global tokenizer, model
     
     try:
+        # Price, supplier, order and FAQ lookups are answered from the catalogue (ahead of the
+        # response cache, whose answers would go stale as prices change)
+        answered = lookup_answer(message, language) if fast_path and not history else None
+        if answered is not None:
+            if on_text is not None:
+                on_text(answered.answer)
+            if stats is not None:
+                stats["lookup"] = answered.intent
+            return answered.answer
+        
+        # Repeated questions are answered from the cache without touching the model
+        cached = None
+        if response_cache is not None and not history:
+            cached = response_cache.get(message, language, cache_params(language))
+        if cached is None and semantic_cache is not None and not history:
+            cached = semantic_cache.get(message, language, cache_params(language))
+        if cached is not None:
+            logger.info(f"Serving cached response for message in {language}")
+            if on_text is not None:
+                on_text(cached)
+            if stats is not None:
+                stats["cached"] = True
+            metrics.count("cached")
+            return cached
+        
         # Load model if not already loaded
         if tokenizer is None or model is None:
             success = load_model()
             if not success:
+                if raise_errors:
+                    raise RuntimeError("model failed to load")
                 return get_error_message(language)
         
         # Prepare system prompt based on language
@@ -78,42 +251,146 @@ def generate_response(message, language="english"):
         # Create messages list
         messages = [
             {"role": "system", "content": system_prompt},
+            *(history or []),
             {"role": "user", "content": message},
         ]
         
+        # Long conversations keep their recent turns plus a summary of the rest
+        compaction = None
+        if history and context is not None:
+            compaction = context.fit(messages, conversation=conversation)
+            messages = compaction.messages
+            if compaction.dropped:
+                metrics.compaction(compaction.tokens_before)
+        
         logger.info(f"Generating response for message in {language}")
+        started_at = time.time()
         
-        # Apply chat template
-        inputs = tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        ).to(model.device)
+        import torch
+        
+        # Apply chat template (assembled from cached token fragments, same ids as apply_chat_template)
+        prompt_ids = encode_chat(tokenizer, messages)
+        input_ids = torch.tensor([prompt_ids], device=model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        template_done_at = time.time()
+        
+        # Start from the cached system-prompt KV state so prefill only covers the user message
+        if prefix_cache is not None:
+            language_key = language.lower() if language.lower() in LANGUAGES else "english"
+            past_key_values, _ = prefix_cache.lookup(language_key, prompt_ids)
+            if past_key_values is not None:
+                inputs["past_key_values"] = past_key_values
+        
+        # With a thinking budget the <think> section is closed at the budget and not shown
+        budget = budget_for(THINKING_BUDGETS, language)
+        reasoning = ReasoningTracker.create(tokenizer, prompt_ids, budget) if budget is not None else None
+        
+        # Stream decoded text to the caller as tokens are produced (without on_text the
+        # streamer only notes when the first token arrives, for the prefill/decode split)
+        streamer = TokenStreamer(tokenizer, on_text,
+                                 answer_filter=ReasoningTracker.create(tokenizer, prompt_ids) if reasoning else None)
         
-        # Generate response
-        with torch.no_grad():
+        # Generate response (the registry keeps the model loaded until it finishes)
+        with registry.use(MODEL_NAME), torch.no_grad():
             outputs = model.generate(
                 **inputs,
-                max_new_tokens=500,  # Adjust based on your needs
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True
+                **GENERATION_PARAMS,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria(cancel_token, deadline),
+                logits_processor=budget_processor(reasoning) if reasoning is not None else None
             )
         
+        generated_at = time.time()
+        
+        # Stopped short of max_new_tokens without an end-of-sequence: cancelled or out of time
+        prompt_length = len(prompt_ids)
+        completion_tokens = outputs.shape[-1] - prompt_length
+        tokens_saved = GENERATION_PARAMS["max_new_tokens"] - completion_tokens
+        reason = None
+        if tokens_saved > 0 and outputs[0][-1].item() != tokenizer.eos_token_id:
+            reason = stop_reason(cancel_token, deadline)
+        if reason is not None:
+            logger.info(f"Generation stopped early ({reason}), {tokens_saved} tokens saved")
+            metrics.saved(tokens_saved, reason)
+        
         # Decode response
+        answer_ids, split = split_answer(tokenizer, prompt_ids, outputs[0][prompt_length:].tolist())
         response = tokenizer.decode(
-            outputs[0][inputs["input_ids"].shape[-1]:],
+            answer_ids if reasoning is not None else outputs[0][prompt_length:],
             skip_special_tokens=True
         )
+        finished_at = time.time()
+        
+        first_token_at = streamer.first_token_at or generated_at
+        metrics.record(
+            {
+                "template": template_done_at - started_at,
+                "prefill": first_token_at - template_done_at,
+                "decode": generated_at - first_token_at,
+                "detokenize": finished_at - generated_at + streamer.detokenize_seconds,
+            },
+            prompt_tokens=prompt_length,
+            output_tokens=completion_tokens,
+            outcome=reason or "ok",
+        )
+        if split is not None:
+            metrics.reasoning(language, split.reasoning_tokens, split.answer_tokens,
+                              reasoning is not None and reasoning.budget_exhausted)
+        
+        if stats is not None:
+            stats.update(timing_stats(
+                started_at,
+                streamer.first_token_at,
+                finished_at,
+                prompt_length,
+                completion_tokens
+            ))
+            if split is not None:
+                stats["usage"].update(reasoning_tokens=split.reasoning_tokens, answer_tokens=split.answer_tokens)
+            if compaction is not None and compaction.dropped:
+                stats["usage"].update(prompt_tokens_before_compaction=compaction.tokens_before,
+                                      dropped_messages=compaction.dropped,
+                                      summarized_messages=compaction.summarized)
+            if reason is not None:
+                stats.update(truncated=True, finish_reason=reason)
+        
+        # Partial answers and answers that depend on history are never cached
+        if reason is None and not history:
+            if response_cache is not None:
+                response_cache.put(message, language, cache_params(language), response)
+            if semantic_cache is not None:
+                semantic_cache.put(message, language, cache_params(language), response)
         
         logger.info("Response generated successfully")
         return response
     except Exception as e:
+        if raise_errors:
+            raise
         logger.error(f"Error generating response: {str(e)}")
+        metrics.count("error")
         return get_error_message(language)
 
+def lookup_answer(message, language):
+    """The lookup fast path's answer (a LookupResult), or None when it is off or declines the message"""
+    if lookup is None:
+        return None
+    result = lookup.lookup(message, language)
+    metrics.lookup(result)
+    if result.answer is None:
+        return None
+    logger.info(f"Answered {result.intent} lookup in {language} without generating")
+    return result
+
+def cache_params(language):
+    """Generation settings a cached answer depends on"""
+    budget = budget_for(THINKING_BUDGETS, language)
+    return GENERATION_PARAMS if budget is None else {**GENERATION_PARAMS, "thinking_budget": budget}
+
+def embed_message(message):
+    """Semantic cache embedding from the serving model's hidden states (--semantic-embedding model)"""
+    with registry.use(MODEL_NAME) as loaded:
+        return hidden_state_vector(loaded.model, loaded.tokenizer, message)
+
 def get_system_prompt(language):
     """Get system prompt based on language"""
     prompts = {
@@ -134,20 +411,568 @@ def get_error_message(language):
     }
     return messages.get(language.lower(), messages["english"])
 
+def parse_address(address):
+    """Split a listen address into a socket family and address ("host:port" or a socket path)"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and os.sep not in host:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError(f"Unix domain sockets are not supported here, use host:port instead of {address}")
+    return socket.AF_UNIX, address
+
+
+class InferenceWorker:
+    """
+    Owns the model for the daemon and runs queued generation requests on one thread.
+    
+    Waiting requests are served by priority class, then weighted-fair across tenants (see
+    deepseek_fairness); a running request is never interrupted for a more urgent one.
+    """
+
+    def __init__(self, tenants=None):
+        self.jobs = FairQueue(tenants)
+        self.loading = False
+        self.load_failed = False
+        self.served = 0
+        self.stopping = False
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        metrics.gauge("queue_depth", "Requests waiting for the inference worker", self.jobs.qsize)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def resident(self):
+        return tokenizer is not None and model is not None
+
+    @property
+    def ready(self):
+        # A model unloaded for idleness is reloaded by the next request, so the daemon stays ready
+        return self.resident or model_unloaded
+
+    def health(self):
+        """Health/ready probe payload"""
+        return {
+            "ready": self.ready,
+            "resident": self.resident,
+            "loading": self.loading,
+            "load_failed": self.load_failed,
+            "pending": self.jobs.qsize(),
+            "served": self.served,
+            "tenants": self.jobs.stats(),
+            "response_cache": response_cache.stats() if response_cache is not None else None,
+            "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+            "lookup": lookup.stats() if lookup is not None else None,
+            "context": context.stats() if context is not None else None,
+            "models": registry.stats(),
+            "uptime": round(time.time() - self.started_at, 3),
+        }
+
+    def submit(self, request, reply, cancel_token=None):
+        """
+        Queue a generate request; its optional "timeout" (seconds) is counted from now.
+        
+        Its optional "tenant" and "priority" ("interactive" or "batch") place it in the queue;
+        requests over the tenant's queue cap are rejected right away. Catalogue lookups (see
+        --lookup-data) are answered without queuing.
+        """
+        request_id = request.get("id")
+        if self.stopping:
+            reply({"id": request_id, "ok": False, "error": "the daemon is shutting down",
+                   "finish_reason": "shutdown"})
+            return
+        try:
+            priority_rank(request.get("priority"))
+            check_history(request.get("history"))
+        except ValueError as e:
+            reply({"id": request_id, "ok": False, "error": str(e)})
+            return
+        # Catalogue lookups are answered right away instead of waiting behind generations
+        if not request.get("history"):
+            answered = lookup_answer(request.get("message", ""), request.get("language", "english"))
+            if answered is not None:
+                if request.get("stream"):
+                    reply({"id": request_id, "event": "token", "text": answered.answer})
+                reply({"id": request_id, "ok": True, "response": answered.answer, "lookup": answered.intent})
+                return
+        deadline = time.time() + float(request["timeout"]) if request.get("timeout") else None
+        job = (request, reply, cancel_token, deadline, time.time())
+        if not self.jobs.put(job, request.get("tenant"), request.get("priority"),
+                             cost=GENERATION_PARAMS["max_new_tokens"]):
+            metrics.count("rejected")
+            reply({"id": request_id, "ok": False, "error": "tenant queue is full, retry later",
+                   "finish_reason": "rejected"})
+
+    def stop(self, timeout=None):
+        """Stop taking requests and wait until the queued ones have been answered"""
+        self.stopping = True
+        self.jobs.close()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        # Requests that raced with the shutdown still get an answer
+        while True:
+            job = self.jobs.get(timeout=0)
+            if job is None:
+                break
+            request, reply = job[0], job[1]
+            reply({"id": request.get("id"), "ok": False, "error": "the daemon is shutting down",
+                   "finish_reason": "shutdown"})
+
+    def _run(self):
+        self.loading = True
+        self.load_failed = not load_model()
+        self.loading = False
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            request, reply, cancel_token, deadline, queued_at = job
+            request_id = request.get("id")
+            language = request.get("language", "english")
+            tenant, priority = request.get("tenant"), request.get("priority")
+            queue_seconds = time.time() - queued_at
+            
+            # Drop requests whose client gave up or whose time ran out while they waited
+            reason = stop_reason(cancel_token, deadline)
+            if reason is not None:
+                metrics.count(reason)
+                metrics.saved(GENERATION_PARAMS["max_new_tokens"], reason)
+                reply({"id": request_id, "ok": False, "error": f"request stopped ({reason}) before generation started",
+                       "finish_reason": reason})
+                continue
+            
+            # Streaming requests get token events before the final reply
+            on_text = None
+            if request.get("stream"):
+                on_text = lambda text: reply({"id": request_id, "event": "token", "text": text})
+            stats = {}
+            try:
+                with model_lock.foreground():
+                    response = generate_response(request.get("message", ""), language, on_text=on_text,
+                                                 stats=stats, cancel_token=cancel_token, deadline=deadline,
+                                                 history=request.get("history"),
+                                                 conversation=request.get("conversation"), fast_path=False,
+                                                 raise_errors=True)
+                # Processed tokens count against the tenant's token-rate limit
+                tokens = stats.get("usage", {}).get("total_tokens", 0)
+                self.jobs.charge(tenant, tokens)
+                metrics.tenant(tenant, priority, queue_seconds, tokens)
+                self.served += 1
+                reply({"id": request_id, "ok": True, "response": response, **stats})
+            except Exception as e:
+                # Never let one request take the worker down
+                logger.error(f"Error serving request {request_id}: {str(e)}")
+                metrics.count("error")
+                try:
+                    reply({"id": request_id, "ok": False, "error": str(e)})
+                except Exception as reply_error:
+                    # The reply channel itself failed; the client is gone
+                    logger.error(f"Error replying to request {request_id}: {str(reply_error)}")
+
+
+def check_history(history):
+    """Raise ValueError unless history is None or a list of role/content messages"""
+    if history is None:
+        return
+    if not isinstance(history, list) or not all(
+            isinstance(message, dict) and message.get("role") in ("user", "assistant")
+            and isinstance(message.get("content"), str) for message in history):
+        raise ValueError("history must be a list of {role: user|assistant, content} messages")
+
+
+def handle_request(request, reply, worker, shutdown=None, tokens=None):
+    """
+    Dispatch one decoded daemon request; replies may arrive out of order and carry the request id.
+    
+    tokens maps the ids of the connection's unfinished generate requests to their cancellation
+    tokens, for the cancel op and for cancelling everything when the client disconnects.
+    """
+    request_id = request.get("id")
+    op = request.get("op", "generate")
+    if tokens is None:
+        tokens = {}
+
+    if op == "health":
+        reply({"id": request_id, "ok": True, **worker.health()})
+    elif op == "metrics":
+        reply({"id": request_id, "ok": True, "metrics": metrics.render()})
+    elif op == "generate":
+        if not request.get("message"):
+            reply({"id": request_id, "ok": False, "error": "message is required"})
+        else:
+            cancel_token = tokens[request_id] = CancellationToken()
+
+            def reply_and_forget(payload):
+                if "event" not in payload:
+                    tokens.pop(request_id, None)
+                reply(payload)
+
+            worker.submit(request, reply_and_forget, cancel_token)
+    elif op == "cancel":
+        # {"op": "cancel", "target": <id of a generate request on this connection>}
+        cancel_token = tokens.get(request.get("target"))
+        if cancel_token is not None:
+            cancel_token.cancel()
+        reply({"id": request_id, "ok": True, "cancelled": cancel_token is not None})
+    elif op == "shutdown":
+        reply({"id": request_id, "ok": True})
+        if shutdown is not None:
+            shutdown()
+    else:
+        reply({"id": request_id, "ok": False, "error": f"unknown op: {op}"})
+
+
+def decode_request(line):
+    """Parse a JSON-lines request, returning None and an error reply payload on bad input"""
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        return request, None
+    except ValueError as e:
+        return None, {"id": None, "ok": False, "error": f"invalid request: {e}"}
+
+
+def serve_stdio(worker):
+    """Serve JSON-lines requests from stdin, writing multiplexed replies to stdout"""
+    write_lock = threading.Lock()
+    done = threading.Event()
+
+    def reply(payload):
+        with write_lock:
+            sys.stdout.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+    logger.info("Serving JSON-lines requests on stdin/stdout")
+    tokens = {}
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request, error = decode_request(line)
+        if error:
+            reply(error)
+            continue
+        handle_request(request, reply, worker, shutdown=done.set, tokens=tokens)
+        if done.is_set():
+            break
+    else:
+        # stdin closed: nobody is left to read the answers still being generated
+        for cancel_token in list(tokens.values()):
+            cancel_token.cancel()
+    worker.stop()
+
+
+def serve_metrics(address):
+    """Serve GET /metrics in the Prometheus text format on host:port from a background thread"""
+    host, _, port = address.rpartition(":")
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on http://{host or '127.0.0.1'}:{port}/metrics")
+    return server
+
+
+def serve_socket(address, worker):
+    """Serve JSON-lines requests over a Unix domain socket (or localhost TCP)"""
+    family, bind_address = parse_address(address)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            write_lock = threading.Lock()
+
+            def reply(payload):
+                data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+                with write_lock:
+                    try:
+                        self.wfile.write(data)
+                        self.wfile.flush()
+                    except (OSError, ValueError):
+                        logger.debug("Client went away before reply %s", payload.get("id"))
+
+            tokens = {}
+            try:
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    request, error = decode_request(line.decode("utf-8"))
+                    if error:
+                        reply(error)
+                        continue
+                    handle_request(request, reply, worker, shutdown=shutdown, tokens=tokens)
+            except OSError:
+                pass
+            # The client disconnected: stop generating answers it can no longer receive
+            for cancel_token in list(tokens.values()):
+                cancel_token.cancel()
+
+    if family == socket.AF_INET:
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+    else:
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+    server = Server(bind_address, RequestHandler)
+
+    def shutdown():
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    logger.info(f"Serving JSON-lines requests on {address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        worker.stop()
+        if family != socket.AF_INET and os.path.exists(bind_address):
+            os.unlink(bind_address)
+
+
+def request_daemon(address, payload, timeout=600.0, on_event=None):
+    """
+    Send one request to a running daemon and wait for the final reply with the same id.
+    
+    Intermediate events for the request (streamed tokens) are passed to on_event.
+    """
+    family, connect_address = parse_address(address)
+    payload = {"id": uuid.uuid4().hex, **payload}
+
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(connect_address)
+        sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as replies:
+            for line in replies:
+                reply = json.loads(line)
+                if reply.get("id") != payload["id"]:
+                    continue
+                if "event" in reply:
+                    if on_event is not None:
+                        on_event(reply)
+                    continue
+                return reply
+    raise ConnectionError("Daemon closed the connection without replying")
+
+
+def start_daemon(address, timeout=60.0, extra_args=()):
+    """Start a background daemon on address and wait until it answers health probes"""
+    logger.info(f"Starting DeepSeek daemon on {address}")
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--listen", address, *extra_args],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return request_daemon(address, {"op": "health"}, timeout=5.0)
+        except (OSError, ValueError):
+            time.sleep(0.2)
+    raise ConnectionError(f"Daemon did not come up on {address} within {timeout}s")
+
+
+def daemon_args(args):
+    """Serving options to forward to an autostarted daemon"""
+    extra_args = []
+    if args.no_prefix_cache:
+        extra_args.append("--no-prefix-cache")
+    if args.no_response_cache:
+        extra_args.append("--no-response-cache")
+    if args.response_cache:
+        extra_args += ["--response-cache", os.path.abspath(args.response_cache)]
+    if args.cache_sampled:
+        extra_args.append("--cache-sampled")
+    if args.semantic_cache:
+        extra_args += ["--semantic-cache", "--semantic-threshold", str(args.semantic_threshold),
+                       "--semantic-embedding", args.semantic_embedding]
+    if args.lookup_data:
+        extra_args += ["--lookup-data", os.path.abspath(args.lookup_data)]
+    if args.metrics_listen:
+        extra_args += ["--metrics-listen", args.metrics_listen]
+    if args.model_idle_ttl is not None:
+        extra_args += ["--model-idle-ttl", str(args.model_idle_ttl)]
+    if args.model_memory_mb is not None:
+        extra_args += ["--model-memory-mb", str(args.model_memory_mb)]
+    for budget in args.thinking_budget or []:
+        extra_args += ["--thinking-budget", budget]
+    if args.tenant_policies:
+        extra_args += ["--tenant-policies", os.path.abspath(args.tenant_policies)]
+    if args.max_context_tokens is not None:
+        extra_args += ["--max-context-tokens", str(args.max_context_tokens)]
+    if args.no_context_summary:
+        extra_args.append("--no-context-summary")
+    return extra_args
+
+
+def run_client(args):
+    """One-shot CLI: forward the message to the daemon, starting it if needed"""
+    # The daemon stops generating a little before the client gives up, leaving time for the partial reply
+    payload = {"op": "generate", "message": args.message, "language": args.language, "stream": args.stream,
+               "timeout": max(args.timeout - 5.0, 1.0)}
+    if args.tenant:
+        payload["tenant"] = args.tenant
+    if args.priority:
+        payload["priority"] = args.priority
+
+    def print_event(event):
+        print(json.dumps(event, ensure_ascii=False), flush=True)
+
+    on_event = print_event if args.stream else None
+
+    if not args.in_process:
+        try:
+            try:
+                reply = request_daemon(args.listen, payload, timeout=args.timeout, on_event=on_event)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if args.no_autostart:
+                    raise
+                start_daemon(args.listen, extra_args=daemon_args(args))
+                reply = request_daemon(args.listen, payload, timeout=args.timeout, on_event=on_event)
+            if reply.get("ok"):
+                return reply["response"]
+            logger.error(f"Daemon rejected request: {reply.get('error')}")
+            return get_error_message(args.language)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Daemon unavailable ({e}), generating in-process")
+
+    on_text = (lambda text: print_event({"event": "token", "text": text})) if args.stream else None
+    return generate_response(args.message, args.language, on_text=on_text)
+
+
 def main():
     """Main function to parse arguments and generate response"""
     parser = argparse.ArgumentParser(description="DeepSeek-R1 Server Script")
-    parser.add_argument("--message", type=str, required=True, help="User message")
+    parser.add_argument("--message", type=str, help="User message")
     parser.add_argument("--language", type=str, default="english", 
                         help="Response language (english, hindi, marathi, gujarati)")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a long-lived daemon that loads the model once")
+    parser.add_argument("--stdio", action="store_true",
+                        help="With --serve, read JSON-lines requests from stdin instead of a socket")
+    parser.add_argument("--listen", type=str, default=DEFAULT_LISTEN,
+                        help="Daemon address: a Unix socket path or host:port")
+    parser.add_argument("--health", action="store_true",
+                        help="Print the daemon health/ready probe and exit")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="Seconds to wait for a daemon reply")
+    parser.add_argument("--no-autostart", action="store_true",
+                        help="Do not start a daemon when none is running")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Load the model in this process instead of using the daemon")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print token events as JSON lines before the final response")
+    parser.add_argument("--no-prefix-cache", action="store_true",
+                        help="Do not precompute the per-language system-prompt KV prefix")
+    parser.add_argument("--no-response-cache", action="store_true",
+                        help="Always generate, never answer from the response cache")
+    parser.add_argument("--response-cache", type=str, default=None,
+                        help="SQLite file that persists the response cache across restarts")
+    parser.add_argument("--cache-sampled", action="store_true",
+                        help="Serve cached answers even though generation samples (temperature > 0)")
+    parser.add_argument("--semantic-cache", action="store_true",
+                        help="Also answer near-verbatim repeats (word order, an extra word) of earlier "
+                             "questions from the cache")
+    parser.add_argument("--semantic-threshold", type=float, default=0.85,
+                        help="Minimum cosine similarity for a semantic cache hit")
+    parser.add_argument("--semantic-embedding", choices=("ngram", "model"), default="ngram",
+                        help="Semantic cache embedding: hashed word/trigram vectors (near-verbatim repeats) or "
+                             "the mean of the model's hidden states (also paraphrases; costs a forward pass)")
+    parser.add_argument("--lookup-data", type=str, default=None, metavar="PATH",
+                        help="JSON catalogue/FAQ file; price, supplier, order and FAQ lookups are answered "
+                             "from it without generating (re-read when it changes)")
+    parser.add_argument("--metrics-listen", type=str, default=None,
+                        help="With --serve, also serve Prometheus metrics over HTTP on host:port")
+    parser.add_argument("--model-idle-ttl", type=float, default=None,
+                        help="Unload the model after this many idle seconds (reloaded on demand)")
+    parser.add_argument("--model-memory-mb", type=int, default=None,
+                        help="Memory budget for loaded models; least recently used ones are unloaded")
+    parser.add_argument("--thinking-budget", action="append", default=None, metavar="[LANGUAGE=]TOKENS",
+                        help="Cap the <think> section at TOKENS and leave it out of responses; "
+                             "repeat with LANGUAGE= for per-language budgets")
+    parser.add_argument("--tenant", type=str, default=None,
+                        help="Tenant id the request is queued and rate limited under")
+    parser.add_argument("--priority", type=str, default=None, choices=PRIORITIES,
+                        help="Priority class of the request (default: interactive)")
+    parser.add_argument("--tenant-policies", type=str, default=None, metavar="PATH",
+                        help="With --serve, JSON file of per-tenant weights, token-rate limits and queue caps")
+    parser.add_argument("--max-context-tokens", type=int, default=None,
+                        help="Prompt-token budget for requests with history; older turns are summarised and left out")
+    parser.add_argument("--no-context-summary", action="store_true",
+                        help="With --max-context-tokens, drop old turns without summarising them")
     args = parser.parse_args()
     
+    global use_prefix_cache, response_cache, semantic_cache, THINKING_BUDGETS, MAX_CONTEXT_TOKENS, CONTEXT_SUMMARIES
+    global lookup
+    use_prefix_cache = not args.no_prefix_cache
+    MAX_CONTEXT_TOKENS = args.max_context_tokens
+    CONTEXT_SUMMARIES = not args.no_context_summary
+    THINKING_BUDGETS = parse_budgets(args.thinking_budget)
+    if args.no_response_cache:
+        response_cache = None
+    else:
+        response_cache = ResponseCache(MODEL_NAME, path=args.response_cache, allow_sampled=args.cache_sampled)
+    if args.lookup_data:
+        lookup = LookupFastPath(args.lookup_data)
+    if args.semantic_cache:
+        # With a catalogue, questions about different products never share an answer
+        semantic_cache = SemanticCache(MODEL_NAME, threshold=args.semantic_threshold,
+                                       embed=embed_message if args.semantic_embedding == "model" else None,
+                                       entities=lookup.names if lookup is not None else None,
+                                       allow_sampled=args.cache_sampled)
+    registry.idle_ttl = args.model_idle_ttl
+    if args.model_memory_mb is not None:
+        registry.memory_budget_bytes = args.model_memory_mb * 1024 * 1024
+
+    if args.serve:
+        if args.metrics_listen:
+            serve_metrics(args.metrics_listen)
+        worker = InferenceWorker(load_policies(args.tenant_policies)).start()
+        if args.stdio:
+            serve_stdio(worker)
+        else:
+            serve_socket(args.listen, worker)
+        return
+
+    if args.health:
+        try:
+            result = request_daemon(args.listen, {"op": "health"}, timeout=5.0)
+        except OSError as e:
+            result = {"ok": False, "ready": False, "error": str(e)}
+        print(json.dumps(result))
+        sys.exit(0 if result.get("ready") else 1)
+
+    if not args.message:
+        parser.error("--message is required unless --serve or --health is given")
+
     # Generate response
-    response = generate_response(args.message, args.language)
+    response = run_client(args)
     
     # Output JSON response
     result = {"response": response}
     print(json.dumps(result))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,230 @@
+# DeepSeek Chat Sessions
+# Keeps each conversation's transcript and KV cache so a new turn only prefills its own tokens.
+# KV caches live under a memory budget with LRU eviction and an idle TTL; a session whose
+# cache was evicted keeps its transcript and simply falls back to a full re-prefill.
+# With a paged KV cache, a session holds a block table of the pool instead; those caches are
+# evicted when the pool runs out of blocks (see release_table).
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+import threading
+import time
+
+from deepseek_errors import SessionBusyError
+
+# deepseek_kv pulls in torch; the store itself is created before any model is loaded
+if TYPE_CHECKING:
+    from deepseek_kv import KVLayers
+
+
+class Session:
+    """One conversation: its messages plus the KV cache of the tokens last run through the model"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: List[Dict[str, str]] = []
+        self.kv_ids: Tuple[int, ...] = ()
+        self.kv_layers: Optional["KVLayers"] = None
+        # deepseek_paged.BlockTable holding the cache in a paged KV pool, instead of kv_layers
+        self.kv_table = None
+        self.kv_bytes = 0
+        self.last_used = time.time()
+        # How the last turn's history was fitted into the context budget (deepseek_context.Compaction)
+        self.compaction = None
+        # Claim of the turn in flight (see SessionStore.begin_turn); None when the session is idle
+        self.turn = None
+        self.turn_started = 0.0
+
+    def drop_cache(self):
+        if self.kv_table is not None:
+            self.kv_table.pool.free(self.kv_table)
+        self.kv_ids = ()
+        self.kv_layers = None
+        self.kv_table = None
+        self.kv_bytes = 0
+
+
+class SessionStore:
+    """Session transcripts with budgeted, LRU-evicted KV caches"""
+
+    def __init__(self,
+                 memory_budget_bytes: int = 512 * 1024 * 1024,
+                 ttl_seconds: float = 1800.0,
+                 max_sessions: int = 10000):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+
+        # Ordered from least to most recently used
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_expiry = time.time()
+        self.kv_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def get(self, session_id: str) -> Session:
+        """Return the session with this id, creating it if needed"""
+        with self._lock:
+            self._expire_locked()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    _, oldest = self._sessions.popitem(last=False)
+                    self._drop_cache_locked(oldest)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def lookup(self, session: Session, input_ids: Sequence[int]) -> Tuple[Optional["KVLayers"], int]:
+        """
+        Return the cached KV covering the longest reusable prefix of input_ids, and its length.
+
+        At least one token is always left to prefill; (None, 0) means a full re-prefill.
+        """
+        from deepseek_kv import common_prefix_length, slice_positions
+
+        with self._lock:
+            reused = 0
+            if session.kv_layers is not None:
+                reused = min(common_prefix_length(session.kv_ids, input_ids), len(input_ids) - 1)
+            if reused > 0:
+                self.hits += 1
+                self.reused_tokens += reused
+                self.prefilled_tokens += len(input_ids) - reused
+                return slice_positions(session.kv_layers, 0, reused), reused
+            self.misses += 1
+            self.prefilled_tokens += len(input_ids)
+            return None, 0
+
+    def lookup_table(self, session: Session, input_ids: Sequence[int], pool) -> Tuple[Optional[object], int]:
+        """lookup() for a paged KV cache: a table of pool sharing the session's blocks for the reusable prefix"""
+        from deepseek_kv import common_prefix_length
+
+        with self._lock:
+            reused = 0
+            if session.kv_table is not None and session.kv_table.pool is pool:
+                reused = min(common_prefix_length(session.kv_ids, input_ids), len(input_ids) - 1)
+            if reused > 0:
+                self.hits += 1
+                self.reused_tokens += reused
+                self.prefilled_tokens += len(input_ids) - reused
+                return pool.fork(session.kv_table, reused), reused
+            self.misses += 1
+            self.prefilled_tokens += len(input_ids)
+            return None, 0
+
+    def store_table(self, session: Session, token_ids: Sequence[int], table):
+        """Keep a block table as the session's cache for token_ids (the pool bounds their memory)"""
+        with self._lock:
+            self._drop_cache_locked(session)
+            if session.session_id not in self._sessions:
+                table.pool.free(table)
+                return
+            session.kv_ids = tuple(token_ids)
+            session.kv_table = table
+            session.last_used = time.time()
+            self._sessions.move_to_end(session.session_id)
+
+    def release_table(self) -> bool:
+        """Drop the least recently used session's block table; the KV pool calls this when it is full"""
+        with self._lock:
+            for session in self._sessions.values():
+                if session.kv_table is not None:
+                    self._drop_cache_locked(session)
+                    self.evictions += 1
+                    return True
+        return False
+
+    def store(self, session: Session, token_ids: Sequence[int], layers: "KVLayers"):
+        """Keep layers as the session's cache for token_ids, evicting other caches to fit the budget"""
+        from deepseek_kv import layers_nbytes
+
+        nbytes = layers_nbytes(layers)
+        with self._lock:
+            self._drop_cache_locked(session)
+            if nbytes > self.memory_budget_bytes or session.session_id not in self._sessions:
+                return
+            session.kv_ids = tuple(token_ids)
+            session.kv_layers = layers
+            session.kv_bytes = nbytes
+            self.kv_bytes += nbytes
+            session.last_used = time.time()
+            self._sessions.move_to_end(session.session_id)
+
+            # Evict least recently used caches until the budget holds
+            for other in list(self._sessions.values()):
+                if self.kv_bytes <= self.memory_budget_bytes:
+                    break
+                if other is not session and other.kv_layers is not None:
+                    self._drop_cache_locked(other)
+                    self.evictions += 1
+
+    def begin_turn(self, session: Session, stale_after: Optional[float] = None) -> object:
+        """
+        Claim the session for a new turn, so its transcript is read and extended by one turn at a
+        time. Returns the claim to pass to end_turn; raises SessionBusyError while another turn is
+        in flight. A claim older than stale_after seconds is taken to be abandoned.
+        """
+        with self._lock:
+            now = time.time()
+            if session.turn is not None and (stale_after is None or now - session.turn_started < stale_after):
+                raise SessionBusyError(f"session {session.session_id} is still answering the previous message")
+            session.turn = object()
+            session.turn_started = now
+            return session.turn
+
+    def end_turn(self, session: Session, turn: object):
+        """Release a claim taken by begin_turn (a no-op once a newer turn has taken over)"""
+        with self._lock:
+            if session.turn is turn:
+                session.turn = None
+
+    def delete(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._drop_cache_locked(session)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "cached_sessions": sum(1 for s in self._sessions.values()
+                                       if s.kv_layers is not None or s.kv_table is not None),
+                "kv_bytes": self.kv_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "reused_tokens": self.reused_tokens,
+                "prefilled_tokens": self.prefilled_tokens,
+            }
+
+    def _drop_cache_locked(self, session: Session):
+        self.kv_bytes -= session.kv_bytes
+        session.drop_cache()
+
+    def _expire_locked(self):
+        """Drop caches idle past the TTL (checked at most once a second)"""
+        now = time.time()
+        if now - self._last_expiry < 1.0:
+            return
+        self._last_expiry = now
+        for session in self._sessions.values():
+            if session.last_used >= now - self.ttl_seconds:
+                # Sessions are ordered by last use, so the rest are fresher
+                break
+            if session.kv_layers is not None or session.kv_table is not None:
+                self._drop_cache_locked(session)
+                self.expirations += 1
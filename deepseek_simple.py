@@ -1,12 +1,18 @@
 # Simple DeepSeek-R1 Implementation
 # A minimal implementation for using DeepSeek-R1 model
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import os
+
+# DEEPSEEK_MODEL may point at a local checkpoint made by deepseek_checkpoint.py prepare
+MODEL_NAME = os.environ.get("DEEPSEEK_MODEL", "deepseek-ai/DeepSeek-R1")
 
 # Load model and tokenizer
 print("Loading model and tokenizer...")
-tokenizer = AutoTokenizer.from_pretrained("deepseek-ai/DeepSeek-R1", trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained("deepseek-ai/DeepSeek-R1", trust_remote_code=True)
+from transformers import AutoTokenizer
+import deepseek_checkpoint
+
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
+model = deepseek_checkpoint.load_model(MODEL_NAME)
 
 # User message
 user_message = "Who are you?"
@@ -0,0 +1,106 @@
+# DeepSeek Speculative Decoding
+# A small draft model proposes several tokens, and the full model checks all of them in a
+# single forward pass. Under greedy decoding a proposal is kept only if it is the token the
+# full model would have picked anyway, so the output is the same as normal decoding. Each
+# verification pass adds at least one token, and up to lookahead + 1 when the draft agrees.
+#
+# The draft must share the full model's tokenizer, e.g. a small distilled checkpoint of the
+# same family.
+
+from typing import Dict, Optional, Tuple
+import time
+
+import torch
+from transformers import DynamicCache
+
+
+def check_compatible(tokenizer, draft_tokenizer):
+    """Raise ValueError unless the draft model's tokenizer maps text to the same ids"""
+    if tokenizer.get_vocab() != draft_tokenizer.get_vocab():
+        raise ValueError("The draft model must use the same tokenizer as the main model")
+
+
+def _forward(model, input_ids: torch.Tensor, cache: DynamicCache) -> torch.Tensor:
+    """Run input_ids through model on top of cache and return the logits for every position"""
+    return model(input_ids=input_ids, past_key_values=cache, use_cache=True).logits[0]
+
+
+def _truncate(cache: DynamicCache, length: int):
+    """Drop cached positions beyond length"""
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+
+@torch.no_grad()
+def speculative_generate(model, draft_model, input_ids: torch.Tensor, max_new_tokens: int = 100,
+                         lookahead: int = 4, eos_token_id: Optional[int] = None
+                         ) -> Tuple[torch.Tensor, Dict[str, float]]:
+    """
+    Greedy decoding of one prompt ([1, prompt_len]) with draft-model speculation.
+
+    Returns the prompt followed by the generated ids, as model.generate() does, and the
+    statistics of the run: proposed and accepted draft tokens, the acceptance rate and the
+    number of main-model forward passes.
+    """
+    if input_ids.shape[0] != 1:
+        raise ValueError("Speculative decoding handles one prompt at a time")
+    started = time.perf_counter()
+    device = input_ids.device
+    prompt_length = input_ids.shape[-1]
+    sequence = input_ids[0].tolist()
+    target_cache, draft_cache = DynamicCache(), DynamicCache()
+
+    # The main model reads the whole prompt once and picks the first token itself
+    logits = _forward(model, input_ids, target_cache)
+    sequence.append(int(logits[-1].argmax()))
+    target_passes, proposed, accepted = 1, 0, 0
+
+    while len(sequence) - prompt_length < max_new_tokens and sequence[-1] != eos_token_id:
+        remaining = max_new_tokens - (len(sequence) - prompt_length)
+        steps = min(lookahead, remaining - 1)
+
+        # Draft: catch up on the tokens it has not seen, then propose `steps` tokens greedily
+        drafts = []
+        pending = sequence[draft_cache.get_seq_length():]
+        for _ in range(steps):
+            logits = _forward(draft_model, torch.tensor([pending], device=device), draft_cache)
+            token = int(logits[-1].argmax())
+            drafts.append(token)
+            if token == eos_token_id:
+                break
+            pending = [token]
+        proposed += len(drafts)
+
+        # Verify: one main-model pass scores the unseen accepted tokens plus every proposal
+        known = target_cache.get_seq_length()
+        new_ids = sequence[known:] + drafts
+        logits = _forward(model, torch.tensor([new_ids], device=device), target_cache)
+        target_passes += 1
+        choices = logits[len(new_ids) - len(drafts) - 1:].argmax(dim=-1).tolist()
+
+        # Keep proposals while they match the main model's choice, then take its next token
+        matched = 0
+        while matched < len(drafts) and drafts[matched] == choices[matched]:
+            matched += 1
+        accepted += matched
+        sequence += drafts[:matched] + [choices[matched]]
+        if eos_token_id in sequence[-matched - 1:]:
+            del sequence[sequence.index(eos_token_id, len(sequence) - matched - 1) + 1:]
+
+        # Forget the rejected proposals; the last token is fed on the next round
+        _truncate(target_cache, len(sequence) - 1)
+        _truncate(draft_cache, len(sequence) - 1)
+
+    del sequence[prompt_length + max_new_tokens:]
+    new_tokens = len(sequence) - prompt_length
+    stats = {
+        "new_tokens": new_tokens,
+        "draft_tokens": proposed,
+        "accepted_tokens": accepted,
+        "acceptance_rate": accepted / proposed if proposed else 0.0,
+        "target_passes": target_passes,
+        "tokens_per_pass": new_tokens / target_passes,
+        "seconds": time.perf_counter() - started,
+    }
+    return torch.tensor([sequence], device=device), stats
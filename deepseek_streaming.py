@@ -0,0 +1,120 @@
+# DeepSeek Token Streaming Helpers
+# Incremental detokenisation and server-sent-events formatting for streamed responses.
+
+from typing import Callable, List, Optional
+import json
+import time
+
+
+class IncrementalDetokenizer:
+    """
+    Turn a growing list of token ids into text deltas.
+
+    Byte-level tokenizers split Devanagari and Gujarati characters across several tokens,
+    so decoding each token on its own yields replacement characters. Instead we re-decode a
+    short window that starts a few tokens back and only emit text once it no longer ends in
+    an incomplete character (U+FFFD).
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id: int) -> str:
+        """Append one token id and return any newly completed text"""
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        """Return whatever text is still held back at the end of generation"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class TokenStreamer:
+    """
+    Streamer for ``model.generate(streamer=...)`` that forwards text deltas to a callback.
+
+    generate() passes the prompt on the first put() call; it is skipped so only new tokens
+    are streamed. With on_text=None nothing is decoded and only the first-token time is kept.
+    answer_filter (a ReasoningTracker) holds back the tokens of the <think> section.
+    """
+
+    def __init__(self, tokenizer, on_text: Optional[Callable[[str], None]], skip_special_tokens: bool = True,
+                 answer_filter=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=skip_special_tokens)
+        self.on_text = on_text
+        self.answer_filter = answer_filter
+        self.prompt_seen = False
+        self.started_at = time.time()
+        self.first_token_at: Optional[float] = None
+        self.detokenize_seconds = 0.0
+
+    @property
+    def token_count(self) -> int:
+        return len(self.detokenizer.token_ids)
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        if self.on_text is None:
+            return
+        for token_id in value.reshape(-1).tolist():
+            if self.answer_filter is not None and not self.answer_filter.observe(token_id):
+                continue
+            started = time.perf_counter()
+            text = self.detokenizer.add(int(token_id))
+            self.detokenize_seconds += time.perf_counter() - started
+            if text:
+                self.on_text(text)
+
+    def end(self):
+        if self.on_text is None:
+            return
+        text = self.detokenizer.flush()
+        if text:
+            self.on_text(text)
+
+
+def timing_stats(started_at: float, first_token_at: Optional[float], finished_at: float,
+                 prompt_tokens: int, completion_tokens: int) -> dict:
+    """Usage and timing summary sent with the final event of a streamed response"""
+    total = finished_at - started_at
+    decode_time = finished_at - first_token_at if first_token_at else 0.0
+    return {
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+        "timing": {
+            "time_to_first_token": round(first_token_at - started_at, 4) if first_token_at else None,
+            "total_time": round(total, 4),
+            "tokens_per_second": round(completion_tokens / total, 2) if total > 0 else None,
+            "decode_tokens_per_second": round((completion_tokens - 1) / decode_time, 2)
+            if decode_time > 0 and completion_tokens > 1 else None,
+        },
+    }
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
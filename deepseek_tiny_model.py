@@ -0,0 +1,111 @@
+# Tiny DeepSeek-style Model Builder
+# Writes a small, randomly initialised causal LM and tokenizer to a local directory so the
+# serving code can be exercised offline on a CPU box without downloading DeepSeek-R1.
+
+import argparse
+import os
+
+from tokenizers import ByteLevelBPETokenizer
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+import torch
+
+# Special tokens follow the DeepSeek-R1 tokenizer so chat templates and <think> handling match
+BOS_TOKEN = "<｜begin▁of▁sentence｜>"
+EOS_TOKEN = "<｜end▁of▁sentence｜>"
+PAD_TOKEN = "<｜▁pad▁｜>"
+USER_TOKEN = "<｜User｜>"
+ASSISTANT_TOKEN = "<｜Assistant｜>"
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+# Simplified DeepSeek-R1 chat template: system prompt first, then alternating turns
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}{{ message['content'] }}"
+    "{% elif message['role'] == 'user' %}" + USER_TOKEN + "{{ message['content'] }}"
+    "{% elif message['role'] == 'assistant' %}" + ASSISTANT_TOKEN + "{{ message['content'] }}" + EOS_TOKEN +
+    "{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}" + ASSISTANT_TOKEN + THINK_START + "\n{% endif %}"
+)
+
+# Small multilingual corpus of vendor questions used to train the tokenizer
+CORPUS = [
+    "You are a helpful assistant for BazaarBandhu, a platform that connects local artisans with customers.",
+    "What is today's onion price? How do I register as a supplier? Where is my order?",
+    "Show me suppliers of tomatoes and potatoes near Dadar with delivery today.",
+    "आज प्याज का भाव क्या है? मैं सप्लायर के रूप में कैसे रजिस्टर करूँ? मेरा ऑर्डर कहाँ है?",
+    "आज कांद्याचा भाव काय आहे? मी पुरवठादार म्हणून नोंदणी कशी करू? माझी ऑर्डर कुठे आहे?",
+    "આજે ડુંગળીનો ભાવ શું છે? હું સપ્લાયર તરીકે કેવી રીતે નોંધણી કરું? મારો ઓર્ડર ક્યાં છે?",
+    "आप बाज़ारबंधु के लिए एक सहायक हैं। संक्षिप्त, सटीक और सहायक प्रतिक्रियाएँ प्रदान करें।",
+    "तुम्ही बाजारबंधु साठी एक मदतगार आहात. संक्षिप्त, अचूक आणि मदतगार प्रतिसाद द्या.",
+    "તમે બજારબંધુ માટે એક મદદગાર સહાયક છો. સંક્ષિપ્ત, ચોક્કસ અને મદદરૂપ પ્રતિભાવો આપો.",
+]
+
+
+def build_tokenizer(vocab_size=512):
+    """Train a small byte-level BPE tokenizer with the DeepSeek-R1 special tokens"""
+    special_tokens = [BOS_TOKEN, EOS_TOKEN, PAD_TOKEN, USER_TOKEN, ASSISTANT_TOKEN, THINK_START, THINK_END]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(CORPUS * 4, vocab_size=vocab_size, min_frequency=1,
+                            special_tokens=special_tokens, show_progress=False)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe._tokenizer,
+        bos_token=BOS_TOKEN,
+        eos_token=EOS_TOKEN,
+        pad_token=PAD_TOKEN,
+        additional_special_tokens=[USER_TOKEN, ASSISTANT_TOKEN],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_model(tokenizer, hidden_size=64, num_layers=2, num_heads=4, seed=0):
+    """Create a randomly initialised Llama-architecture causal LM sized for CPU tests"""
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_heads,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model
+
+
+def create_tiny_model(output_dir, hidden_size=64, num_layers=2, num_heads=4, seed=0):
+    """Write a tiny model and tokenizer to output_dir and return the directory"""
+    tokenizer = build_tokenizer()
+    model = build_model(tokenizer, hidden_size=hidden_size, num_layers=num_layers,
+                        num_heads=num_heads, seed=seed)
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+    model.save_pretrained(output_dir)
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a tiny random DeepSeek-style model for offline testing")
+    parser.add_argument("output_dir", type=str, help="Directory to write the model and tokenizer to")
+    parser.add_argument("--hidden-size", type=int, default=64, help="Hidden size of the model")
+    parser.add_argument("--layers", type=int, default=2, help="Number of transformer layers")
+    parser.add_argument("--heads", type=int, default=4, help="Number of attention heads")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the weights")
+    args = parser.parse_args()
+
+    create_tiny_model(args.output_dir, hidden_size=args.hidden_size, num_layers=args.layers,
+                      num_heads=args.heads, seed=args.seed)
+    print(f"Tiny model written to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,129 @@
 # DeepSeek-R1 Web Application
-# A simple Flask web application that uses DeepSeek-R1 for text generation
+# A simple Flask web application that uses DeepSeek-R1 for text generation.
+# Chat requests are decoded together by a continuous batching scheduler that owns the model.
+# Requests may name a tenant and a priority class ("interactive" or "batch"); the scheduler
+# serves interactive traffic first and shares decode slots fairly across tenants.
+# Identical questions asked while one is being answered share that generation (deepseek_coalesce).
+# With --model-tiers, simple messages are answered by smaller models first (deepseek_routing).
+# With --lookup-data, catalogue lookups are answered without generating (deepseek_lookup).
 
-from flask import Flask, request, jsonify, render_template_string
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
 import threading
 import time
 import argparse
+import logging
+
+from deepseek_cache import ResponseCache, SemanticCache, cache_key, hidden_state_vector
+from deepseek_cancel import CancellationToken
+from deepseek_coalesce import RequestCoalescer
+from deepseek_context import ContextManager, model_summarizer
+from deepseek_errors import DeadlineExceeded, QueueFullError, SessionBusyError
+from deepseek_fairness import load_policies, priority_rank
+from deepseek_lookup import LookupFastPath
+from deepseek_metrics import CONTENT_TYPE, InferenceMetrics
+from deepseek_prompts import encode_chat
+from deepseek_reasoning import ReasoningTracker, budget_for, parse_budgets, split_answer
+from deepseek_registry import registry
+from deepseek_routing import TierRouter, TierServer, load_tiers
+from deepseek_sessions import SessionStore
+from deepseek_streaming import IncrementalDetokenizer, format_sse, timing_stats
 
 app = Flask(__name__)
 
 # Global variables to store model and tokenizer
+MODEL_NAME = "deepseek-ai/DeepSeek-R1"
+MAX_BATCH_SIZE = 8
+MAX_QUEUE_DEPTH = 64
+NUM_WORKERS = 0
+REQUEST_TIMEOUT = 120.0
+# Extra seconds to wait for a request past its deadline: the scheduler stops it at the next step
+DEADLINE_GRACE = 5.0
 tokenizer = None
 model = None
+scheduler = None
 model_loaded = False
 model_loading = False
+model_load_failed = False
+load_lock = threading.Lock()
+
+# Generation settings used for every chat turn (also part of the response cache key)
+GENERATION_PARAMS = {
+    "max_new_tokens": 100,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "do_sample": True,
+}
+
+# Reasoning-token budgets by language ("default" for the rest); when set, the <think> section
+# is closed at the budget and left out of responses
+THINKING_BUDGETS = {}
+
+# Per-tenant weights, token-rate limits and queue caps (deepseek_fairness.TenantPolicy), and
+# whether interactive requests may take the decode slot of a running batch request
+TENANT_POLICIES = {}
+PREEMPTION = True
+
+# Multi-turn conversations, keyed by the session_id clients send with each message
+sessions = SessionStore()
+
+# Paged KV cache: size of the preallocated block pool (None: contiguous per-batch KV tensors)
+# and tokens per block. Session caches then live in the pool and are evicted when it is full.
+KV_POOL_MB = None
+KV_BLOCK_SIZE = 16
+
+# Prompt-token budget for session turns: older turns are summarised in the background and
+# left out (None: history is sent in full)
+MAX_CONTEXT_TOKENS = None
+CONTEXT_SUMMARIES = True
+context = None
+
+# Answers to repeated single-turn questions; configured from the command line in main()
+response_cache = None
+semantic_cache = None
+# Concurrent identical single-turn requests share one generation; followers wait this many
+# seconds for the leader's first token before generating their own answer
+COALESCE_WAIT = 10.0
+coalescer = None
+
+# Smaller model tiers tried before the serving model, from the --model-tiers file
+MODEL_TIERS = []
+ROUTER_OPTIONS = {}
+tiers = []
+router = None
+
+# Price, supplier, order and FAQ lookups answered from the --lookup-data catalogue
+lookup = None
+
+# Per-stage request timings and serving gauges, exposed on /metrics
+metrics = InferenceMetrics()
+metrics.gauge("model_loaded", "1 once the model is ready to serve", lambda: int(model_loaded))
+metrics.gauge("queue_depth", "Requests waiting for a batch slot",
+              lambda: scheduler.stats()["queued"] if scheduler is not None else 0)
+metrics.gauge("active_requests", "Requests currently being decoded",
+              lambda: scheduler.stats()["active"] if scheduler is not None else 0)
+metrics.gauge("session_kv_cache_bytes", "Memory held by cached session KV state",
+              lambda: sessions.kv_bytes)
+metrics.gauge("coalesced_generations_saved", "Generations not run because an identical request was in flight",
+              lambda: coalescer.stats()["generations_saved"] if coalescer is not None else 0)
+metrics.gauge("lookup_hit_rate", "Share of checked messages the lookup fast path answered without generating",
+              lambda: lookup.stats()["hit_rate"] if lookup is not None else None)
+metrics.gauge("coalesce_in_flight", "Generations that identical requests can currently attach to",
+              lambda: coalescer.stats()["in_flight"] if coalescer is not None else 0)
+
+
+def kv_pool_stat(name):
+    """A statistic of the in-process scheduler's paged KV pool, or None without one"""
+    pool = getattr(scheduler, "kv_pool", None)
+    return pool.stats()[name] if pool is not None else None
+
+
+metrics.gauge("kv_pool_used_blocks", "Paged KV cache blocks in use", lambda: kv_pool_stat("used_blocks"))
+metrics.gauge("kv_pool_utilization", "Fraction of paged KV cache blocks in use",
+              lambda: kv_pool_stat("utilization"))
+metrics.gauge("kv_pool_shared_blocks", "Paged KV cache blocks shared by several sequences",
+              lambda: kv_pool_stat("shared_blocks"))
+metrics.gauge("kv_pool_prefix_hit_tokens", "Prompt tokens matched to pool blocks of an earlier prompt prefix",
+              lambda: kv_pool_stat("prefix_hit_tokens"))
 
 # HTML template for the web interface
 HTML_TEMPLATE = '''
@@ -133,6 +242,7 @@ HTML_TEMPLATE = '''
         const sendButton = document.getElementById('send-button');
         const loadingIndicator = document.getElementById('loading');
         const modelStatus = document.getElementById('model-status');
+        const sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : String(Date.now() + Math.random());
         
         // Check model status periodically
         function checkModelStatus() {
@@ -166,6 +276,7 @@ HTML_TEMPLATE = '''
             messageDiv.textContent = text;
             chatContainer.appendChild(messageDiv);
             chatContainer.scrollTop = chatContainer.scrollHeight;
+            return messageDiv;
         }
         
         // Send message function
@@ -182,19 +293,45 @@ HTML_TEMPLATE = '''
             sendButton.disabled = true;
             loadingIndicator.style.display = 'block';
             
-            // Send request to server
-            fetch('/api/chat', {
+            // Stream the response from the server as server-sent events
+            const botMessage = addMessage('', false);
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            function handleEvent(block) {
+                const event = (block.match(/^event: (.*)$/m) || [])[1];
+                const data = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || '{}');
+                if (event === 'token') {
+                    loadingIndicator.style.display = 'none';
+                    botMessage.textContent += data.text;
+                    chatContainer.scrollTop = chatContainer.scrollHeight;
+                } else if (event === 'error') {
+                    botMessage.textContent += data.error;
+                }
+            }
+            
+            fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ message: message }),
+                body: JSON.stringify({ message: message, session_id: sessionId }),
+            })
+            .then(response => {
+                const reader = response.body.getReader();
+                function read() {
+                    return reader.read().then(({ done, value }) => {
+                        if (done) return;
+                        buffer += decoder.decode(value, { stream: true });
+                        const blocks = buffer.split('\n\n');
+                        buffer = blocks.pop();
+                        blocks.forEach(handleEvent);
+                        return read();
+                    });
+                }
+                return read();
             })
-            .then(response => response.json())
-            .then(data => {
-                // Add bot response to chat
-                addMessage(data.response, false);
-                
+            .then(() => {
                 // Re-enable input and hide loading
                 userInput.disabled = false;
                 sendButton.disabled = false;
@@ -225,41 +362,140 @@ HTML_TEMPLATE = '''
 
 def load_model_in_background():
     """Load the model in a background thread"""
-    global tokenizer, model, model_loaded, model_loading
+    global tokenizer, scheduler, model_loaded, model_loading, model_load_failed
     
     model_loading = True
+    model_load_failed = False
     try:
-        # Load tokenizer
-        tokenizer = AutoTokenizer.from_pretrained("deepseek-ai/DeepSeek-R1", trust_remote_code=True)
+        # torch and transformers are imported here so serving the page and /api/status stays cheap
+        import torch
+        
+        if NUM_WORKERS > 0:
+            # Inference runs in pinned worker processes sharing one memory-mapped copy of the weights
+            from transformers import AutoTokenizer
+            from deepseek_workers import WorkerPool
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
+            print(f"Starting {NUM_WORKERS} inference workers...")
+            scheduler = WorkerPool(MODEL_NAME, NUM_WORKERS, max_batch_size=MAX_BATCH_SIZE,
+                                   max_queue_depth=MAX_QUEUE_DEPTH, tenants=TENANT_POLICIES,
+                                   preemption=PREEMPTION,
+                                   kv_pool_bytes=int(KV_POOL_MB * 1024 * 1024) if KV_POOL_MB else None,
+                                   kv_block_size=KV_BLOCK_SIZE).start()
+            start_context()
+            model_loaded = True
+            print("Model loaded successfully!")
+            start_tiers()
+            return
         
         # Determine if CUDA is available
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Loading model on {device}...")
         
-        # Load model with appropriate settings
-        model_kwargs = {
-            "trust_remote_code": True,
-            "device_map": "auto"
-        }
-        
-        # Use half precision for CUDA
-        if device == "cuda":
-            model_kwargs["torch_dtype"] = torch.float16
-        
-        # Load the model
-        model = AutoModelForCausalLM.from_pretrained(
-            "deepseek-ai/DeepSeek-R1",
-            **model_kwargs
-        )
-        
-        model_loaded = True
+        # The registry loads the model once per process (half precision on CUDA, prepared
+        # checkpoints memory-mapped as is) and may unload it when idle; the hooks below
+        # start and stop serving with it
+        start_serving(registry.get(MODEL_NAME, on_load=start_serving, on_unload=stop_serving))
         print("Model loaded successfully!")
+        start_tiers()
     except Exception as e:
+        model_load_failed = True
         print(f"Error loading model: {e}")
     finally:
         model_loading = False
 
 
+def start_serving(loaded):
+    """Serve a (re)loaded model: the scheduler thread owns it from here on"""
+    global tokenizer, model, scheduler, model_loaded
+    from deepseek_batching import ContinuousBatchingScheduler
+    
+    with load_lock:
+        if loaded.model is model:
+            return
+        tokenizer, model = loaded.tokenizer, loaded.model
+        model.eval()
+        kv_pool = None
+        if KV_POOL_MB:
+            from deepseek_paged import KVBlockPool
+            kv_pool = KVBlockPool.for_model(model, int(KV_POOL_MB * 1024 * 1024), KV_BLOCK_SIZE)
+            # A full pool evicts the least recently used session's cache
+            kv_pool.reclaim = sessions.release_table
+        scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=MAX_BATCH_SIZE,
+                                                max_queue_depth=MAX_QUEUE_DEPTH, tenants=TENANT_POLICIES,
+                                                preemption=PREEMPTION, kv_pool=kv_pool).start()
+        start_context()
+        model_loaded = True
+
+
+def start_tiers():
+    """Load the smaller model tiers and route messages across them and the serving model"""
+    global tiers, router
+    if not MODEL_TIERS or router is not None:
+        return
+    options = {"max_batch_size": MAX_BATCH_SIZE, "max_queue_depth": MAX_QUEUE_DEPTH,
+               "tenants": TENANT_POLICIES, "preemption": PREEMPTION}
+    tiers = [TierServer(policy, GENERATION_PARAMS, **options) for policy in MODEL_TIERS]
+    for tier in tiers:
+        print(f"Loading the {tier.name} model tier ({tier.policy.model})...")
+        try:
+            tier.load(registry)
+        except Exception as e:
+            # Its messages go to the next tier until it loads
+            print(f"Error loading the {tier.name} model tier: {e}")
+    router = TierRouter(MODEL_TIERS, on_served=metrics.tier, **ROUTER_OPTIONS)
+
+
+def tier_tokenizer(generation):
+    """Tokenizer of the model tier that answered a request"""
+    for tier in tiers:
+        if tier.name == generation.model_tier:
+            return tier.tokenizer
+    return tokenizer
+
+
+def summary_ids(prompt_ids, max_new_tokens):
+    """Generate a conversation summary as low-priority batch work on the serving scheduler"""
+    generation = scheduler.submit(prompt_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                  deadline=time.time() + REQUEST_TIMEOUT, tenant="context-summary",
+                                  priority="batch")
+    return generation.result(timeout=REQUEST_TIMEOUT + DEADLINE_GRACE)
+
+
+def start_context():
+    """Create the context manager once the tokenizer is loaded (kept across model reloads)"""
+    global context
+    if MAX_CONTEXT_TOKENS is None or context is not None:
+        return
+    summarize = model_summarizer(tokenizer, summary_ids) if CONTEXT_SUMMARIES else None
+    context = ContextManager(tokenizer, MAX_CONTEXT_TOKENS, summarize=summarize)
+
+
+def stop_serving():
+    """Stop serving before the registry unloads the model, so nothing keeps the weights alive"""
+    global model, scheduler, model_loaded
+    
+    with load_lock:
+        model_loaded = False
+        if scheduler is not None:
+            scheduler.stop()
+        scheduler = None
+        model = None
+        # Session caches in the paged KV pool would keep it alive
+        while sessions.release_table():
+            pass
+
+
+def ensure_model_loading():
+    """Start loading the model in the background unless it is loaded or already loading"""
+    global model_loading
+    
+    with load_lock:
+        if model_loaded or model_loading:
+            return
+        model_loading = True
+    threading.Thread(target=load_model_in_background, daemon=True).start()
+
+
 @app.route('/')
 def home():
     """Render the home page"""
@@ -267,75 +503,590 @@ def home():
     return render_template_string(HTML_TEMPLATE, status_message=status_message, model_ready=model_loaded)
 
 
+def status_payload():
+    """Model, queue and cache status shared by the Flask and async front ends"""
+    if model_loaded:
+        batch = scheduler.stats()
+        return {
+            "ready": True,
+            "message": "Model is ready!",
+            "queue": {
+                "depth": batch["queued"],
+                "max_depth": batch["max_queue_depth"],
+                "estimated_wait_seconds": batch["estimated_wait"],
+                "rejected": batch["rejected"],
+                "expired": batch["expired"],
+            },
+            "batch": batch,
+            "sessions": sessions.stats(),
+            "context": context.stats() if context is not None else None,
+            "models": registry.stats(),
+            "response_cache": response_cache.stats() if response_cache is not None else None,
+            "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+            "coalescing": coalescer.stats() if coalescer is not None else None,
+            "routing": router.stats() if router is not None else None,
+            "lookup": lookup.stats() if lookup is not None else None,
+        }
+    elif model_loading:
+        return {"ready": False, "message": "Loading model... This may take a few minutes."}
+    elif model_load_failed:
+        return {"ready": False, "message": "Model failed to load. Please check server logs."}
+    else:
+        return {"ready": False, "message": "Model is not loaded; it loads on the next request."}
+
+
 @app.route('/api/status')
 def status():
     """Return the current status of the model"""
-    if model_loaded:
-        return jsonify({"ready": True, "message": "Model is ready!"})
-    elif model_loading:
-        return jsonify({"ready": False, "message": "Loading model... This may take a few minutes."})
+    return jsonify(status_payload())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request and serving metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+def cache_params(language):
+    """Generation settings a cached answer depends on"""
+    budget = budget_for(THINKING_BUDGETS, language)
+    return GENERATION_PARAMS if budget is None else {**GENERATION_PARAMS, "thinking_budget": budget}
+
+
+def response_text(generation, input_ids):
+    """Decode a finished turn; the <think> section is dropped when thinking budgets are set"""
+    output_ids = generation.output_ids
+    if THINKING_BUDGETS:
+        output_ids, _ = split_answer(tier_tokenizer(generation), input_ids, output_ids)
+    return tier_tokenizer(generation).decode(output_ids, skip_special_tokens=True)
+
+
+def answer_filter(generation, input_ids):
+    """Tracker whose observe() tells which streamed tokens to show, or None to show them all"""
+    return ReasoningTracker.create(tier_tokenizer(generation), input_ids) if THINKING_BUDGETS else None
+
+
+def record_metrics(generation, input_ids, language="english"):
+    """
+    Record a finished generation's stage timings and token counts.
+    
+    Returns the reasoning_tokens/answer_tokens split of the output (empty without think tags).
+    A coalesced request is only counted; its generation is recorded with the request that ran it.
+    """
+    if generation.coalesced:
+        metrics.count("coalesced")
+        _, reasoning = split_answer(tier_tokenizer(generation), input_ids, generation.output_ids)
+        if reasoning is None:
+            return {}
+        return {"reasoning_tokens": reasoning.reasoning_tokens, "answer_tokens": reasoning.answer_tokens}
+    if generation.truncated:
+        outcome = generation.finish_reason
+    elif generation.error is None:
+        outcome = "ok"
     else:
-        return jsonify({"ready": False, "message": "Model failed to load. Please check server logs."})
+        outcome = "expired" if isinstance(generation.error, DeadlineExceeded) else "error"
+    metrics.record(generation.timings, len(input_ids), len(generation.output_ids), outcome)
+    metrics.tenant(generation.tenant, generation.priority, generation.timings.get("queue", 0.0),
+                   len(input_ids) + len(generation.output_ids), generation.preemptions)
+    
+    _, reasoning = split_answer(tier_tokenizer(generation), input_ids, generation.output_ids)
+    if reasoning is None:
+        return {}
+    budget_exhausted = generation.reasoning is not None and generation.reasoning.budget_exhausted
+    metrics.reasoning(language, reasoning.reasoning_tokens, reasoning.answer_tokens, budget_exhausted)
+    return {"reasoning_tokens": reasoning.reasoning_tokens, "answer_tokens": reasoning.answer_tokens}
+
+
+def context_usage(session):
+    """Usage fields describing how a session turn's history was compacted (empty if it was not)"""
+    compaction = session.compaction if session is not None else None
+    if compaction is None or not compaction.dropped:
+        return {}
+    return {"prompt_tokens_before_compaction": compaction.tokens_before,
+            "dropped_messages": compaction.dropped, "summarized_messages": compaction.summarized}
+
+
+def request_tenant(data):
+    """(tenant, priority) of a chat request; raises ValueError for an unknown priority class"""
+    tenant = data.get('tenant') or None
+    priority = data.get('priority') or None
+    priority_rank(priority)
+    return tenant, priority
+
+
+def queue_full_response(error):
+    """429 reply telling the client when to retry"""
+    retry_after = max(1, int(error.retry_after + 0.999))
+    return {"response": "Server is busy. Please retry shortly.", "retry_after": retry_after}, retry_after
+
+
+def submit_chat(user_message, session_id=None, stream=False, on_token=None, on_done=None, cancel_token=None,
+                language="english", tenant=None, priority=None):
+    """
+    Queue a chat turn with the scheduler.
+    
+    With a session_id the turn is appended to that conversation, and prefill resumes from the
+    session's cached KV state so only the new tokens are processed. Raises QueueFullError when
+    the scheduler queue is full; turns still queued after REQUEST_TIMEOUT are dropped, and turns
+    still decoding then (or whose cancel_token is cancelled) stop with their partial output.
+    tenant and priority decide the turn's place in the scheduler queue.
+    
+    A single-turn question identical to one already being generated attaches to that
+    generation instead (see deepseek_coalesce); the returned request is then marked coalesced.
+    With model tiers, the turn may be answered by a smaller model (generation.model_tier); the
+    returned input_ids are the prompt of the model that answered.
+    
+    A session answers one turn at a time: SessionBusyError is raised while its previous turn is
+    still in flight, and the claim is released by finish_chat (or end_turn when a turn fails).
+    """
+    session = sessions.get(session_id) if session_id else None
+    turn = sessions.begin_turn(session, REQUEST_TIMEOUT + DEADLINE_GRACE) if session else None
+    try:
+        generation, input_ids = start_chat(user_message, session, session_id, stream, on_token, on_done,
+                                           cancel_token, language, tenant, priority)
+    except BaseException:
+        if session is not None:
+            sessions.end_turn(session, turn)
+        raise
+    generation.session_turn = turn
+    return generation, input_ids, session
+
+
+def start_chat(user_message, session, session_id, stream, on_token, on_done, cancel_token, language,
+               tenant, priority):
+    """Build a chat turn's prompt and queue it (see submit_chat); returns (generation, input_ids)"""
+    registry.touch(MODEL_NAME)
+    
+    # Create messages list
+    messages = (session.messages if session else []) + [
+        {"role": "user", "content": user_message},
+    ]
+    
+    template_started = time.perf_counter()
+    # Long conversations keep their recent turns plus a summary of the rest
+    if session is not None and context is not None:
+        session.compaction = context.fit(messages, conversation=session_id)
+        messages = session.compaction.messages
+        if session.compaction.dropped:
+            metrics.compaction(session.compaction.tokens_before)
+    
+    # Apply chat template (assembled from cached token fragments, same ids as apply_chat_template)
+    input_ids = encode_chat(tokenizer, messages)
+    template_seconds = time.perf_counter() - template_started
+    
+    def submit_to(tier, on_token, on_done, cancel_token, token_probs=None, stream=False):
+        # Session KV caches belong to the serving model; smaller tiers prefill the whole prompt
+        past_layers = past_table = None
+        if tier is None and session is not None and getattr(scheduler, "supports_past_layers", True):
+            if getattr(scheduler, "kv_pool", None) is not None:
+                past_table, _ = sessions.lookup_table(session, input_ids, scheduler.kv_pool)
+            else:
+                past_layers, _ = sessions.lookup(session, input_ids)
+        
+        def finished(generation):
+            if generation.tokens_saved:
+                metrics.saved(generation.tokens_saved, generation.finish_reason)
+            if on_done is not None:
+                on_done(generation)
+        
+        # The scheduler batches this with other in-flight requests
+        generation = (scheduler if tier is None else tier.scheduler).submit(
+            input_ids if tier is None else encode_chat(tier.tokenizer, messages),
+            **(GENERATION_PARAMS if tier is None else tier.params),
+            stream=stream,
+            past_layers=past_layers,
+            past_table=past_table,
+            keep_cache=session is not None and tier is None,
+            deadline=time.time() + REQUEST_TIMEOUT,
+            cancel_token=cancel_token,
+            thinking_budget=budget_for(THINKING_BUDGETS, language),
+            tenant=tenant,
+            priority=priority,
+            token_probs=token_probs,
+            on_token=on_token,
+            on_done=finished
+        )
+        if tier is not None:
+            generation.model_tier = tier.name
+        return generation
+    
+    def start(on_token, on_done, cancel_token, stream=False):
+        if router is None:
+            return submit_to(None, on_token, on_done, cancel_token, stream=stream)
+        # Simple messages go to the smallest tier that answers them confidently
+        return router.submit(
+            user_message, language,
+            lambda index, *args: submit_to(tiers[index] if index < len(tiers) else None, *args, stream=stream),
+            cancel_token=cancel_token, on_token=on_token, on_done=on_done,
+            ready=lambda index: tiers[index].ready
+        )
+    
+    generation = None
+    if session is None and coalescer is not None and coalescer.coalescable(cache_params(language)):
+        key = cache_key(user_message, language, MODEL_NAME, cache_params(language))
+        generation = coalescer.submit(key, start, input_ids, stream=stream, cancel_token=cancel_token,
+                                      tenant=tenant, priority=priority, on_token=on_token, on_done=on_done)
+    if generation is None:
+        generation = start(on_token, on_done, cancel_token, stream)
+    generation.timings["template"] = template_seconds
+    return generation, generation.input_ids
+
+
+def lookup_response(user_message, language, session_id=None):
+    """The lookup fast path's answer (a LookupResult) for a single-turn lookup, or None to generate"""
+    if lookup is None or session_id:
+        return None
+    result = lookup.lookup(user_message, language)
+    metrics.lookup(result)
+    return result if result.answer is not None else None
+
+
+def cached_response(user_message, language, session_id=None):
+    """Cached answer for a single-turn question, if any (session turns depend on history)"""
+    if session_id:
+        return None
+    cached = None
+    if response_cache is not None:
+        cached = response_cache.get(user_message, language, cache_params(language))
+    if cached is None and semantic_cache is not None:
+        cached = semantic_cache.get(user_message, language, cache_params(language))
+    return cached
+
+
+def embed_message(user_message):
+    """Semantic cache embedding from the serving model's hidden states (--semantic-embedding model)"""
+    current, current_tokenizer = model, tokenizer
+    if current is None:
+        # Unloaded (or in worker processes): no embedding, so the lookup is a miss
+        return None
+    registry.touch(MODEL_NAME)
+    return hidden_state_vector(current, current_tokenizer, user_message)
+
+
+def end_turn(generation, session):
+    """Let the session take its next turn after this one failed or was abandoned"""
+    if session is not None and generation is not None:
+        sessions.end_turn(session, getattr(generation, "session_turn", None))
+
+
+# 409 reply for a turn sent while its session is still answering the previous one
+SESSION_BUSY_MESSAGE = "This conversation is still answering the previous message. Please wait for it to finish."
+
+
+def finish_chat(generation, session, user_message, response, language="english"):
+    """Record a completed turn in its session and keep the KV cache for the next one"""
+    if session is None:
+        # Partial answers of cancelled or late requests are never cached, and a coalesced
+        # answer is cached by the request that generated it
+        if generation.error is None and not generation.truncated and not generation.coalesced:
+            if response_cache is not None:
+                response_cache.put(user_message, language, cache_params(language), response)
+            if semantic_cache is not None:
+                semantic_cache.put(user_message, language, cache_params(language), response)
+        return
+    session.messages.extend([
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": response},
+    ])
+    try:
+        if generation.cache_layers is not None:
+            sessions.store(session, generation.cache_ids, generation.cache_layers)
+        elif generation.cache_table is not None:
+            sessions.store_table(session, generation.cache_ids, generation.take_cache_table())
+    finally:
+        end_turn(generation, session)
 
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """Handle chat requests"""
     if not model_loaded:
+        ensure_model_loading()
         return jsonify({"response": "Model is still loading. Please wait."})
     
     # Get message from request
     data = request.json
     user_message = data.get('message', '')
+    session_id = data.get('session_id')
+    language = data.get('language', 'english')
     
     if not user_message:
         return jsonify({"response": "Please provide a message."})
+    try:
+        tenant, priority = request_tenant(data)
+    except ValueError as e:
+        return jsonify({"response": str(e)}), 400
+    
+    answered = lookup_response(user_message, language, session_id)
+    if answered is not None:
+        return jsonify({"response": answered.answer, "lookup": answered.intent})
+    
+    cached = cached_response(user_message, language, session_id)
+    if cached is not None:
+        metrics.count("cached")
+        return jsonify({"response": cached, "cached": True})
     
+    cancel_token = CancellationToken()
+    generation = session = None
     try:
-        # Create messages list
-        messages = [
-            {"role": "user", "content": user_message},
-        ]
-        
-        # Apply chat template
-        inputs = tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        ).to(model.device)
-        
-        # Generate response
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=100,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True
-            )
+        generation, input_ids, session = submit_chat(user_message, session_id, cancel_token=cancel_token,
+                                                     language=language, tenant=tenant, priority=priority)
+        generation.result(timeout=REQUEST_TIMEOUT + DEADLINE_GRACE)
         
         # Decode response
-        response = tokenizer.decode(
-            outputs[0][inputs["input_ids"].shape[-1]:],
-            skip_special_tokens=True
-        )
+        detokenize_started = time.perf_counter()
+        response = response_text(generation, input_ids)
+        generation.timings["detokenize"] = time.perf_counter() - detokenize_started
+        record_metrics(generation, input_ids, language)
+        finish_chat(generation, session, user_message, response, language)
         
-        return jsonify({"response": response})
+        payload = {"response": response}
+        if session is not None:
+            payload["session_id"] = session_id
+            usage = context_usage(session)
+            if usage:
+                payload["usage"] = {"prompt_tokens": len(input_ids), **usage}
+        if generation.truncated:
+            payload.update(truncated=True, finish_reason=generation.finish_reason)
+        return jsonify(payload)
+    except QueueFullError as e:
+        metrics.count("rejected")
+        payload, retry_after = queue_full_response(e)
+        return jsonify(payload), 429, {"Retry-After": str(retry_after)}
+    except SessionBusyError:
+        metrics.count("rejected")
+        return jsonify({"response": SESSION_BUSY_MESSAGE}), 409
+    except (DeadlineExceeded, TimeoutError):
+        cancel_token.cancel()
+        metrics.count("expired")
+        return jsonify({"response": "The request timed out. Please try again."}), 504
     except Exception as e:
+        cancel_token.cancel()
+        metrics.count("error")
         print(f"Error generating response: {e}")
         return jsonify({"response": f"Error generating response: {str(e)}"})
+    finally:
+        # A turn that failed still frees its session (finish_chat already did otherwise)
+        end_turn(generation, session)
 
 
-def main():
-    parser = argparse.ArgumentParser(description="DeepSeek-R1 Web App")
+@app.route('/api/chat/stream', methods=['GET', 'POST'])
+def chat_stream():
+    """Stream a chat response as server-sent events: token events, then a done event with usage"""
+    if not model_loaded:
+        ensure_model_loading()
+        return Response(format_sse("error", {"error": "Model is still loading. Please wait."}),
+                        mimetype="text/event-stream")
+    
+    # Accept a JSON body, or a query string so EventSource (GET only) can be used directly
+    data = request.get_json(silent=True) or request.args
+    user_message = data.get('message', '')
+    session_id = data.get('session_id')
+    language = data.get('language', 'english')
+    
+    if not user_message:
+        return Response(format_sse("error", {"error": "Please provide a message."}),
+                        mimetype="text/event-stream")
+    try:
+        tenant, priority = request_tenant(data)
+    except ValueError as e:
+        return Response(format_sse("error", {"error": str(e)}), status=400, mimetype="text/event-stream")
+    
+    answered = lookup_response(user_message, language, session_id)
+    if answered is not None:
+        return Response(
+            format_sse("token", {"text": answered.answer})
+            + format_sse("done", {"finish_reason": "lookup", "lookup": answered.intent}),
+            mimetype="text/event-stream",
+        )
+    
+    cached = cached_response(user_message, language, session_id)
+    if cached is not None:
+        metrics.count("cached")
+        return Response(
+            format_sse("token", {"text": cached}) + format_sse("done", {"finish_reason": "cached", "cached": True}),
+            mimetype="text/event-stream",
+        )
+    
+    cancel_token = CancellationToken()
+    try:
+        generation, input_ids, session = submit_chat(user_message, session_id, stream=True,
+                                                     cancel_token=cancel_token, language=language,
+                                                     tenant=tenant, priority=priority)
+    except QueueFullError as e:
+        metrics.count("rejected")
+        payload, retry_after = queue_full_response(e)
+        return Response(format_sse("error", {"error": payload["response"], "retry_after": retry_after}),
+                        status=429, mimetype="text/event-stream", headers={"Retry-After": str(retry_after)})
+    except SessionBusyError:
+        metrics.count("rejected")
+        return Response(format_sse("error", {"error": SESSION_BUSY_MESSAGE}),
+                        status=409, mimetype="text/event-stream")
+    
+    def events():
+        detokenizer = IncrementalDetokenizer(tier_tokenizer(generation))
+        reasoning = answer_filter(generation, input_ids)
+        detokenize_seconds = 0.0
+        try:
+            for token_id in generation.iter_tokens():
+                if reasoning is not None and not reasoning.observe(token_id):
+                    continue
+                detokenize_started = time.perf_counter()
+                text = detokenizer.add(token_id)
+                detokenize_seconds += time.perf_counter() - detokenize_started
+                if text:
+                    yield format_sse("token", {"text": text})
+            text = detokenizer.flush()
+            if text:
+                yield format_sse("token", {"text": text})
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+            record_metrics(generation, input_ids, language)
+            yield format_sse("error", {"error": f"Error generating response: {str(e)}"})
+            end_turn(generation, session)
+            return
+        finally:
+            # The client disconnected mid-stream (the generator was closed): stop decoding for it
+            if not generation.done:
+                cancel_token.cancel()
+                end_turn(generation, session)
+        generation.timings["detokenize"] = detokenize_seconds
+        usage = record_metrics(generation, input_ids, language)
+        
+        finish_chat(generation, session, user_message, response_text(generation, input_ids), language)
+        stats = timing_stats(generation.submitted_at, generation.first_token_at, generation.finished_at,
+                             len(input_ids), len(generation.output_ids))
+        stats["usage"].update(usage, **context_usage(session))
+        yield format_sse("done", {"finish_reason": generation.finish_reason, "truncated": generation.truncated,
+                                  **stats})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def build_arg_parser(description="DeepSeek-R1 Web App"):
+    """Command-line options shared by the Flask and async front ends"""
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument("--port", type=int, default=5000, help="Port to run the server on")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to run the server on")
     parser.add_argument("--debug", action="store_true", help="Run in debug mode")
     parser.add_argument("--load-model-on-startup", action="store_true", 
                         help="Load model on startup instead of on first request")
-    args = parser.parse_args()
+    parser.add_argument("--model", type=str, default=MODEL_NAME,
+                        help="HuggingFace model identifier or local model directory")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help="Maximum number of requests decoded together")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS,
+                        help="Run inference in this many CPU worker processes sharing mmap'd weights (0: in-process)")
+    parser.add_argument("--max-queue-depth", type=int, default=MAX_QUEUE_DEPTH,
+                        help="Requests allowed to wait for a batch slot before new ones get 429")
+    parser.add_argument("--request-timeout", type=float, default=REQUEST_TIMEOUT,
+                        help="Seconds a request may wait and run before it is abandoned")
+    parser.add_argument("--thinking-budget", action="append", default=None, metavar="[LANGUAGE=]TOKENS",
+                        help="Cap the <think> section at TOKENS and leave it out of responses; "
+                             "repeat with LANGUAGE= for per-language budgets")
+    parser.add_argument("--tenant-policies", type=str, default=None, metavar="PATH",
+                        help="JSON file of per-tenant weights, token-rate limits and queue caps")
+    parser.add_argument("--no-preemption", action="store_true",
+                        help="Never pause running batch requests for interactive ones (they still go first)")
+    parser.add_argument("--max-context-tokens", type=int, default=None,
+                        help="Prompt-token budget for session turns; older turns are summarised and left out")
+    parser.add_argument("--no-context-summary", action="store_true",
+                        help="With --max-context-tokens, drop old turns without summarising them")
+    parser.add_argument("--model-idle-ttl", type=float, default=None,
+                        help="Unload the model after this many idle seconds (reloaded on demand)")
+    parser.add_argument("--model-memory-mb", type=int, default=None,
+                        help="Memory budget for loaded models; least recently used ones are unloaded")
+    parser.add_argument("--kv-pool-mb", type=float, default=None,
+                        help="Keep KV state in a paged pool of this many MB (per worker with --workers)")
+    parser.add_argument("--kv-block-size", type=int, default=KV_BLOCK_SIZE,
+                        help="Tokens per paged KV cache block")
+    parser.add_argument("--session-memory-mb", type=int, default=512,
+                        help="Memory budget for cached session KV state")
+    parser.add_argument("--session-ttl", type=float, default=1800.0,
+                        help="Seconds an idle session keeps its KV cache")
+    parser.add_argument("--no-response-cache", action="store_true",
+                        help="Always generate, never answer from the response cache")
+    parser.add_argument("--response-cache", type=str, default=None,
+                        help="SQLite file that persists the response cache across restarts")
+    parser.add_argument("--cache-sampled", action="store_true",
+                        help="Serve cached answers, and share in-flight generations between identical "
+                             "requests, even though generation samples (temperature > 0)")
+    parser.add_argument("--semantic-cache", action="store_true",
+                        help="Also answer near-verbatim repeats (word order, an extra word) of earlier "
+                             "questions from the cache")
+    parser.add_argument("--semantic-threshold", type=float, default=0.85,
+                        help="Minimum cosine similarity for a semantic cache hit")
+    parser.add_argument("--semantic-embedding", choices=("ngram", "model"), default="ngram",
+                        help="Semantic cache embedding: hashed word/trigram vectors (near-verbatim repeats) or "
+                             "the mean of the model's hidden states (also paraphrases; costs a forward pass; "
+                             "not with --workers)")
+    parser.add_argument("--model-tiers", type=str, default=None, metavar="PATH",
+                        help="JSON file of smaller model tiers that answer simple messages before --model")
+    parser.add_argument("--lookup-data", type=str, default=None, metavar="PATH",
+                        help="JSON catalogue/FAQ file; price, supplier, order and FAQ lookups are answered "
+                             "from it without generating (re-read when it changes)")
+    parser.add_argument("--no-coalesce", action="store_true",
+                        help="Generate every request, even while an identical one is in flight")
+    parser.add_argument("--coalesce-wait", type=float, default=COALESCE_WAIT,
+                        help="Seconds a request waits for an identical in-flight generation's first token "
+                             "before generating its own answer")
+    return parser
+
+
+def configure(args):
+    """Apply parsed command-line options to the module settings"""
+    global MODEL_NAME, MAX_BATCH_SIZE, MAX_QUEUE_DEPTH, NUM_WORKERS, REQUEST_TIMEOUT, THINKING_BUDGETS
+    global TENANT_POLICIES, PREEMPTION, MAX_CONTEXT_TOKENS, CONTEXT_SUMMARIES, response_cache, semantic_cache
+    global KV_POOL_MB, KV_BLOCK_SIZE, COALESCE_WAIT, coalescer, MODEL_TIERS, ROUTER_OPTIONS, lookup
+    
+    MODEL_NAME = args.model
+    if not args.no_response_cache:
+        response_cache = ResponseCache(MODEL_NAME, path=args.response_cache, allow_sampled=args.cache_sampled)
+    MODEL_TIERS, ROUTER_OPTIONS = load_tiers(args.model_tiers)
+    if args.lookup_data:
+        lookup = LookupFastPath(args.lookup_data)
+    if args.semantic_cache:
+        embed = None
+        if args.semantic_embedding == "model":
+            if args.workers > 0:
+                # The model lives in the worker processes, not here
+                print("--semantic-embedding model needs the model in this process; using ngram with --workers")
+            else:
+                embed = embed_message
+        # With a catalogue, questions about different products never share an answer
+        semantic_cache = SemanticCache(MODEL_NAME, threshold=args.semantic_threshold, embed=embed,
+                                       entities=lookup.names if lookup is not None else None,
+                                       allow_sampled=args.cache_sampled)
+    COALESCE_WAIT = args.coalesce_wait
+    if not args.no_coalesce:
+        coalescer = RequestCoalescer(COALESCE_WAIT, allow_sampled=args.cache_sampled)
+    MAX_BATCH_SIZE = args.max_batch_size
+    MAX_QUEUE_DEPTH = args.max_queue_depth
+    NUM_WORKERS = args.workers
+    REQUEST_TIMEOUT = args.request_timeout
+    THINKING_BUDGETS = parse_budgets(args.thinking_budget)
+    TENANT_POLICIES = load_policies(args.tenant_policies)
+    PREEMPTION = not args.no_preemption
+    MAX_CONTEXT_TOKENS = args.max_context_tokens
+    CONTEXT_SUMMARIES = not args.no_context_summary
+    KV_POOL_MB = args.kv_pool_mb
+    KV_BLOCK_SIZE = args.kv_block_size
+    sessions.memory_budget_bytes = args.session_memory_mb * 1024 * 1024
+    sessions.ttl_seconds = args.session_ttl
+    registry.idle_ttl = args.model_idle_ttl
+    if args.model_memory_mb is not None:
+        registry.memory_budget_bytes = args.model_memory_mb * 1024 * 1024
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    # Library modules log their progress (model loading, registry) instead of printing
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    configure(args)
     
     # Start model loading in background if requested
     if args.load_model_on_startup:
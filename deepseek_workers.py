@@ -0,0 +1,448 @@
+# DeepSeek CPU Worker Pool
+# Runs several inference processes on one CPU node. Each worker is pinned to its own core set
+# with a matching torch thread count and runs a continuous batching scheduler; all workers map
+# the same read-only prepared checkpoint (deepseek_checkpoint), so the weights occupy the page
+# cache once instead of once per process. A front process dispatches each request to the
+# least-loaded worker. Tenant policies (deepseek_fairness) are enforced by each worker's
+# scheduler, so weights, rate limits and queue caps apply per worker process. With a paged KV
+# cache, each worker gets its own pool. A worker process that dies (OOM kill, segfault) fails
+# the requests it held and is started again.
+
+from typing import Callable, Dict, List, Optional, Sequence
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from deepseek_batching import DeadlineExceeded, GenerationRequest, QueueFullError
+from deepseek_cancel import CancellationToken
+from deepseek_checkpoint import DEFAULT_CACHE_DIR, ensure_prepared, load_prepared_model
+from deepseek_fairness import TenantPolicy
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that every worker process is still running
+HEALTH_CHECK_INTERVAL = 1.0
+
+
+def split_cores(num_workers: int, cores: Optional[Sequence[int]] = None) -> List[List[int]]:
+    """Divide the available cores into num_workers contiguous sets (shared round-robin if too few)"""
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    sets, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def process_memory(pid: int) -> Dict[str, int]:
+    """RSS, PSS and shared/private resident bytes of a process (Linux only, zeros elsewhere)"""
+    fields = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared", "Shared_Dirty": "shared",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    memory = {"rss": 0, "pss": 0, "shared": 0, "private": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in fields:
+                    memory[fields[name]] += int(rest.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+def worker_main(worker_id, checkpoint_path, cores, max_batch_size, jobs, results,
+                tenants=None, preemption=True, kv_pool_bytes=None, kv_block_size=16):
+    """Entry point of one inference process"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores)))
+
+    from transformers import AutoTokenizer
+    from deepseek_batching import ContinuousBatchingScheduler
+
+    try:
+        # Weights are assigned straight from the checkpoint's memory-mapped safetensors files,
+        # so the process never allocates a private copy: its weight pages are the page-cache pages
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint_path, trust_remote_code=True)
+        model = load_prepared_model(checkpoint_path)
+        kv_pool = None
+        if kv_pool_bytes:
+            from deepseek_paged import KVBlockPool
+            kv_pool = KVBlockPool.for_model(model, kv_pool_bytes, kv_block_size)
+        scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=max_batch_size,
+                                                tenants=tenants, preemption=preemption,
+                                                kv_pool=kv_pool).start()
+    except Exception as e:
+        results.put(("failed", worker_id, None, repr(e)))
+        return
+    results.put(("ready", worker_id, None, os.getpid()))
+
+    # Cancellation tokens of this worker's unfinished jobs, cancelled by ("cancel", job_id) messages
+    tokens: Dict[int, CancellationToken] = {}
+
+    def on_done(job_id):
+        def callback(request):
+            tokens.pop(job_id, None)
+            error = None
+            if request.error is not None:
+                error = ("expired" if isinstance(request.error, DeadlineExceeded) else "error", str(request.error))
+            results.put(("done", worker_id, job_id,
+                         (request.output_ids, request.finish_reason, error, request.first_token_at,
+                          request.timings, request.tokens_saved, request.preemptions)))
+        return callback
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if job[0] == "cancel":
+            token = tokens.get(job[1])
+            if token is not None:
+                token.cancel()
+            continue
+        job_id, input_ids, params, stream = job
+        # Scored jobs send each token with its probability
+        token_probs = [] if params.pop("score", False) else None
+        if token_probs is not None:
+            on_token = lambda token_id, job_id=job_id, probs=token_probs: \
+                results.put(("token", worker_id, job_id, (token_id, probs[-1])))
+        elif stream:
+            on_token = lambda token_id, job_id=job_id: results.put(("token", worker_id, job_id, token_id))
+        else:
+            on_token = None
+        tokens[job_id] = CancellationToken()
+        try:
+            scheduler.submit(input_ids, **params, cancel_token=tokens[job_id], token_probs=token_probs,
+                             on_token=on_token, on_done=on_done(job_id))
+        except QueueFullError as e:
+            # The tenant's queue cap in this worker is reached
+            tokens.pop(job_id, None)
+            results.put(("done", worker_id, job_id, ([], "rejected", ("rejected", e.retry_after), None, {}, 0, 0)))
+    scheduler.stop()
+
+
+class WorkerPool:
+    """
+    N pinned inference processes behind the ContinuousBatchingScheduler submit() interface.
+
+    KV state cannot be handed between processes cheaply, so past_layers/past_table/keep_cache are
+    ignored (session turns re-prefill their history); everything else behaves like the scheduler.
+    """
+
+    supports_past_layers = False
+
+    def __init__(self,
+                 model_name: str,
+                 num_workers: int,
+                 max_batch_size: int = 8,
+                 max_queue_depth: Optional[int] = None,
+                 dtype: torch.dtype = torch.float32,
+                 checkpoint_path: Optional[str] = None,
+                 cache_dir: str = DEFAULT_CACHE_DIR,
+                 cores: Optional[Sequence[int]] = None,
+                 tenants: Optional[Dict[str, TenantPolicy]] = None,
+                 preemption: bool = True,
+                 kv_pool_bytes: Optional[int] = None,
+                 kv_block_size: int = 16):
+        self.model_name = model_name
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.max_queue_depth = max_queue_depth
+        self.dtype = dtype
+        # The prepared checkpoint the workers map (None: prepared once under cache_dir on start)
+        self.checkpoint_path = checkpoint_path
+        self.cache_dir = cache_dir
+        self.core_sets = split_cores(num_workers, cores)
+        self.tenants = tenants
+        self.preemption = preemption
+        # Paged KV cache pool size per worker (None: contiguous per-batch KV tensors)
+        self.kv_pool_bytes = kv_pool_bytes
+        self.kv_block_size = kv_block_size
+
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._jobs = [self._context.Queue() for _ in range(num_workers)]
+        # A worker's process is None once it is dropped (it failed to load the model on a restart)
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * num_workers
+        self._pids: List[Optional[int]] = [None] * num_workers
+        self._ready = [False] * num_workers
+        self._pending: Dict[int, GenerationRequest] = {}
+        # Worker each pending job was sent to
+        self._job_workers: Dict[int, int] = {}
+        self._outstanding = [0] * num_workers
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._collector = threading.Thread(target=self._collect, name="worker-pool-results", daemon=True)
+
+        self.completed = [0] * num_workers
+        self.generated_tokens = [0] * num_workers
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.tokens_saved = 0
+        self.preempted = 0
+        self.restarts = [0] * num_workers
+        self.mean_service_time: Optional[float] = None
+
+    def start(self, timeout: float = 600.0):
+        """Prepare the shared checkpoint if needed, spawn the workers and wait until all are ready"""
+        if self.checkpoint_path is None:
+            self.checkpoint_path = ensure_prepared(self.model_name, str(self.dtype).replace("torch.", ""),
+                                                   self.cache_dir)
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+
+        deadline = time.time() + timeout
+        ready = 0
+        while ready < self.num_workers:
+            try:
+                kind, worker_id, _, payload = self._results.get(timeout=max(0.1, deadline - time.time()))
+            except queue.Empty:
+                self.stop()
+                raise TimeoutError("Inference workers did not start in time")
+            if kind == "failed":
+                self.stop()
+                raise RuntimeError(f"Worker {worker_id} failed to load the model: {payload}")
+            self._pids[worker_id] = payload
+            self._ready[worker_id] = True
+            ready += 1
+        self._collector.start()
+        return self
+
+    def _spawn(self, worker_id: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(worker_id, self.checkpoint_path, self.core_sets[worker_id], self.max_batch_size,
+                  self._jobs[worker_id], self._results, self.tenants, self.preemption,
+                  self.kv_pool_bytes, self.kv_block_size),
+            name=f"deepseek-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def stop(self):
+        self._stopping = True
+        for jobs in self._jobs:
+            jobs.put(None)
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(("stop", None, None, None))
+
+    def submit(self,
+               input_ids: List[int],
+               max_new_tokens: int = 100,
+               temperature: float = 0.7,
+               top_p: float = 0.9,
+               top_k: int = 0,
+               do_sample: bool = True,
+               stream: bool = False,
+               past_layers=None,
+               past_table=None,
+               keep_cache: bool = False,
+               deadline: Optional[float] = None,
+               cancel_token: Optional[CancellationToken] = None,
+               thinking_budget: Optional[int] = None,
+               tenant: Optional[str] = None,
+               priority: Optional[str] = None,
+               token_probs: Optional[List[float]] = None,
+               on_token: Optional[Callable[[int], None]] = None,
+               on_done: Optional[Callable[[GenerationRequest], None]] = None) -> GenerationRequest:
+        """
+        Send a prompt to the least-loaded worker; the returned request completes asynchronously.
+
+        A request over its tenant's queue cap in the worker fails with QueueFullError, and one
+        held by a worker process that dies fails with RuntimeError.
+        """
+        request = GenerationRequest(input_ids, max_new_tokens=max_new_tokens, temperature=temperature,
+                                    top_p=top_p, top_k=top_k, do_sample=do_sample, stream=stream,
+                                    deadline=deadline, cancel_token=cancel_token, tenant=tenant,
+                                    priority=priority, token_probs=token_probs, on_token=on_token, on_done=on_done)
+        params = {"max_new_tokens": max_new_tokens, "temperature": temperature, "top_p": top_p,
+                  "top_k": top_k, "do_sample": do_sample, "deadline": deadline, "thinking_budget": thinking_budget,
+                  "tenant": tenant, "priority": priority, "score": token_probs is not None}
+        with self._lock:
+            if self.max_queue_depth is not None and self._queued_locked() >= self.max_queue_depth:
+                self.rejected += 1
+                raise QueueFullError(self._estimated_wait_locked())
+            workers = [i for i in range(self.num_workers) if self._processes[i] is not None]
+            if not workers:
+                raise RuntimeError("No inference worker is running")
+            # A restarting worker picks up its jobs once it has loaded the model
+            worker_id = min(workers, key=lambda i: (not self._ready[i], self._outstanding[i]))
+            job_id = next(self._ids)
+            self._pending[job_id] = request
+            self._job_workers[job_id] = worker_id
+            self._outstanding[worker_id] += 1
+            jobs = self._jobs[worker_id]
+        jobs.put((job_id, list(input_ids), params, stream or on_token is not None))
+        if cancel_token is not None:
+            # The worker stops the job between decode steps, like the in-process scheduler
+            cancel_token.add_callback(lambda: self._jobs[worker_id].put(("cancel", job_id)))
+        return request
+
+    def generate(self, input_ids: List[int], timeout: Optional[float] = None, **kwargs) -> List[int]:
+        """Submit a prompt and block until its tokens are ready"""
+        return self.submit(input_ids, **kwargs).result(timeout)
+
+    def estimated_wait(self) -> float:
+        with self._lock:
+            return self._estimated_wait_locked()
+
+    def stats(self) -> Dict[str, object]:
+        """Pool-wide counters in the scheduler's format, plus one entry per worker"""
+        with self._lock:
+            outstanding = sum(self._outstanding)
+            capacity = self.num_workers * self.max_batch_size
+            workers = [
+                {
+                    "pid": self._pids[i],
+                    "cores": self.core_sets[i],
+                    "ready": self._ready[i],
+                    "restarts": self.restarts[i],
+                    "outstanding": self._outstanding[i],
+                    "completed": self.completed[i],
+                    "generated_tokens": self.generated_tokens[i],
+                    **(process_memory(self._pids[i]) if self._pids[i] else {}),
+                }
+                for i in range(self.num_workers)
+            ]
+            return {
+                "workers": workers,
+                "max_batch_size": capacity,
+                "active": min(outstanding, capacity),
+                "queued": self._queued_locked(),
+                "occupancy": min(outstanding, capacity) / capacity,
+                "generated_tokens": sum(self.generated_tokens),
+                "completed": sum(self.completed),
+                "max_queue_depth": self.max_queue_depth,
+                "estimated_wait": round(self._estimated_wait_locked(), 3),
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "cancelled": self.cancelled,
+                "tokens_saved": self.tokens_saved,
+                "preempted": self.preempted,
+            }
+
+    def _queued_locked(self) -> int:
+        return sum(max(0, n - self.max_batch_size) for n in self._outstanding)
+
+    def _estimated_wait_locked(self) -> float:
+        service_time = self.mean_service_time or 1.0
+        return sum(self._outstanding) / (self.num_workers * self.max_batch_size) * service_time
+
+    def _collect(self):
+        """Route worker messages back to the waiting requests and restart workers that died"""
+        checked = time.monotonic()
+        while True:
+            try:
+                kind, worker_id, job_id, payload = self._results.get(timeout=HEALTH_CHECK_INTERVAL)
+            except queue.Empty:
+                kind = None
+            if time.monotonic() - checked >= HEALTH_CHECK_INTERVAL:
+                checked = time.monotonic()
+                self._check_workers()
+            if kind is None:
+                continue
+            if kind == "stop":
+                break
+            if kind == "ready":
+                with self._lock:
+                    self._pids[worker_id] = payload
+                    self._ready[worker_id] = True
+                logger.info(f"Worker {worker_id} restarted (pid {payload})")
+                continue
+            if kind == "failed":
+                # A worker that cannot load the model again is dropped; the jobs sent to it fail
+                logger.error(f"Worker {worker_id} failed to load the model on restart: {payload}")
+                with self._lock:
+                    self._processes[worker_id] = None
+                self._fail_worker(worker_id, RuntimeError(f"Worker {worker_id} failed to restart: {payload}"))
+                continue
+            request = self._pending.get(job_id)
+            if request is None:
+                continue
+            if kind == "token":
+                if request.token_probs is not None:
+                    payload, prob = payload
+                    request.token_probs.append(prob)
+                request._append(payload)
+                continue
+
+            output_ids, finish_reason, error, first_token_at, timings, tokens_saved, preemptions = payload
+            with self._lock:
+                del self._pending[job_id]
+                del self._job_workers[job_id]
+                self._outstanding[worker_id] -= 1
+                if error is not None and error[0] == "rejected":
+                    self.rejected += 1
+                else:
+                    self.completed[worker_id] += 1
+                    self.generated_tokens[worker_id] += len(output_ids)
+                    service_time = time.time() - request.submitted_at
+                    self.mean_service_time = service_time if self.mean_service_time is None \
+                        else 0.9 * self.mean_service_time + 0.1 * service_time
+                if error is not None and error[0] == "expired":
+                    self.expired += 1
+                if tokens_saved and error is None:
+                    self.cancelled += 1
+                self.tokens_saved += tokens_saved
+                self.preempted += preemptions
+            if not request.output_ids:
+                request.output_ids = list(output_ids)
+                request.first_token_at = first_token_at
+            # Queue time as seen from the front includes the hop to the worker
+            request.timings.update(timings)
+            request.tokens_saved = tokens_saved
+            request.preemptions = preemptions
+            if error is None:
+                request._finish(finish_reason)
+                continue
+            kind, message = error
+            if kind == "rejected":
+                request._finish(finish_reason, QueueFullError(message))
+            else:
+                request._finish(finish_reason, DeadlineExceeded(message) if kind == "expired" else RuntimeError(message))
+
+    def _check_workers(self):
+        """Fail the requests of worker processes that exited and start them again"""
+        if self._stopping:
+            return
+        for worker_id, process in enumerate(self._processes):
+            if process is None or process.is_alive():
+                continue
+            logger.error(f"Worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}; restarting it")
+            self._fail_worker(worker_id, RuntimeError(f"Worker {worker_id} exited with code {process.exitcode}"))
+            with self._lock:
+                self.restarts[worker_id] += 1
+            self._spawn(worker_id)
+
+    def _fail_worker(self, worker_id: int, error: BaseException):
+        """Fail every request sent to a worker and give it an empty job queue"""
+        with self._lock:
+            job_ids = [job_id for job_id, worker in self._job_workers.items() if worker == worker_id]
+            requests = [self._pending.pop(job_id) for job_id in job_ids]
+            for job_id in job_ids:
+                del self._job_workers[job_id]
+            self._outstanding[worker_id] = 0
+            self._ready[worker_id] = False
+            self._pids[worker_id] = None
+            # Jobs still queued for the dead process were failed above
+            self._jobs[worker_id] = self._context.Queue()
+        for request in requests:
+            request._finish("error", error)
@@ -0,0 +1,349 @@
+# DeepSeek Serving Tests
+# Checks the serving optimisations against plain greedy generation on tiny random models
+# (deepseek_tiny_model), so they run offline on a CPU box in a few seconds:
+#   python -m pytest -q test_deepseek_serving.py
+
+import os
+import signal
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from deepseek_batching import ContinuousBatchingScheduler
+from deepseek_cache import SemanticCache, hidden_state_vector
+from deepseek_checkpoint import is_prepared, load_model, prepare_checkpoint
+from deepseek_paged import KVBlockPool
+from deepseek_prompts import ChatPromptBuilder, encode_chat
+from deepseek_routing import TierPolicy, TierRouter
+from deepseek_server import LANGUAGES, get_system_prompt
+from deepseek_sessions import SessionStore
+from deepseek_speculative import speculative_generate
+from deepseek_streaming import IncrementalDetokenizer
+from deepseek_tiny_model import create_tiny_model
+from deepseek_workers import WorkerPool
+
+MAX_NEW_TOKENS = 12
+
+MESSAGES = [
+    "What is today's onion price?",
+    "आज प्याज का भाव क्या है?",
+    "hi",
+    "Which suppliers near Dadar deliver tomatoes today? I need 40 kg by tomorrow morning.",
+]
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    return create_tiny_model(str(tmp_path_factory.mktemp("tiny")))
+
+
+@pytest.fixture(scope="module")
+def tokenizer(model_path):
+    return AutoTokenizer.from_pretrained(model_path)
+
+
+@pytest.fixture(scope="module")
+def model(model_path):
+    return AutoModelForCausalLM.from_pretrained(model_path).eval()
+
+
+@pytest.fixture(scope="module")
+def prompts(tokenizer):
+    return [encode_chat(tokenizer, [{"role": "user", "content": message}]) for message in MESSAGES]
+
+
+def greedy(model, tokenizer, input_ids, max_new_tokens=MAX_NEW_TOKENS):
+    """Tokens model.generate() adds to input_ids with greedy decoding"""
+    with torch.no_grad():
+        output = model.generate(torch.tensor([input_ids]), max_new_tokens=max_new_tokens, do_sample=False,
+                                pad_token_id=tokenizer.eos_token_id)
+    return output[0, len(input_ids):].tolist()
+
+
+# A question, an earlier answer and a follow-up per language
+CONVERSATIONS = {
+    "english": ["What is today's onion price?", "Onion is ₹40/kg in Dadar today.", "And tomatoes?"],
+    "hindi": ["आज प्याज का भाव क्या है?", "आज दादर में प्याज ₹40/किलो है।", "और टमाटर?"],
+    "marathi": ["आज कांद्याचा भाव काय आहे?", "आज दादरमध्ये कांदा ₹40/किलो आहे.", "आणि टोमॅटो?"],
+    "gujarati": ["આજે ડુંગળીનો ભાવ શું છે?", "આજે દાદરમાં ડુંગળી ₹40/કિલો છે.", "અને ટામેટાં?"],
+}
+
+
+@pytest.mark.parametrize("language", LANGUAGES)
+@pytest.mark.parametrize("with_history", [False, True])
+def test_encode_chat_matches_apply_chat_template(tokenizer, language, with_history):
+    """Prompts assembled from cached template fragments are the ids apply_chat_template gives"""
+    question, answer, follow_up = CONVERSATIONS[language]
+    system = {"role": "system", "content": get_system_prompt(language)}
+    if with_history:
+        layouts = [[system, {"role": "user", "content": question}, {"role": "assistant", "content": answer},
+                    {"role": "user", "content": follow_up}]]
+    else:
+        layouts = [[system, {"role": "user", "content": question}], [system, {"role": "user", "content": follow_up}]]
+    builder = ChatPromptBuilder(tokenizer)
+    # The first prompt of a layout is checked against the template; later ones are assembled
+    for messages in layouts + layouts:
+        expected = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True,
+                                                 return_dict=True)["input_ids"]
+        assert builder.encode(messages) == expected
+        assert encode_chat(tokenizer, messages) == expected
+    stats = builder.stats()
+    # Every prompt but the first of its layout was assembled, none fell back to the template
+    assert stats["layouts_rejected"] == 0
+    assert stats["hits"] == 2 * len(layouts) - stats["layouts_built"]
+
+
+@pytest.mark.parametrize("language", ["hindi", "marathi", "gujarati"])
+def test_incremental_detokenizer_matches_decode(model, tokenizer, language, prompts):
+    """Streamed text deltas join up to exactly what decoding all ids at once gives"""
+    text = " ".join(CONVERSATIONS[language]) + " " + get_system_prompt(language)
+    sequences = [tokenizer.encode(text, add_special_tokens=False)]
+    # Generated ids are not guaranteed to form whole characters at all
+    sequences += [greedy(model, tokenizer, input_ids, max_new_tokens=40) for input_ids in prompts]
+    streamed = []
+    for token_ids in sequences:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        streamed.append([detokenizer.add(token_id) for token_id in token_ids] + [detokenizer.flush()])
+        assert "".join(streamed[-1]) == tokenizer.decode(token_ids, skip_special_tokens=True)
+    # Some characters span several byte-level tokens, yet none is sent half-done
+    assert any("\ufffd" in tokenizer.decode([token_id]) for token_id in sequences[0])
+    assert not any("\ufffd" in delta for delta in streamed[0])
+
+
+def test_scheduler_matches_greedy_generate(model, tokenizer, prompts):
+    """Prompts of different lengths batched together decode exactly as they do alone"""
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=3).start()
+    try:
+        requests = [scheduler.submit(input_ids, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+                    for input_ids in prompts]
+        outputs = [request.result(timeout=60) for request in requests]
+    finally:
+        scheduler.stop()
+    assert outputs == [greedy(model, tokenizer, input_ids) for input_ids in prompts]
+
+
+@pytest.mark.parametrize("paged", [False, True])
+@pytest.mark.parametrize("fallback", [None, "evicted", "expired"])
+def test_session_turn_reusing_kv_matches_full_prefill(model, tokenizer, paged, fallback):
+    """A follow-up prefilled on top of the session's cached KV decodes as it would from scratch,
+    and so does one whose cache was evicted or expired in between"""
+    kv_pool = KVBlockPool.for_model(model, 1 << 20, block_size=4) if paged else None
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=2, kv_pool=kv_pool).start()
+    sessions = SessionStore()
+    question, answer, follow_up = CONVERSATIONS["hindi"]
+
+    def turn(session, messages):
+        # As deepseek_web_app.start_chat/submit_chat do with a session
+        input_ids = encode_chat(tokenizer, messages)
+        if paged:
+            past_table, reused = sessions.lookup_table(session, input_ids, kv_pool)
+            past_layers = None
+        else:
+            past_layers, reused = sessions.lookup(session, input_ids)
+            past_table = None
+        request = scheduler.submit(input_ids, max_new_tokens=MAX_NEW_TOKENS, do_sample=False,
+                                   past_layers=past_layers, past_table=past_table, keep_cache=True)
+        output = request.result(timeout=60)
+        if paged:
+            sessions.store_table(session, request.cache_ids, request.take_cache_table())
+        else:
+            sessions.store(session, request.cache_ids, request.cache_layers)
+        return input_ids, output, reused
+
+    try:
+        session = sessions.get("a")
+        turn(session, [{"role": "user", "content": question}])
+        if fallback == "evicted":
+            if paged:
+                # What the pool does when it runs out of blocks
+                assert sessions.release_table()
+            else:
+                # Another session's cache of the same size pushes this one out of the budget
+                sessions.memory_budget_bytes = sessions.kv_bytes
+                turn(sessions.get("b"), [{"role": "user", "content": question}])
+        elif fallback == "expired":
+            sessions.ttl_seconds = 0
+            sessions._last_expiry = 0
+            sessions.get("b")
+        input_ids, output, reused = turn(session, [{"role": "user", "content": question},
+                                                   {"role": "assistant", "content": answer},
+                                                   {"role": "user", "content": follow_up}])
+    finally:
+        scheduler.stop()
+    assert output == greedy(model, tokenizer, input_ids)
+    assert (reused > 0) == (fallback is None)
+    assert sessions.stats()["evictions" if fallback == "evicted" else "expirations"] == int(fallback is not None)
+    if paged:
+        sessions.delete("a")
+        sessions.delete("b")
+        assert kv_pool.stats()["used_blocks"] == 0
+
+
+def test_paged_kv_matches_greedy_and_shares_prefix_blocks(model, tokenizer):
+    """Decoding from a paged KV pool matches greedy generate; prompts with a common system prompt
+    share its blocks, a table forked mid-block copies that block before writing to it, and every
+    block is free again once the tables are released"""
+    kv_pool = KVBlockPool.for_model(model, 1 << 20, block_size=4)
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=4, kv_pool=kv_pool).start()
+    system = {"role": "system", "content": get_system_prompt("hindi")}
+    prompts = [encode_chat(tokenizer, [system, {"role": "user", "content": message}])
+               for message in CONVERSATIONS["hindi"]]
+    try:
+        first = scheduler.submit(prompts[0], max_new_tokens=MAX_NEW_TOKENS, do_sample=False, keep_cache=True)
+        outputs = [first.result(timeout=60)]
+        tables = [first.take_cache_table()]
+        # A different continuation of the first prompt, branching off inside a block of its table
+        forked_length = max(length for length in range(len(prompts[0])) if length % kv_pool.block_size)
+        prompts.append(prompts[0][:forked_length] + prompts[1][-4:])
+        first_keys = kv_pool.keys[:, tables[0].slots()].clone()
+        requests = [scheduler.submit(input_ids, max_new_tokens=MAX_NEW_TOKENS, do_sample=False, keep_cache=True)
+                    for input_ids in prompts[1:-1]]
+        requests.append(scheduler.submit(prompts[-1], max_new_tokens=MAX_NEW_TOKENS, do_sample=False,
+                                         past_table=kv_pool.fork(tables[0], forked_length), keep_cache=True))
+        outputs += [request.result(timeout=60) for request in requests]
+        tables += [request.take_cache_table() for request in requests]
+    finally:
+        scheduler.stop()
+    # The scheduler stops at EOS without emitting it
+    expected = []
+    for input_ids in prompts:
+        output_ids = greedy(model, tokenizer, input_ids)
+        expected.append(output_ids[:-1] if output_ids[-1] == tokenizer.eos_token_id else output_ids)
+    assert outputs == expected
+
+    stats = kv_pool.stats()
+    assert stats["prefix_hits"] == len(CONVERSATIONS["hindi"]) - 1
+    assert stats["shared_blocks"] > 0
+    assert stats["cow_copies"] == 1
+    assert torch.equal(kv_pool.keys[:, tables[0].slots()], first_keys)
+    for table in tables:
+        kv_pool.free(table)
+    assert kv_pool.stats()["used_blocks"] == 0
+
+
+def test_prepared_checkpoint_loads_identical_model(model, tokenizer, model_path, prompts, tmp_path):
+    """A prepared checkpoint is loaded memory-mapped and generates exactly what the original does"""
+    prepared_path = prepare_checkpoint(model_path, str(tmp_path / "prepared"), "float32")
+    assert is_prepared(prepared_path)
+    prepared = load_model(prepared_path)
+    assert prepared.dtype == torch.float32
+    weights = prepared.state_dict()
+    for name, param in model.state_dict().items():
+        assert torch.equal(weights[name], param), name
+    for input_ids in prompts:
+        assert greedy(prepared, tokenizer, input_ids) == greedy(model, tokenizer, input_ids)
+
+
+@pytest.fixture(scope="module")
+def draft_model(tmp_path_factory):
+    """A different random model sharing the tokenizer, so most of its proposals are rejected"""
+    path = create_tiny_model(str(tmp_path_factory.mktemp("draft")), hidden_size=32, num_layers=1, seed=1)
+    return AutoModelForCausalLM.from_pretrained(path).eval()
+
+
+@pytest.mark.parametrize("draft", ["self", "other"])
+def test_speculative_matches_greedy_generate(model, draft_model, tokenizer, prompts, draft):
+    """Draft proposals change how many passes the main model makes, never the tokens it picks"""
+    proposer = model if draft == "self" else draft_model
+    for input_ids in prompts:
+        output, stats = speculative_generate(model, proposer, torch.tensor([input_ids]),
+                                             max_new_tokens=MAX_NEW_TOKENS, lookahead=4,
+                                             eos_token_id=tokenizer.eos_token_id)
+        assert output[0, len(input_ids):].tolist() == greedy(model, tokenizer, input_ids)
+        if draft == "self":
+            # The model agrees with itself, so every proposal is accepted
+            assert stats["acceptance_rate"] == 1.0
+            assert stats["target_passes"] < stats["new_tokens"]
+
+
+@pytest.mark.parametrize("message, min_confidence, answered_by, escalated", [
+    ("What is today's onion price?", 0.0, "small", False),
+    # No answer reaches a mean token probability above 1, so the small tier always escalates
+    ("What is today's onion price?", 1.01, "full", True),
+    ("Explain why onion prices rise in the monsoon", 0.0, "full", False),
+])
+def test_router_serves_or_escalates_small_tier(model, draft_model, tokenizer, message, min_confidence,
+                                               answered_by, escalated):
+    """Simple messages go to the small tier, and on to the full model when it is unsure; hard ones skip it"""
+    input_ids = encode_chat(tokenizer, [{"role": "user", "content": message}])
+    schedulers = [ContinuousBatchingScheduler(draft_model, tokenizer).start(),
+                  ContinuousBatchingScheduler(model, tokenizer).start()]
+    router = TierRouter([TierPolicy("small", "tiny-small", min_confidence=min_confidence)], probe_tokens=4)
+
+    def start(index, on_token, on_done, cancel_token, token_probs):
+        return schedulers[index].submit(input_ids, max_new_tokens=MAX_NEW_TOKENS, do_sample=False,
+                                        cancel_token=cancel_token, token_probs=token_probs,
+                                        on_token=on_token, on_done=on_done)
+
+    try:
+        output = router.submit(message, "english", start).result(timeout=60)
+    finally:
+        for scheduler in schedulers:
+            scheduler.stop()
+    tiers = {tier["name"]: tier for tier in router.stats()["tiers"]}
+    assert tiers[answered_by]["served"] == 1
+    assert output == greedy(draft_model if answered_by == "small" else model, tokenizer, input_ids)
+    assert tiers["small"]["escalated"] == int(escalated)
+
+
+@pytest.mark.parametrize("paged", [False, True])
+def test_scheduler_fails_only_the_request_whose_prefill_fails(model, tokenizer, prompts, paged):
+    """A prompt the model cannot prefill fails on its own; the rest of the batch still decodes"""
+    kv_pool = KVBlockPool.for_model(model, 1 << 20, block_size=4) if paged else None
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=4, kv_pool=kv_pool)
+    # Queued before the thread starts, so the bad prompt is prefilled in one pass with the others
+    requests = [scheduler.submit(input_ids, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+                for input_ids in prompts[:2]]
+    bad = scheduler.submit([1, 2, 10 ** 6], max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+    requests.append(scheduler.submit(prompts[2], max_new_tokens=MAX_NEW_TOKENS, do_sample=False))
+    scheduler.start()
+    try:
+        with pytest.raises(IndexError):
+            bad.result(timeout=60)
+        outputs = [request.result(timeout=60) for request in requests]
+        # The scheduler keeps serving after the failure
+        after = scheduler.generate(prompts[3], timeout=60, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+    finally:
+        scheduler.stop()
+    assert outputs == [greedy(model, tokenizer, input_ids) for input_ids in prompts[:3]]
+    assert after == greedy(model, tokenizer, prompts[3])
+    if paged:
+        assert kv_pool.stats()["used_blocks"] == 0
+
+
+def test_worker_pool_fails_requests_of_a_dead_worker_and_restarts_it(model, tokenizer, model_path, prompts,
+                                                                     tmp_path):
+    """Requests held by a killed worker process fail instead of hanging, and the worker comes back"""
+    pool = WorkerPool(model_path, 1, cache_dir=str(tmp_path)).start()
+    try:
+        request = pool.submit(prompts[0], max_new_tokens=10 ** 6, do_sample=False)
+        os.kill(pool.stats()["workers"][0]["pid"], signal.SIGKILL)
+        with pytest.raises(RuntimeError, match="exited"):
+            request.result(timeout=60)
+        # Sent to the restarting worker, which picks it up once it has loaded the model
+        output = pool.generate(prompts[1], timeout=120, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+        worker = pool.stats()["workers"][0]
+    finally:
+        pool.stop()
+    assert output == greedy(model, tokenizer, prompts[1])
+    assert worker["restarts"] == 1 and worker["ready"] and worker["outstanding"] == 0
+
+
+def test_semantic_cache_matches_paraphrases_with_model_embedding(model, tokenizer):
+    """Hidden-state embeddings match a paraphrase the n-gram embedding misses, but never a different quantity"""
+    params = {"do_sample": False}
+    # A random model's hidden states only separate meanings coarsely, so the threshold is set for
+    # it; serving a pretrained model needs a threshold calibrated for that model
+    model_cache = SemanticCache("tiny", threshold=0.3, embed=lambda text: hidden_state_vector(model, tokenizer, text))
+    ngram_cache = SemanticCache("tiny")
+    for cache in (model_cache, ngram_cache):
+        cache.put("today's onion price", "english", params, "Onion: ₹40/kg")
+    assert model_cache.get("onion rate today?", "english", params) == "Onion: ₹40/kg"
+    assert ngram_cache.get("onion rate today?", "english", params) is None
+    assert model_cache.get("Who delivers tomatoes in Dadar?", "english", params) is None
+
+    cache = SemanticCache("tiny", threshold=0.3, embed=lambda text: hidden_state_vector(model, tokenizer, text))
+    cache.put("5 kg onion price", "english", params, "₹200")
+    assert cache.get("50 kg onion price", "english", params) is None
+    assert cache.stats()["refused"] == 1